@@ -23,12 +23,32 @@ _CC.MODEL.ROI_HEADS.DROPOUT_RATIO = 0.8
 _CC.MODEL.ROI_BOX_HEAD.POOLER_RESOLUTION = 7  # for faster
 
 # ------------- TEST ------------- #
+_CC.TEST.IMS_PER_BATCH = 1                 # images per inference batch on each device, grouped by orientation
+_CC.TEST.PRE_NMS_TOPK_PER_IMAGE = 0        # (box, class) candidates per image entering NMS, 0 for all
+_CC.TEST.RES5_CHUNK_SIZE = 0               # proposals per res5 pass of Res5ROIHeads, 0 for all
+_CC.TEST.PROPOSAL_MIN_OBJECTNESS = 0.0     # sigmoid objectness to reach the ROI head, 0 for all
+_CC.TEST.PROPOSAL_OBJECTNESS_MASS = 1.0    # keep top proposals holding this share of objectness, 1 for all
+_CC.TEST.PROPOSAL_GATE_MIN_KEEP = 16       # top proposals per image never dropped by the two gates above
+_CC.TEST.PROPOSAL_GATE_MAX_KEEP = -1       # most proposals per image after the gate, -1 for no limit
+_CC.TEST.NMS_TYPE = "greedy"               # or 'fast' / 'matrix', see tools/nms_compare.py
+_CC.TEST.VOC_EXPORT_PREDICTIONS = False    # also write the VOC per-class result files to the output dir
+_CC.TEST.COCO_EVAL_WORKERS = 0             # processes splitting COCOeval.evaluate() by category, 0 for none
+_CC.TEST.DIST_EVAL = "gather"              # or 'reduce': each rank matches its own images, only matches are gathered
 _CC.TEST.PCB_ENABLE = False
-_CC.TEST.PCB_MODELTYPE = 'resnet'             # res-like
+_CC.TEST.PCB_MODELTYPE = 'resnet'             # res-like, or 'resnet_trunk' / 'resnet_int8' (cpu)
 _CC.TEST.PCB_MODELPATH = ""
 _CC.TEST.PCB_ALPHA = 0.50
 _CC.TEST.PCB_UPPER = 1.0
 _CC.TEST.PCB_LOWER = 0.05
+_CC.TEST.PCB_CACHE_DIR = ""                # prototype cache dir, "" to disable
+_CC.TEST.PCB_BATCH_SIZE = 8                # support images per prototype batch
+_CC.TEST.PCB_SUPPORT_MIN_SIZE = 0          # support short side, 0 keeps original size
+_CC.TEST.PCB_SUPPORT_MAX_SIZE = 1333
+_CC.TEST.PCB_FEATURE_CACHE_DIR = ""        # test feature maps reused across evals, "" to disable
+_CC.TEST.PCB_QUANT_CALIB_BATCHES = 8       # support batches used to calibrate 'resnet_int8'
+_CC.TEST.PCB_PROTOTYPES_PER_CLASS = 1      # >1 keeps raw shots or k-means centroids per class
+_CC.TEST.PCB_TOPK = 1                      # similarities averaged over the best k prototypes
+_CC.TEST.PCB_DUMP_DIR = ""                 # raw scores for tools/pcb_sweep.py, "" to disable
 
 # ------------ Other ------------- #
 _CC.SOLVER.WEIGHT_DECAY = 5e-5
@@ -378,13 +378,18 @@ def _test_loader_from_config(cfg, dataset_name, mapper=None):
     )
     if mapper is None:
         mapper = DatasetMapper(cfg, False)
-    return {"dataset": dataset, "mapper": mapper, "num_worker": cfg.DATALOADER.NUM_WORKERS}
+    return {
+        "dataset": dataset,
+        "mapper": mapper,
+        "num_worker": cfg.DATALOADER.NUM_WORKERS,
+        "batch_size": cfg.TEST.IMS_PER_BATCH,
+    }
 
 
 @configurable(from_config=_test_loader_from_config)
-def build_detection_test_loader(dataset, *, mapper, num_worker=0):
+def build_detection_test_loader(dataset, *, mapper, num_worker=0, batch_size=1):
     """
-    Similar to `build_detection_train_loader`, but uses a batch size of 1.
+    Similar to `build_detection_train_loader`, but uses a batch size of 1 by default.
     This interface is experimental.
     Args:
         dataset (list or torch.utils.data.Dataset): a list of dataset dicts,
@@ -394,6 +399,9 @@ def build_detection_test_loader(dataset, *, mapper, num_worker=0):
            and returns the format to be consumed by the model.
            When using cfg, the default choice is ``DatasetMapper(cfg, is_train=False)``.
         num_workers (int): number of parallel data loading workers
+        batch_size (int): images per batch on each worker. When larger than 1, the
+            images of a batch share their orientation (see
+            :class:`InferenceGroupedBatchSampler`) to limit the padding.
     Returns:
         DataLoader: a torch DataLoader, that loads the given detection
         dataset, with test-time transformation and batching.
@@ -405,14 +413,18 @@ def build_detection_test_loader(dataset, *, mapper, num_worker=0):
         # or, instantiate with a CfgNode:
         data_loader = build_detection_test_loader(cfg, "my_test")
     """
+    group_ids = None
     if isinstance(dataset, list):
+        group_ids = [0 if d.get("width", 1) > d.get("height", 0) else 1 for d in dataset]
         dataset = DatasetFromList(dataset, copy=False)
     if mapper is not None:
         dataset = MapDataset(dataset, mapper)
     sampler = InferenceSampler(len(dataset))
-    # Always use 1 image per worker during inference since this is the
-    # standard when reporting inference time in papers.
-    batch_sampler = torch.utils.data.sampler.BatchSampler(sampler, 1, drop_last=False)
+    if batch_size > 1 and group_ids is not None:
+        batch_sampler = InferenceGroupedBatchSampler(sampler, group_ids, batch_size)
+    else:
+        # 1 image per worker is the standard when reporting inference time in papers.
+        batch_sampler = torch.utils.data.sampler.BatchSampler(sampler, batch_size, drop_last=False)
     data_loader = torch.utils.data.DataLoader(
         dataset,
         num_workers=num_worker,
@@ -422,6 +434,45 @@ def build_detection_test_loader(dataset, *, mapper, num_worker=0):
     return data_loader
 
 
+class InferenceGroupedBatchSampler(torch.utils.data.sampler.Sampler):
+    """
+    Batch the indices of an :class:`InferenceSampler` so that the images of a batch
+    share their orientation (width > height or not), like
+    :class:`AspectRatioGroupedDataset` does for training.
+
+    Unlike the training grouping it drops nothing and is deterministic: indices keep
+    the order of the sampler within each group, a batch is yielded as soon as its
+    group is full, and the partial batches are yielded last.
+    """
+
+    def __init__(self, sampler, group_ids, batch_size):
+        """
+        Args:
+            sampler (Sampler): an inference sampler, usually :class:`InferenceSampler`.
+            group_ids (list[int]): the orientation group of every dataset index.
+            batch_size (int): maximum number of images per batch.
+        """
+        self.sampler = sampler
+        self.group_ids = np.asarray(group_ids)
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        buckets = {}
+        for idx in self.sampler:
+            bucket = buckets.setdefault(self.group_ids[idx], [])
+            bucket.append(idx)
+            if len(bucket) == self.batch_size:
+                yield bucket[:]
+                del bucket[:]
+        for bucket in sorted(buckets.values(), key=lambda b: b[0] if b else -1):
+            if bucket:
+                yield bucket
+
+    def __len__(self):
+        counts = np.bincount(self.group_ids[np.asarray(list(self.sampler), dtype=np.int64)])
+        return int(np.ceil(counts / self.batch_size).sum())
+
+
 def trivial_batch_collator(batch):
     """
     A batch collator that does nothing.
@@ -41,7 +41,8 @@ class DatasetMapper:
         instance_mask_format: str = "polygon",
         keypoint_hflip_indices: Optional[np.ndarray] = None,
         precomputed_proposal_topk: Optional[int] = None,
-        recompute_boxes: bool = False
+        recompute_boxes: bool = False,
+        keep_original_image: bool = False
     ):
         """
         NOTE: this interface is experimental.
@@ -58,6 +59,9 @@ class DatasetMapper:
                 proposals from dataset_dict and keep the top k proposals for each image.
             recompute_boxes: whether to overwrite bounding box annotations
                 by computing tight bounding boxes from instance mask annotations.
+            keep_original_image: whether to also return the decoded image before any
+                augmentation as "original_image", so that consumers such as PCB do not
+                have to read the file again.
         """
         if recompute_boxes:
             assert use_instance_mask, "recompute_boxes requires instance masks"
@@ -71,6 +75,7 @@ class DatasetMapper:
         self.keypoint_hflip_indices = keypoint_hflip_indices
         self.proposal_topk          = precomputed_proposal_topk
         self.recompute_boxes        = recompute_boxes
+        self.keep_original_image    = keep_original_image
         # fmt: on
         logger = logging.getLogger(__name__)
         mode = "training" if is_train else "inference"
@@ -93,6 +98,7 @@ class DatasetMapper:
             "instance_mask_format": cfg.INPUT.MASK_FORMAT,
             "use_keypoint": cfg.MODEL.KEYPOINT_ON,
             "recompute_boxes": recompute_boxes,
+            "keep_original_image": cfg.TEST.PCB_ENABLE and not is_train,
         }
 
         if cfg.MODEL.KEYPOINT_ON:
@@ -117,6 +123,8 @@ class DatasetMapper:
         # USER: Write your own image loading if it's not from a file
         image = utils.read_image(dataset_dict["file_name"], format=self.image_format)
         utils.check_image_size(dataset_dict, image)
+        if self.keep_original_image:
+            dataset_dict["original_image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
 
         # USER: Remove if you don't do semantic/panoptic segmentation.
         if "sem_seg_file_name" in dataset_dict:
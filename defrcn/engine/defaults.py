@@ -495,7 +495,7 @@ class DefaultTrainer(SimpleTrainer):
                     )
                     results[dataset_name] = {}
                     continue
-            results_i = inference_on_dataset(model, data_loader, evaluator, cfg)
+            results_i = inference_on_dataset(model, data_loader, evaluator, cfg, dataset_name)
             results[dataset_name] = results_i
             if comm.is_main_process():
                 assert isinstance(
@@ -1 +1 @@
-from .resnet import resnet101
+from .resnet import ResNetTrunk, resnet101
@@ -1,18 +1,47 @@
 import os
 import cv2
+import copy
+import math
 import json
 import torch
+import hashlib
+import itertools
 import logging
 import detectron2
 import numpy as np
+import torch.nn.functional as F
+from detectron2.data import transforms as T
 from detectron2.structures import ImageList
 from detectron2.modeling.poolers import ROIPooler
-from sklearn.metrics.pairwise import cosine_similarity
-from defrcn.dataloader import build_detection_test_loader
-from defrcn.evaluation.archs import resnet101
+from detectron2.utils import comm
+from detectron2.data.samplers import InferenceSampler
+from detectron2.data.common import DatasetFromList, MapDataset
+from defrcn.dataloader import DatasetMapper, get_detection_dataset_dicts
+from defrcn.dataloader.build import trivial_batch_collator
+from defrcn.evaluation.archs import ResNetTrunk, resnet101
 
 logger = logging.getLogger(__name__)
 
+_PCB_BLOCKS = {}
+
+
+def get_calibration_block(cfg):
+    """
+    Return the PrototypicalCalibrationBlock for `cfg`, building it only on first use.
+    The ImageNet model and the prototypes do not depend on the detector being trained,
+    so the same block is reused by every evaluation in this process.
+    """
+    key = (
+        cfg.MODEL.DEVICE,
+        cfg.MODEL.ROI_HEADS.NUM_CLASSES,
+        cfg.DATASETS.TRAIN[0],
+        cfg.DATASETS.TEST[0],
+        tuple(sorted((k, str(v)) for k, v in cfg.TEST.items() if k.startswith("PCB"))),
+    )
+    if key not in _PCB_BLOCKS:
+        _PCB_BLOCKS[key] = PrototypicalCalibrationBlock(cfg)
+    return _PCB_BLOCKS[key]
+
 
 class PrototypicalCalibrationBlock:
 
@@ -21,17 +50,20 @@ class PrototypicalCalibrationBlock:
         self.cfg = cfg
         self.device = torch.device(cfg.MODEL.DEVICE)
         self.alpha = self.cfg.TEST.PCB_ALPHA
+        self.pixel_mean = torch.tensor([0.406, 0.456, 0.485]).reshape((3, 1, 1)).to(self.device)
+        self.pixel_std = torch.tensor([0.225, 0.224, 0.229]).reshape((3, 1, 1)).to(self.device)
 
         self.imagenet_model = self.build_model()
-        self.dataloader = build_detection_test_loader(self.cfg, self.cfg.DATASETS.TRAIN[0])
+        self.model_hash = self.hash_model_weights()
         self.roi_pooler = ROIPooler(output_size=(1, 1), scales=(1 / 32,), sampling_ratio=(0), pooler_type="ROIAlignV2")
-        self.prototypes = self.build_prototypes()
-
+        self.feature_extractor = self.build_feature_extractor()
         self.exclude_cls = self.clsid_filter()
+        self.prototypes, self.prototype_index = self.build_prototype_matrix(self.load_or_build_prototypes())
+        self.feature_store = self.build_feature_store()
 
     def build_model(self):
         logger.info("Loading ImageNet Pre-train Model from {}".format(self.cfg.TEST.PCB_MODELPATH))
-        if self.cfg.TEST.PCB_MODELTYPE == 'resnet':
+        if self.cfg.TEST.PCB_MODELTYPE in ['resnet', 'resnet_trunk', 'resnet_int8']:
             imagenet_model = resnet101()
         else:
             raise NotImplementedError
@@ -41,61 +73,296 @@ class PrototypicalCalibrationBlock:
         imagenet_model.eval()
         return imagenet_model
 
-    def build_prototypes(self):
+    @torch.no_grad()
+    def build_feature_extractor(self):
+        """
+        Return a callable mapping a preprocessed image batch to its layer4 feature map.
 
-        all_features, all_labels = [], []
-        for index in range(len(self.dataloader.dataset)):
-            inputs = [self.dataloader.dataset[index]]
-            assert len(inputs) == 1
-            # load support images and gt-boxes
-            img = cv2.imread(inputs[0]['file_name'])  # BGR
-            img_h, img_w = img.shape[0], img.shape[1]
-            ratio = img_h / inputs[0]['instances'].image_size[0]
-            inputs[0]['instances'].gt_boxes.tensor = inputs[0]['instances'].gt_boxes.tensor * ratio
+        'resnet' runs the full classification network as is. 'resnet_trunk' stops at
+        layer4 and runs a frozen, channels_last graph so that conv/bn/relu get fused
+        (by oneDNN on CPU). 'resnet_int8' additionally applies int8 post-training static
+        quantization calibrated on the support set, and is only available on CPU. It
+        falls back to 'resnet_trunk' when there is no support image to calibrate on.
+        """
+        modeltype = self.cfg.TEST.PCB_MODELTYPE
+        if modeltype == 'resnet':
+            return lambda x: self.imagenet_model(x)[1]
+
+        trunk = ResNetTrunk(self.imagenet_model).eval()
+        if modeltype == 'resnet_int8':
+            quantized = self.quantize_trunk(trunk)
+            if quantized is not None:
+                return quantized
+
+        trunk = trunk.to(memory_format=torch.channels_last)
+        example = torch.zeros((1, 3, 224, 224), device=self.device).to(memory_format=torch.channels_last)
+        return torch.jit.optimize_for_inference(torch.jit.trace(trunk, example))
+
+    @torch.no_grad()
+    def quantize_trunk(self, trunk):
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        if self.device.type != "cpu":
+            raise ValueError("PCB_MODELTYPE 'resnet_int8' is only supported with MODEL.DEVICE 'cpu'")
+
+        # every rank calibrates on the same leading support batches, so that the observers,
+        # and with them the quantized trunks, are identical across ranks
+        calib_batches = list(itertools.islice(
+            self.build_support_loader(shard=False), self.cfg.TEST.PCB_QUANT_CALIB_BATCHES
+        ))
+        if not calib_batches:
+            logger.warning(
+                "No support image to calibrate the int8 PCB trunk on; using the fp32 trunk instead."
+            )
+            return None
+        calib_images = [self.preprocess_images([x["image"] for x in inputs]) for inputs in calib_batches]
+        prepared = prepare_fx(copy.deepcopy(trunk), get_default_qconfig_mapping("x86"), (calib_images[0],))
+        for images in calib_images:
+            prepared(images)
+        quantized = convert_fx(prepared)
+
+        # report how far the int8 roi features drift from the fp32 ones on the support boxes
+        cos = []
+        for inputs, images in zip(calib_batches, calib_images):
+            boxes = [x["instances"].gt_boxes for x in inputs]
+            ref = self.imagenet_model.fc(self.roi_pooler([trunk(images)], boxes).flatten(1))
+            out = self.imagenet_model.fc(self.roi_pooler([quantized(images)], boxes).flatten(1))
+            cos.append(F.cosine_similarity(ref, out, dim=1))
+        cos = torch.cat(cos)
+        if len(cos) == 0:
+            return quantized
+        # |cos(a', p) - cos(a, p)| <= ||a'/|a'| - a/|a| || = sqrt(2 - 2 cos(a', a))
+        max_shift = (1 - self.alpha) * math.sqrt(max(2 - 2 * float(cos.min()), 0))
+        logger.info(
+            "PCB int8 drift on {} support boxes: cosine to fp32 features mean {:.4f}, min {:.4f}; "
+            "calibrated scores move by at most {:.4f}".format(len(cos), float(cos.mean()), float(cos.min()), max_shift)
+        )
+        return quantized
+
+    def hash_model_weights(self):
+        sha = hashlib.sha1()
+        with open(self.cfg.TEST.PCB_MODELPATH, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def prototype_cache_key(self):
+        """
+        Everything the prototypes depend on: the ImageNet weights, the support set
+        and the settings of the feature extractor. The batch size matters as images
+        are padded per batch, and with it the int8 calibration set.
+        """
+        return {
+            "model": self.model_hash,
+            "modeltype": self.cfg.TEST.PCB_MODELTYPE,
+            "dataset": self.cfg.DATASETS.TRAIN[0],
+            "support_size": [self.cfg.TEST.PCB_SUPPORT_MIN_SIZE, self.cfg.TEST.PCB_SUPPORT_MAX_SIZE],
+            "prototypes_per_class": self.cfg.TEST.PCB_PROTOTYPES_PER_CLASS,
+            "kmeans": "cosine",
+            "batch_size": self.cfg.TEST.PCB_BATCH_SIZE,
+            "quant_calib_batches": self.cfg.TEST.PCB_QUANT_CALIB_BATCHES,
+        }
+
+    def load_or_build_prototypes(self):
+        cache_dir = self.cfg.TEST.PCB_CACHE_DIR
+        if not cache_dir:
+            return self.build_prototypes()
+
+        key = json.dumps(self.prototype_cache_key(), sort_keys=True)
+        cache_file = os.path.join(
+            cache_dir, "prototypes_{}.pth".format(hashlib.sha1(key.encode()).hexdigest()[:16])
+        )
+        # building is a collective operation, so all ranks must agree on a cache hit
+        if all(comm.all_gather(os.path.exists(cache_file))):
+            logger.info("Loading PCB prototypes from {}".format(cache_file))
+            return torch.load(cache_file, map_location="cpu")
+
+        prototypes_dict = self.build_prototypes()
+        if comm.is_main_process():
+            os.makedirs(cache_dir, exist_ok=True)
+            # write to a private file first so that readers never see a partial cache
+            tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+            torch.save(prototypes_dict, tmp_file)
+            os.replace(tmp_file, cache_file)
+            logger.info("Saved PCB prototypes to {}".format(cache_file))
+        return prototypes_dict
+
+    def build_feature_store(self):
+        cache_dir = self.cfg.TEST.PCB_FEATURE_CACHE_DIR
+        if not cache_dir:
+            return None
+        key = "{}_{}".format(self.cfg.TEST.PCB_MODELTYPE, self.model_hash[:16])
+        if self.cfg.TEST.PCB_MODELTYPE == 'resnet_int8':
+            # the int8 trunk, and with it the features, depends on its calibration batches
+            calib_key = json.dumps([
+                self.cfg.DATASETS.TRAIN[0],
+                self.cfg.TEST.PCB_SUPPORT_MIN_SIZE,
+                self.cfg.TEST.PCB_SUPPORT_MAX_SIZE,
+                self.cfg.TEST.PCB_BATCH_SIZE,
+                self.cfg.TEST.PCB_QUANT_CALIB_BATCHES,
+            ])
+            key += "_" + hashlib.sha1(calib_key.encode()).hexdigest()[:8]
+        logger.info("Caching PCB test feature maps in {}".format(os.path.join(cache_dir, key)))
+        return FeatureMapStore(os.path.join(cache_dir, key))
+
+    def build_support_loader(self, shard=True):
+        """
+        A loader over this rank's shard of the support set (or over the whole set in
+        order if not `shard`) that decodes and resizes images in its workers and yields
+        batches of TEST.PCB_BATCH_SIZE mapped dicts.
+        """
+        min_size, max_size = self.cfg.TEST.PCB_SUPPORT_MIN_SIZE, self.cfg.TEST.PCB_SUPPORT_MAX_SIZE
+        augmentations = [T.ResizeShortestEdge(min_size, max_size, "choice")] if min_size > 0 else []
+        mapper = DatasetMapper(False, augmentations=augmentations, image_format="BGR")
+        dataset = get_detection_dataset_dicts([self.cfg.DATASETS.TRAIN[0]], filter_empty=False)
+        dataset = MapDataset(DatasetFromList(dataset, copy=False), mapper)
+        if shard:
+            sampler = InferenceSampler(len(dataset))
+        else:
+            sampler = torch.utils.data.sampler.SequentialSampler(dataset)
+        batch_sampler = torch.utils.data.sampler.BatchSampler(
+            sampler, self.cfg.TEST.PCB_BATCH_SIZE, drop_last=False
+        )
+        return torch.utils.data.DataLoader(
+            dataset,
+            num_workers=self.cfg.DATALOADER.NUM_WORKERS,
+            batch_sampler=batch_sampler,
+            collate_fn=trivial_batch_collator,
+        )
+
+    def support_roi_features(self):
+        """
+        Yield the roi features and class labels of the gt-boxes of this rank's
+        support images, one loader batch at a time.
+        """
+        for inputs in self.build_support_loader():
+            # support images come resized by the loader, with gt-boxes in the same frame
+            images = [x["image"].to(self.device) for x in inputs]
             boxes = [x["instances"].gt_boxes.to(self.device) for x in inputs]
+            labels = torch.cat([x["instances"].gt_classes for x in inputs]).to(self.device)
 
-            # extract roi features
-            features = self.extract_roi_features(img, boxes)
-            all_features.append(features.cpu().data)
+            # extract roi features of the whole batch at once
+            conv_feature = self.extract_conv_features(images)
+            box_features = self.roi_pooler([conv_feature], boxes).flatten(1)
+            yield self.imagenet_model.fc(box_features), labels
+
+    @torch.no_grad()
+    def build_prototypes(self):
+        if self.cfg.TEST.PCB_PROTOTYPES_PER_CLASS > 1:
+            return self.build_prototype_bank()
 
-            gt_classes = [x['instances'].gt_classes for x in inputs]
-            all_labels.append(gt_classes[0].cpu().data)
+        num_classes = self.cfg.MODEL.ROI_HEADS.NUM_CLASSES
+        feature_sums = torch.zeros((num_classes, self.imagenet_model.fc.out_features), device=self.device)
+        counts = torch.zeros(num_classes, device=self.device)
+        for features, labels in self.support_roi_features():
+            feature_sums.index_add_(0, labels, features)
+            counts.index_add_(0, labels, torch.ones_like(labels, dtype=counts.dtype))
 
-        # concat
-        all_features = torch.cat(all_features, dim=0)
-        all_labels = torch.cat(all_labels, dim=0)
-        assert all_features.shape[0] == all_labels.shape[0]
+        # every rank only saw its shard, sum the statistics over all ranks
+        if comm.get_world_size() > 1:
+            stats = torch.cat([feature_sums, counts.unsqueeze(1)], dim=1)
+            if torch.distributed.get_backend() == "gloo":
+                stats = stats.cpu()
+            torch.distributed.all_reduce(stats)
+            stats = stats.to(self.device)
+            feature_sums, counts = stats[:, :-1], stats[:, -1]
 
         # calculate prototype
-        features_dict = {}
-        for i, label in enumerate(all_labels):
-            label = int(label)
-            if label not in features_dict:
-                features_dict[label] = []
-            features_dict[label].append(all_features[i].unsqueeze(0))
+        prototypes = (feature_sums / counts.clamp(min=1).unsqueeze(1)).cpu()
+        return {int(label): prototypes[label].unsqueeze(0) for label in counts.cpu().nonzero().flatten()}
 
-        prototypes_dict = {}
-        for label in features_dict:
-            features = torch.cat(features_dict[label], dim=0)
-            prototypes_dict[label] = torch.mean(features, dim=0, keepdim=True)
+    @torch.no_grad()
+    def build_prototype_bank(self):
+        """
+        Keep up to TEST.PCB_PROTOTYPES_PER_CLASS prototypes per class: the raw support
+        features when a class has few enough shots, otherwise their k-means centroids.
+        """
+        max_prototypes = self.cfg.TEST.PCB_PROTOTYPES_PER_CLASS
+        all_features, all_labels = [], []
+        for features, labels in self.support_roi_features():
+            all_features.append(features.cpu())
+            all_labels.append(labels.cpu())
+        # a rank may get no support image when there are more ranks than images
+        all_features = torch.cat(all_features, dim=0) if all_features else \
+            torch.zeros((0, self.imagenet_model.fc.out_features))
+        all_labels = torch.cat(all_labels, dim=0) if all_labels else torch.zeros(0, dtype=torch.long)
+
+        # every rank only saw its shard, gather the raw features in rank order
+        if comm.get_world_size() > 1:
+            gathered = comm.all_gather((all_features, all_labels))
+            all_features = torch.cat([features for features, _ in gathered], dim=0)
+            all_labels = torch.cat([labels for _, labels in gathered], dim=0)
 
+        prototypes_dict = {}
+        for label in all_labels.unique().tolist():
+            features = all_features[all_labels == label]
+            if len(features) > max_prototypes:
+                features = kmeans(features, max_prototypes)
+            prototypes_dict[label] = features
         return prototypes_dict
 
-    def extract_roi_features(self, img, boxes):
+    def build_prototype_matrix(self, prototypes_dict):
+        """
+        Stack all prototypes into a single L2-normalized PxD bank on the model device,
+        grouped by class, together with a CxM lookup from class id to the bank rows of
+        that class (M is the largest number of prototypes of a class).
+        Unused slots, and classes that are excluded from calibration or have no
+        prototype, map to -1. Without any prototype, both are None and calibration
+        is disabled.
+        """
+        if not prototypes_dict:
+            logger.warning(
+                "No PCB prototypes found in the support set {}; predictions will not be "
+                "calibrated.".format(self.cfg.DATASETS.TRAIN[0])
+            )
+            return None, None
+
+        labels = sorted(prototypes_dict.keys())
+        prototypes = torch.cat([prototypes_dict[label] for label in labels], dim=0)
+        prototypes = F.normalize(prototypes.to(self.device), dim=1)
+
+        num_classes = max([self.cfg.MODEL.ROI_HEADS.NUM_CLASSES] + [label + 1 for label in labels])
+        max_prototypes = max(len(prototypes_dict[label]) for label in labels)
+        prototype_index = torch.full((num_classes, max_prototypes), -1, dtype=torch.long)
+        offset = 0
+        for label in labels:
+            num_prototypes = len(prototypes_dict[label])
+            prototype_index[label, :num_prototypes] = torch.arange(offset, offset + num_prototypes)
+            offset += num_prototypes
+        prototype_index[self.exclude_cls] = -1
+
+        missing = [c for c in range(num_classes) if c not in prototypes_dict and c not in self.exclude_cls]
+        if missing:
+            logger.warning(f"Prototypes for classes {missing} not found; their predictions will not be calibrated.")
+        return prototypes, prototype_index.to(self.device)
+
+    def preprocess_images(self, images):
+        """
+        :param images: list of CxHxW BGR images on the model device, in [0, 255]
+        :return: normalized RGB batch, padded to the largest image, size: BxCxHxW
+        """
+        images = [(img / 255. - self.pixel_mean) / self.pixel_std for img in images]
+        images = ImageList.from_tensors(images, 0).tensor[:, [2, 1, 0]]
+        if self.cfg.TEST.PCB_MODELTYPE != 'resnet':
+            images = images.contiguous(memory_format=torch.channels_last)
+        return images
+
+    def extract_conv_features(self, images):
         """
-        :param img:
-        :param boxes:
-        :return:
+        :param images: list of CxHxW BGR images on the model device, in [0, 255]
+        :return: stride-32 feature map of the padded batch, size: BxCxHxW
         """
+        return self.feature_extractor(self.preprocess_images(images))
 
-        mean = torch.tensor([0.406, 0.456, 0.485]).reshape((3, 1, 1)).to(self.device)
-        std = torch.tensor([[0.225, 0.224, 0.229]]).reshape((3, 1, 1)).to(self.device)
+    def extract_roi_features(self, conv_features, boxes):
+        """
+        :param conv_features: list of N CxHixWi feature maps, one per image
+        :param boxes: list of N Boxes, one per image
+        :return: roi features of all boxes, concatenated in image order
+        """
 
-        img = img.transpose((2, 0, 1))
-        img = torch.from_numpy(img).to(self.device)
-        images = [(img / 255. - mean) / std]
-        images = ImageList.from_tensors(images, 0)
-        conv_feature = self.imagenet_model(images.tensor[:, [2, 1, 0]])[1]  # size: BxCxHxW
+        conv_feature = ImageList.from_tensors(conv_features, 0).tensor  # size: NxCxHxW
 
         box_features = self.roi_pooler([conv_feature], boxes).squeeze(2).squeeze(2)
 
@@ -103,31 +370,122 @@ class PrototypicalCalibrationBlock:
 
         return activation_vectors
 
-    def execute_calibration(self, inputs, dts):
-
-        img = cv2.imread(inputs[0]['file_name'])
-
-        ileft = (dts[0]['instances'].scores > self.cfg.TEST.PCB_UPPER).sum()
-        iright = (dts[0]['instances'].scores > self.cfg.TEST.PCB_LOWER).sum()
-        assert ileft <= iright
-        boxes = [dts[0]['instances'].pred_boxes[ileft:iright]]
-
-        features = self.extract_roi_features(img, boxes)
-
-        for i in range(ileft, iright):
-            tmp_class = int(dts[0]['instances'].pred_classes[i])
-            if tmp_class in self.exclude_cls:
-                continue
-            if tmp_class not in self.prototypes:
-                logger.warning(f"Prototype for class {tmp_class} not found; skipping calibration for this prediction.")
-                continue
-            tmp_cos = cosine_similarity(
-                features[i - ileft].cpu().data.numpy().reshape((1, -1)),
-                self.prototypes[tmp_class].cpu().data.numpy(),
-            )[0][0]
-            dts[0]['instances'].scores[i] = dts[0]['instances'].scores[i] * self.alpha + tmp_cos * (1 - self.alpha)
+    def test_conv_features(self, inputs):
+        """
+        Return the stride-32 feature map of each test image, cropped to its own extent.
+        Maps found in the feature store are read back instead of recomputed, and the
+        missing ones are computed in one batch and added to the store.
+        """
+        conv_features = [None] * len(inputs)
+        if self.feature_store is not None:
+            for i, input in enumerate(inputs):
+                cached = self.feature_store.get(input)
+                if cached is not None:
+                    conv_features[i] = cached.to(self.device).float()
+
+        missing = [i for i, x in enumerate(conv_features) if x is None]
+        if missing:
+            images = [self.load_image(inputs[i]) for i in missing]
+            conv_feature = self.extract_conv_features(images)
+            for j, (i, img) in enumerate(zip(missing, images)):
+                h, w = math.ceil(img.shape[1] / 32), math.ceil(img.shape[2] / 32)
+                conv_features[i] = conv_feature[j, :, :h, :w]
+                if self.feature_store is not None:
+                    self.feature_store.put(inputs[i], conv_features[i])
+        return conv_features
+
+    def load_image(self, input):
+        """
+        Return the original test image as a CxHxW BGR tensor on the model device,
+        reusing the pixels decoded by the test loader when they are available.
+        """
+        if "original_image" in input:
+            img = input["original_image"].to(self.device)
+            if self.cfg.INPUT.FORMAT == "RGB":
+                img = img[[2, 1, 0]]
+            return img
+        img = cv2.imread(input['file_name'])  # BGR
+        return torch.from_numpy(img.transpose((2, 0, 1))).to(self.device)
+
+    def execute_calibration(self, inputs, dts, similarities=None):
+        """
+        Calibrate the scores of `dts` in place and return them.
+
+        If `similarities` is a list, the prototype similarity of every box of every image
+        (NaN where the box cannot be calibrated) is appended to it, one tensor per image,
+        so that the calibration can be replayed offline with other PCB settings.
+        """
+        if self.prototypes is None:
+            if similarities is not None:
+                similarities.extend(
+                    torch.full_like(dt['instances'].scores, float("nan")) for dt in dts
+                )
+            return dts
+
+        # boxes are sorted by score, so each image calibrates a contiguous slice
+        spans = []
+        for dt in dts:
+            scores = dt['instances'].scores
+            ileft = int((scores > self.cfg.TEST.PCB_UPPER).sum())
+            iright = int((scores > self.cfg.TEST.PCB_LOWER).sum())
+            assert ileft <= iright
+            spans.append((ileft, iright))
+
+        # similarities are only needed for the slice, unless they are recorded
+        sim_spans = spans if similarities is None else [(0, len(dt['instances'])) for dt in dts]
+        box_similarities = self.box_similarities(inputs, dts, sim_spans)
+        for dt, (ileft, iright), (start, _), cos in zip(dts, spans, sim_spans, box_similarities):
+            scores = dt['instances'].scores
+            scores[ileft:iright] = blend_scores(scores[ileft:iright], cos[ileft - start:iright - start], self.alpha)
+
+        if similarities is not None:
+            similarities.extend(box_similarities)
         return dts
 
+    def box_similarities(self, inputs, dts, spans):
+        """
+        :param spans: for each image, the (start, end) range of its boxes to score
+        :return: for each image, the similarity of the boxes in its span to the
+            prototypes of their predicted class
+        """
+        similarities = [dt['instances'].scores.new_zeros(0) for dt in dts]
+        selected = [i for i, (start, end) in enumerate(spans) if start < end]
+        if not selected:
+            return similarities
+
+        conv_features = self.test_conv_features([inputs[i] for i in selected])
+        boxes = [dts[i]['instances'].pred_boxes[spans[i][0]:spans[i][1]] for i in selected]
+        features = self.extract_roi_features(conv_features, boxes)
+
+        classes = torch.cat([dts[i]['instances'].pred_classes[spans[i][0]:spans[i][1]] for i in selected])
+        cos = self.class_similarity(classes, features)
+        for i, cos_i in zip(selected, cos.split([len(b) for b in boxes])):
+            similarities[i] = cos_i
+        return similarities
+
+    def class_similarity(self, classes, features):
+        """
+        Cosine similarity between each box feature and the prototypes of its predicted
+        class, for all boxes at once. With several prototypes per class, the mean of the
+        TEST.PCB_TOPK best similarities is used.
+
+        :param classes: (B,) predicted class ids
+        :param features: (B, D) roi features
+        :return: (B,) similarities, NaN for classes that are not calibrated
+        """
+        rows = self.prototype_index[classes]  # size: BxM
+        cos = torch.mm(F.normalize(features, dim=1), self.prototypes.t())  # size: BxP
+        cos = cos.gather(1, rows.clamp(min=0))
+        if rows.shape[1] > 1:
+            valid = rows >= 0
+            topk = min(self.cfg.TEST.PCB_TOPK, rows.shape[1])
+            cos, order = cos.masked_fill(~valid, float("-inf")).topk(topk, dim=1)
+            valid = valid.gather(1, order)
+            cos = cos.masked_fill(~valid, 0).sum(dim=1) / valid.sum(dim=1).clamp(min=1)
+        else:
+            cos = cos.squeeze(1)
+        return cos.masked_fill(rows[:, 0] < 0, float("nan"))
+
     def clsid_filter(self):
         dsname = self.cfg.DATASETS.TEST[0]
         exclude_ids = []
@@ -144,6 +502,61 @@ class PrototypicalCalibrationBlock:
         return exclude_ids
 
 
+def blend_scores(scores, similarities, alpha):
+    """
+    The PCB calibration rule, alpha * score + (1 - alpha) * similarity.
+    Boxes whose similarity is NaN keep their detector score.
+    """
+    return torch.where(torch.isnan(similarities), scores, scores * alpha + similarities * (1 - alpha))
+
+
+def kmeans(features, k, num_iters=20):
+    """
+    Cluster the rows of `features` into `k` centroids by cosine similarity, the metric
+    of PCB: features and centroids are L2-normalized (spherical k-means), so that the
+    feature norms do not pull the centroids. Initialized deterministically from evenly
+    spaced rows, and returns unit-norm centroids.
+    """
+    features = F.normalize(features, dim=1)
+    centroids = features[torch.linspace(0, len(features) - 1, k).long()].clone()
+    for _ in range(num_iters):
+        assignment = torch.mm(features, centroids.t()).argmax(dim=1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, features)
+        counts = torch.bincount(assignment, minlength=k)
+        # keep the previous centroid of an empty cluster
+        nonempty = counts > 0
+        centroids[nonempty] = F.normalize(sums[nonempty], dim=1)
+    return centroids
+
+
+class FeatureMapStore:
+    """
+    A directory of fp16 feature maps, one .npy file per image, keyed by the image id
+    and file name. Files are memory-mapped on read and written atomically.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, input):
+        key = "{}:{}".format(input["image_id"], input["file_name"])
+        return os.path.join(self.root, hashlib.sha1(key.encode()).hexdigest()[:20] + ".npy")
+
+    def get(self, input):
+        path = self._path(input)
+        if not os.path.exists(path):
+            return None
+        return torch.tensor(np.load(path, mmap_mode="r"))
+
+    def put(self, input, feature):
+        path = self._path(input)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.save(f, feature.half().cpu().numpy())
+        os.replace(tmp_path, path)
+
+
 @torch.no_grad()
 def concat_all_gather(tensor):
     """
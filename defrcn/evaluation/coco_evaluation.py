@@ -4,8 +4,10 @@ import json
 import copy
 import torch
 import logging
+import datetime
 import itertools
 import contextlib
+import multiprocessing
 import numpy as np
 from tabulate import tabulate
 from collections import OrderedDict
@@ -17,14 +19,33 @@ from detectron2.utils import comm as comm
 from detectron2.data import MetadataCatalog
 from detectron2.utils.logger import create_small_table
 from detectron2.data.datasets.coco import convert_to_coco_json
+from defrcn.structures import DetectionBatch
 from defrcn.evaluation.evaluator import DatasetEvaluator
 
+logger = logging.getLogger(__name__)
+
 
 class COCOEvaluator(DatasetEvaluator):
 
-    def __init__(self, dataset_name, distributed, output_dir=None):
+    def __init__(self, dataset_name, distributed, output_dir=None, eval_workers=0,
+                 dist_eval="gather"):
+        """
+        Args:
+            dataset_name (str): name of the dataset to be evaluated.
+            distributed (bool): if True, collect results from all ranks for evaluation.
+            output_dir (str): optional, an output directory to dump results.
+            eval_workers (int): processes running COCOeval.evaluate() over disjoint
+                category subsets, 0 to run it in this process.
+            dist_eval (str): "gather" to evaluate all predictions on the main process,
+                or "reduce" to match the images of each rank on the rank and only
+                gather the per image matches. "reduce" writes no prediction files and
+                does not use `eval_workers`.
+        """
+        assert dist_eval in ["gather", "reduce"], dist_eval
 
         self._distributed = distributed
+        self._dist_eval = dist_eval
+        self._eval_workers = eval_workers
         self._output_dir = output_dir
         self._dataset_name = dataset_name
         self._cpu_device = torch.device("cpu")
@@ -53,8 +74,9 @@ class COCOEvaluator(DatasetEvaluator):
         self._do_evaluation = "annotations" in self._coco_api.dataset
 
     def reset(self):
-        self._predictions = []
-        self._coco_results = []
+        self._image_ids = []
+        self._detections = []  # DetectionBatch of every processed batch, on cpu
+        self._coco_results = None
 
     def process(self, inputs, outputs):
         """
@@ -65,70 +87,104 @@ class COCOEvaluator(DatasetEvaluator):
             outputs: the outputs of a COCO model. It is a list of dicts with key
                 "instances" that contains :class:`Instances`.
         """
-        for input, output in zip(inputs, outputs):
-            prediction = {"image_id": input["image_id"]}
-            # TODO this is ugly
-            if "instances" in output:
-                instances = output["instances"].to(self._cpu_device)
-                prediction["instances"] = instances_to_coco_json(
-                    instances, input["image_id"])
-            self._predictions.append(prediction)
+        self.process_detections(inputs, DetectionBatch.from_outputs(outputs))
+
+    def process_detections(self, inputs, detections):
+        self._image_ids.extend(x["image_id"] for x in inputs)
+        self._detections.append(detections.to(self._cpu_device))
 
     def evaluate(self):
+        if self._distributed and self._dist_eval == "reduce" and self._do_evaluation:
+            return self._evaluate_reduce()
+
+        image_ids = self._image_ids
+        detections = [DetectionBatch.cat(self._detections)] if self._detections else []
         if self._distributed:
             comm.synchronize()
-            self._predictions = comm.gather(self._predictions, dst=0)
-            self._predictions = list(itertools.chain(*self._predictions))
+            all_predictions = comm.gather((image_ids, detections), dst=0)
             if not comm.is_main_process():
                 return {}
+            image_ids = list(itertools.chain(*[x[0] for x in all_predictions]))
+            detections = list(itertools.chain(*[x[1] for x in all_predictions]))
 
-        if len(self._predictions) == 0:
+        if len(image_ids) == 0:
             self._logger.warning(
                 "[COCOEvaluator] Did not receive valid predictions.")
             return {}
+        detections = DetectionBatch.cat(detections)
 
         if self._output_dir:
             PathManager.mkdirs(self._output_dir)
             file_path = os.path.join(
                 self._output_dir, "instances_predictions.pth")
             with PathManager.open(file_path, "wb") as f:
-                torch.save(self._predictions, f)
+                torch.save(
+                    {
+                        "image_ids": image_ids,
+                        "boxes": detections.boxes,
+                        "scores": detections.scores,
+                        "classes": detections.classes,
+                        "offsets": detections.offsets,
+                    },
+                    f,
+                )
 
         self._results = OrderedDict()
-        if "instances" in self._predictions[0]:
-            self._eval_predictions()
+        self._eval_predictions(image_ids, detections)
         # Copy so the caller can do whatever with results
         return copy.deepcopy(self._results)
 
-    def _eval_predictions(self):
+    def _evaluate_reduce(self):
         """
-        Evaluate self._predictions on the instance detection task.
+        Match the detections of this rank against the ground truth of its images and
+        gather only the compact per image results of :func:`_evaluate_coco_shard`,
+        which the main process accumulates. No prediction file is written.
+        """
+        comm.synchronize()
+        coco_results = (
+            self._to_coco_array(self._image_ids, DetectionBatch.cat(self._detections))
+            if self._detections else np.zeros((0, 7))
+        )
+        splits = self._splits()
+        split_catIds = _normalize_split_catIds(
+            self._coco_api, [classes for _, classes, _ in splits]
+        )
+        shard = _evaluate_coco_shard(
+            self._coco_api, coco_results, "bbox", self._image_ids,
+            sorted(set(itertools.chain(*split_catIds))),
+        )
+        all_shards = comm.gather(shard, dst=0)
+        if not comm.is_main_process():
+            return {}
+
+        if sum(len(x["imgIds"]) for x in all_shards) == 0:
+            self._logger.warning(
+                "[COCOEvaluator] Did not receive valid predictions.")
+            return {}
+
+        self._results = OrderedDict()
+        self._logger.info("Evaluating predictions ...")
+        coco_evals = (
+            _accumulate_coco_shards(self._coco_api, all_shards, "bbox", split_catIds)
+            if sum(x["numResults"] for x in all_shards) > 0
+            else [None] * len(splits)  # cocoapi does not handle empty results very well
+        )
+        self._derive_split_results(splits, coco_evals)
+        return copy.deepcopy(self._results)
+
+    def _eval_predictions(self, image_ids, detections):
+        """
+        Evaluate the detections of `image_ids` on the instance detection task.
         Fill self._results with the metrics of the instance detection task.
         """
         self._logger.info("Preparing results for COCO format ...")
-        self._coco_results = list(
-            itertools.chain(*[x["instances"] for x in self._predictions]))
-
-        # unmap the category ids for COCO
-        if hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
-            reverse_id_mapping = {
-                v: k for k, v in self._metadata.thing_dataset_id_to_contiguous_id.items()
-            }
-            for result in self._coco_results:
-                orig_cid = result.get("category_id")
-                if orig_cid in reverse_id_mapping:
-                    result["category_id"] = reverse_id_mapping[orig_cid]
-                else:
-                    # Unknown category id from model predictions; skip and warn
-                    self._logger.warning(f"Unknown category_id {orig_cid} in predictions; skipping this item.")
-                    # Mark with an invalid category to let COCOAPI ignore it
-                    result["category_id"] = -1
+        self._coco_results = self._to_coco_array(image_ids, detections)
 
         if self._output_dir:
             file_path = os.path.join(self._output_dir, "coco_instances_results.json")
             self._logger.info("Saving results to {}".format(file_path))
             with PathManager.open(file_path, "w") as f:
-                f.write(json.dumps(self._coco_results))
+                f.write(json.dumps(coco_array_to_json(self._coco_results)))
                 f.flush()
 
         if not self._do_evaluation:
@@ -136,53 +192,105 @@ class COCOEvaluator(DatasetEvaluator):
             return
 
         self._logger.info("Evaluating predictions ...")
+        splits = self._splits()
         if self._is_splits:
-            self._results["bbox"] = {}
-            for split, classes, names in [
-                    ("all", None, self._metadata.get("thing_classes")),
-                    ("base", self._base_classes, self._metadata.get("base_classes")),
-                    ("novel", self._novel_classes, self._metadata.get("novel_classes"))]:
-                if "all" not in self._dataset_name and \
-                        split not in self._dataset_name:
-                    continue
-                coco_eval = (
-                    _evaluate_predictions_on_coco(
-                        self._coco_api, self._coco_results, "bbox", classes,
-                    )
-                    if len(self._coco_results) > 0
-                    else None  # cocoapi does not handle empty results very well
+            # the per image matching is shared by the splits, so it runs once
+            coco_evals = (
+                _evaluate_splits_on_coco(
+                    self._coco_api, self._coco_results, "bbox",
+                    [classes for _, classes, _ in splits], self._eval_workers,
                 )
-                res_ = self._derive_coco_results(coco_eval, "bbox", class_names=names)
-                res = {}
-                for metric in res_.keys():
-                    if len(metric) <= 4:
-                        if split == "all":
-                            res[metric] = res_[metric]
-                        elif split == "base":
-                            res["b"+metric] = res_[metric]
-                        elif split == "novel":
-                            res["n"+metric] = res_[metric]
-                self._results["bbox"].update(res)
-
-            # add "AP" if not already in
-            if "AP" not in self._results["bbox"]:
-                if "nAP" in self._results["bbox"]:
-                    self._results["bbox"]["AP"] = self._results["bbox"]["nAP"]
-                else:
-                    self._results["bbox"]["AP"] = self._results["bbox"]["bAP"]
+                if len(self._coco_results) > 0
+                else [None] * len(splits)  # cocoapi does not handle empty results very well
+            )
         else:
-            coco_eval = (
+            coco_evals = [
                 _evaluate_predictions_on_coco(
-                    self._coco_api, self._coco_results, "bbox",
+                    self._coco_api, self._coco_results, "bbox", num_workers=self._eval_workers,
                 )
                 if len(self._coco_results) > 0
                 else None  # cocoapi does not handle empty results very well
+            ]
+        self._derive_split_results(splits, coco_evals)
+
+    def _splits(self):
+        """
+        Returns:
+            list[tuple]: (split, category ids or None for all, class names) of each
+                split to evaluate. A single "all" split on datasets without splits.
+        """
+        if not self._is_splits:
+            return [("all", None, self._metadata.get("thing_classes"))]
+        return [
+            (split, classes, names) for split, classes, names in [
+                ("all", None, self._metadata.get("thing_classes")),
+                ("base", self._base_classes, self._metadata.get("base_classes")),
+                ("novel", self._novel_classes, self._metadata.get("novel_classes"))]
+            if "all" in self._dataset_name or split in self._dataset_name
+        ]
+
+    def _derive_split_results(self, splits, coco_evals):
+        """
+        Fill self._results["bbox"] with the metrics of each split of :meth:`_splits`,
+        prefixed with "b" for base and "n" for novel on split datasets.
+        """
+        if not self._is_splits:
+            self._results["bbox"] = self._derive_coco_results(
+                coco_evals[0], "bbox", class_names=splits[0][2]
             )
-            res = self._derive_coco_results(
-                coco_eval, "bbox",
-                class_names=self._metadata.get("thing_classes")
-            )
-            self._results["bbox"] = res
+            return
+
+        self._results["bbox"] = {}
+        for (split, classes, names), coco_eval in zip(splits, coco_evals):
+            res_ = self._derive_coco_results(coco_eval, "bbox", class_names=names)
+            res = {}
+            for metric in res_.keys():
+                if len(metric) <= 4:
+                    if split == "all":
+                        res[metric] = res_[metric]
+                    elif split == "base":
+                        res["b"+metric] = res_[metric]
+                    elif split == "novel":
+                        res["n"+metric] = res_[metric]
+            self._results["bbox"].update(res)
+
+        # add "AP" if not already in
+        if "AP" not in self._results["bbox"]:
+            if "nAP" in self._results["bbox"]:
+                self._results["bbox"]["AP"] = self._results["bbox"]["nAP"]
+            else:
+                self._results["bbox"]["AP"] = self._results["bbox"]["bAP"]
+
+    def _to_coco_array(self, image_ids, detections):
+        """
+        Pack the detections of `image_ids` into a :func:`results_to_coco_array` array,
+        with dataset category ids.
+        """
+        classes = detections.classes.numpy()
+
+        # unmap the category ids for COCO
+        if hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
+            id_map = self._metadata.thing_dataset_id_to_contiguous_id
+            reverse_id_mapping = np.full(max(id_map.values()) + 1, -1, dtype=np.int64)
+            for k, v in id_map.items():
+                reverse_id_mapping[v] = k
+            known = (classes >= 0) & (classes < len(reverse_id_mapping))
+            category_ids = np.full(len(classes), -1, dtype=np.int64)
+            category_ids[known] = reverse_id_mapping[classes[known]]
+            unknown = np.unique(classes[category_ids < 0])
+            if len(unknown):
+                # Mark with an invalid category to let COCOAPI ignore them
+                self._logger.warning(
+                    f"Unknown category_id {unknown.tolist()} in predictions; skipping these items.")
+        else:
+            category_ids = classes
+
+        return results_to_coco_array(
+            np.repeat(np.asarray(image_ids), detections.num_detections),
+            detections.boxes.numpy(),
+            detections.scores.numpy(),
+            category_ids,
+        )
 
     def _derive_coco_results(self, coco_eval, iou_type, class_names=None):
         """
@@ -281,7 +389,110 @@ def instances_to_coco_json(instances, img_id):
     return results
 
 
-def _evaluate_predictions_on_coco(coco_gt, coco_results, iou_type, catIds=None):
+def results_to_coco_array(image_ids, boxes, scores, category_ids):
+    """
+    Pack detections into the (D, 7) array of
+    [image_id, x, y, w, h, score, category_id] rows that `COCO.loadRes` accepts,
+    with the same values as the dicts of :func:`instances_to_coco_json`.
+
+    Args:
+        image_ids (ndarray): (D,) image id of every detection.
+        boxes (ndarray): (D, 4) float32 boxes in XYXY_ABS format.
+        scores (ndarray): (D,) scores.
+        category_ids (ndarray): (D,) dataset category ids.
+    """
+    boxes = BoxMode.convert(boxes, BoxMode.XYXY_ABS, BoxMode.XYWH_ABS)
+    return np.column_stack(
+        [image_ids, boxes, scores, category_ids]
+    ).astype(np.float64).reshape(-1, 7)
+
+
+def coco_array_to_json(coco_results):
+    """
+    Convert the rows of :func:`results_to_coco_array` to COCO-format json dicts.
+    """
+    return [
+        {
+            "image_id": int(row[0]),
+            "category_id": int(row[6]),
+            "bbox": row[1:5].tolist(),
+            "score": float(row[5]),
+        }
+        for row in coco_results
+    ]
+
+
+_PARALLEL_COCO_EVAL = None  # COCOeval shared with the forked workers of _evaluate_coco
+
+
+def _evaluate_categories(catIds):
+    coco_eval = copy.copy(_PARALLEL_COCO_EVAL)
+    coco_eval.params = copy.deepcopy(coco_eval.params)
+    coco_eval.params.catIds = catIds
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+    return {k: coco_eval.eval[k] for k in ("precision", "recall", "scores")}
+
+
+def _evaluate_coco(coco_eval, num_workers=0):
+    """
+    Run `coco_eval.evaluate()` and `coco_eval.accumulate()`.
+
+    With `num_workers` > 1 the categories are split across a pool of forked processes,
+    which share the ground truth and detections of the parent. Matching and
+    accumulation are independent per category, so each worker runs both for its
+    categories and only returns its slice of the accumulated arrays; `coco_eval.eval`
+    is then the same as in a single process, but `coco_eval.evalImgs` stays empty.
+    """
+    p = coco_eval.params
+    if num_workers <= 1 or not p.useCats or len(set(p.catIds)) < 2:
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        return
+
+    # the normalization of COCOeval.evaluate()
+    p.imgIds = list(np.unique(p.imgIds))
+    p.catIds = list(np.unique(p.catIds))
+    p.maxDets = sorted(p.maxDets)
+    num_workers = min(num_workers, len(p.catIds))
+    logger.info("Evaluating and accumulating {} categories in {} processes...".format(
+        len(p.catIds), num_workers))
+
+    global _PARALLEL_COCO_EVAL
+    _PARALLEL_COCO_EVAL = coco_eval
+    try:
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(num_workers) as pool:
+            # interleaved, so that the few very frequent categories are spread out
+            chunks = [p.catIds[i::num_workers] for i in range(num_workers)]
+            results = pool.map(_evaluate_categories, chunks)
+    finally:
+        _PARALLEL_COCO_EVAL = None
+
+    T, R, K, A, M = len(p.iouThrs), len(p.recThrs), len(p.catIds), len(p.areaRng), len(p.maxDets)
+    precision = -np.ones((T, R, K, A, M))
+    recall = -np.ones((T, K, A, M))
+    scores = -np.ones((T, R, K, A, M))
+    for catIds, result in zip(chunks, results):
+        k = [p.catIds.index(c) for c in catIds]
+        precision[:, :, k] = result["precision"]
+        recall[:, k] = result["recall"]
+        scores[:, :, k] = result["scores"]
+
+    coco_eval.evalImgs = []
+    coco_eval._paramsEval = copy.deepcopy(p)
+    coco_eval.eval = {
+        "params": p,
+        "counts": [T, R, K, A, M],
+        "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "precision": precision,
+        "recall": recall,
+        "scores": scores,
+    }
+
+
+def _evaluate_predictions_on_coco(coco_gt, coco_results, iou_type, catIds=None, num_workers=0):
     """
     Evaluate the coco results using COCOEval API.
     """
@@ -291,8 +502,184 @@ def _evaluate_predictions_on_coco(coco_gt, coco_results, iou_type, catIds=None):
     coco_eval = COCOeval(coco_gt, coco_dt, iou_type)
     if catIds is not None:
         coco_eval.params.catIds = catIds
-    coco_eval.evaluate()
-    coco_eval.accumulate()
+    _evaluate_coco(coco_eval, num_workers)
     coco_eval.summarize()
 
     return coco_eval
+
+
+def _normalize_split_catIds(coco_gt, split_catIds):
+    """
+    Replace None by all the categories of `coco_gt` and sort the ids of each split.
+    """
+    gt_catIds = sorted(coco_gt.getCatIds())
+    return [gt_catIds if catIds is None else sorted(set(catIds)) for catIds in split_catIds]
+
+
+def _evaluate_splits_on_coco(coco_gt, coco_results, iou_type, split_catIds, num_workers=0):
+    """
+    Evaluate the coco results on several category subsets with a single
+    COCOeval.evaluate() and accumulate().
+
+    Per image and category matching does not depend on the other categories, and
+    neither do the accumulated precision and recall of a category, so each split
+    slices its categories out of one evaluation. The stats are the same as those of
+    :func:`_evaluate_predictions_on_coco` with `catIds` set to the split.
+
+    Args:
+        split_catIds (list[list[int] or None]): category ids of each split, None for
+            all the categories of `coco_gt`.
+        num_workers (int): see :func:`_evaluate_coco`.
+
+    Returns:
+        list[COCOeval]: a summarized COCOeval per split.
+    """
+    assert len(coco_results) > 0
+
+    coco_dt = coco_gt.loadRes(coco_results)
+    coco_eval = COCOeval(coco_gt, coco_dt, iou_type)
+    split_catIds = _normalize_split_catIds(coco_gt, split_catIds)
+    coco_eval.params.catIds = sorted(set(itertools.chain(*split_catIds)))
+    _evaluate_coco(coco_eval, num_workers)
+    return _summarize_splits(coco_eval, split_catIds)
+
+
+def _summarize_splits(coco_eval, split_catIds):
+    """
+    Summarize each split of an accumulated `coco_eval` on its slice of the categories.
+    """
+    # accumulate(p) cannot be used for a subset: it indexes evalImgs by the position
+    # of a category in p.catIds instead of in the evaluated categories
+    split_evals = []
+    for catIds in split_catIds:
+        k = [coco_eval.params.catIds.index(c) for c in catIds]
+        split_eval = copy.copy(coco_eval)
+        split_eval.params = copy.copy(coco_eval.params)
+        split_eval.params.catIds = catIds
+        split_eval.eval = dict(
+            coco_eval.eval,
+            counts=[len(catIds) if i == 2 else n for i, n in enumerate(coco_eval.eval["counts"])],
+            precision=coco_eval.eval["precision"][:, :, k],
+            recall=coco_eval.eval["recall"][:, k],
+            scores=coco_eval.eval["scores"][:, :, k],
+        )
+        split_eval.summarize()
+        split_evals.append(split_eval)
+
+    return split_evals
+
+
+def _load_coco_results(coco_gt, coco_results):
+    """
+    `coco_gt.loadRes(coco_results)`, which also accepts no results.
+    """
+    if len(coco_results) > 0:
+        return coco_gt.loadRes(coco_results)
+    coco_dt = COCO()
+    coco_dt.dataset = {
+        "images": coco_gt.dataset["images"],
+        "categories": copy.deepcopy(coco_gt.dataset["categories"]),
+        "annotations": [],
+    }
+    coco_dt.createIndex()
+    return coco_dt
+
+
+def _evaluate_coco_shard(coco_gt, coco_results, iou_type, imgIds, catIds):
+    """
+    Run COCOeval.evaluate() on the images `imgIds` only, and pack what accumulate()
+    reads of its evalImgs into flat arrays.
+
+    An (image, category) pair has an evalImg for every area range or for none, and
+    its detection scores are the same for every area range, so they are kept once;
+    the matched / ignored flags of the detections are bit packed, and the ignore
+    flags of the ground truth are reduced to the number of non-ignored boxes.
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval = COCOeval(coco_gt, _load_coco_results(coco_gt, coco_results), iou_type)
+        p = coco_eval.params
+        p.imgIds = sorted(set(imgIds))
+        p.catIds = list(catIds)
+        if p.imgIds:
+            coco_eval.evaluate()
+        else:
+            coco_eval.evalImgs = []
+
+    K, A, I, T = len(p.catIds), len(p.areaRng), len(p.imgIds), len(p.iouThrs)
+    # evalImgs are laid out as [category][area range][image]
+    entries = [
+        (p.catIds[k], p.imgIds[i], [coco_eval.evalImgs[(k * A + a) * I + i] for a in range(A)])
+        for k in range(K) for i in range(I)
+        if coco_eval.evalImgs[k * A * I + i] is not None
+    ]
+    empty = np.zeros((A * T, 0), dtype=bool)
+    return {
+        "numResults": len(coco_results),
+        "imgIds": np.asarray(p.imgIds, dtype=np.int64),
+        "entryCatIds": np.asarray([x[0] for x in entries], dtype=np.int64),
+        "entryImgIds": np.asarray([x[1] for x in entries], dtype=np.int64),
+        "numDt": np.asarray([len(x[2][0]["dtScores"]) for x in entries], dtype=np.int32),
+        "numGt": np.asarray(
+            [[np.count_nonzero(e["gtIgnore"] == 0) for e in x[2]] for x in entries],
+            dtype=np.int32,
+        ).reshape(-1, A),
+        "dtScores": np.concatenate(
+            [np.zeros(0)] + [np.asarray(x[2][0]["dtScores"], dtype=np.float64) for x in entries]
+        ),
+        "dtMatches": np.packbits(np.concatenate(
+            [empty] + [np.concatenate([e["dtMatches"] != 0 for e in x[2]]) for x in entries],
+            axis=1,
+        ), axis=0),
+        "dtIgnore": np.packbits(np.concatenate(
+            [empty] + [np.concatenate([e["dtIgnore"] for e in x[2]]) for x in entries],
+            axis=1,
+        ), axis=0),
+    }
+
+
+def _accumulate_coco_shards(coco_gt, shards, iou_type, split_catIds):
+    """
+    Rebuild the evalImgs of all images from the :func:`_evaluate_coco_shard` of every
+    rank, then accumulate and summarize each split as :func:`_evaluate_splits_on_coco`
+    does. Images of `coco_gt` that no rank evaluated are evaluated here without
+    detections, as they are in a single process.
+
+    Returns:
+        list[COCOeval]: a summarized COCOeval per split.
+    """
+    coco_eval = COCOeval(coco_gt, iouType=iou_type)
+    p = coco_eval.params
+    # the normalization of COCOeval.evaluate()
+    p.imgIds = list(np.unique(p.imgIds))
+    p.catIds = sorted(set(itertools.chain(*split_catIds)))
+    p.maxDets = sorted(p.maxDets)
+
+    evaluated = set(itertools.chain(*[x["imgIds"].tolist() for x in shards]))
+    missing = [i for i in p.imgIds if i not in evaluated]
+    if missing:
+        shards = shards + [
+            _evaluate_coco_shard(coco_gt, np.zeros((0, 7)), iou_type, missing, p.catIds)
+        ]
+
+    K, A, I, T = len(p.catIds), len(p.areaRng), len(p.imgIds), len(p.iouThrs)
+    k_index = {catId: k for k, catId in enumerate(p.catIds)}
+    i_index = {imgId: i for i, imgId in enumerate(p.imgIds)}
+    coco_eval.evalImgs = [None] * (K * A * I)
+    for shard in shards:
+        offsets = np.concatenate([[0], np.cumsum(shard["numDt"])])
+        dtMatches = np.unpackbits(shard["dtMatches"], axis=0, count=A * T).astype(bool)
+        dtIgnore = np.unpackbits(shard["dtIgnore"], axis=0, count=A * T).astype(bool)
+        for j, (catId, imgId) in enumerate(zip(shard["entryCatIds"], shard["entryImgIds"])):
+            k, i = k_index[catId], i_index[imgId]
+            d = slice(offsets[j], offsets[j + 1])
+            for a in range(A):
+                t = slice(a * T, (a + 1) * T)
+                coco_eval.evalImgs[(k * A + a) * I + i] = {
+                    "dtScores": shard["dtScores"][d],
+                    "dtMatches": dtMatches[t, d],
+                    "dtIgnore": dtIgnore[t, d],
+                    "gtIgnore": np.zeros(shard["numGt"][j, a], dtype=np.int64),
+                }
+    coco_eval._paramsEval = copy.deepcopy(p)
+    coco_eval.accumulate()
+    return _summarize_splits(coco_eval, split_catIds)
@@ -1,3 +1,4 @@
+import os
 import time
 import torch
 import logging
@@ -5,7 +6,9 @@ import datetime
 from collections import OrderedDict
 from contextlib import contextmanager
 from detectron2.utils.comm import is_main_process
-from .calibration_layer import PrototypicalCalibrationBlock
+from defrcn.structures import DetectionBatch
+from .calibration_layer import get_calibration_block
+from .pcb_sweep import PCBScoreRecorder
 
 
 class DatasetEvaluator:
@@ -36,6 +39,16 @@ class DatasetEvaluator:
         """
         pass
 
+    def process_detections(self, inputs, detections):
+        """
+        Process the detections of a batch of inputs given as columns.
+
+        Args:
+            inputs: the inputs that are used to call the model.
+            detections (DetectionBatch): the detections of `inputs`, in order.
+        """
+        self.process(inputs, [{"instances": x} for x in detections.to_instances()])
+
     def evaluate(self):
         """
         Evaluate/summarize the performance, after processing all input/output pairs.
@@ -66,6 +79,10 @@ class DatasetEvaluators(DatasetEvaluator):
         for evaluator in self._evaluators:
             evaluator.process(input, output)
 
+    def process_detections(self, inputs, detections):
+        for evaluator in self._evaluators:
+            evaluator.process_detections(inputs, detections)
+
     def evaluate(self):
         results = OrderedDict()
         for evaluator in self._evaluators:
@@ -79,46 +96,62 @@ class DatasetEvaluators(DatasetEvaluator):
         return results
 
 
-def inference_on_dataset(model, data_loader, evaluator, cfg=None):
+def inference_on_dataset(model, data_loader, evaluator, cfg=None, dataset_name=""):
 
     num_devices = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
     logger = logging.getLogger(__name__)
 
-    pcb = None
+    pcb, pcb_recorder = None, None
     if cfg.TEST.PCB_ENABLE:
         logger.info("Start initializing PCB module, please wait a seconds...")
-        pcb = PrototypicalCalibrationBlock(cfg)
-
-    logger.info("Start inference on {} images".format(len(data_loader)))
-    total = len(data_loader)  # inference data loader must have a fixed length
+        pcb = get_calibration_block(cfg)
+        if cfg.TEST.PCB_DUMP_DIR:
+            pcb_recorder = PCBScoreRecorder(dataset_name)
+
+    total = len(data_loader)  # inference data loader must have a fixed length, in batches
+    batch_sampler = getattr(data_loader, "batch_sampler", None)
+    num_images = len(batch_sampler.sampler) if batch_sampler is not None else total
+    logger.info("Start inference on {} images".format(num_images))
     evaluator.reset()
 
     logging_interval = 50
     num_warmup = min(5, logging_interval - 1, total - 1)
     start_time = time.time()
     total_compute_time = 0
+    timed_images = 0  # images seen after the warmup batches
     with inference_context(model), torch.no_grad():
         for idx, inputs in enumerate(data_loader):
             if idx == num_warmup:
                 start_time = time.time()
                 total_compute_time = 0
+                timed_images = 0
+            timed_images += len(inputs)
 
             start_compute_time = time.time()
             outputs = model(inputs)
             if cfg.TEST.PCB_ENABLE:
-                outputs = pcb.execute_calibration(inputs, outputs)
-            torch.cuda.synchronize()
+                if pcb_recorder is not None:
+                    raw_scores = [x["instances"].scores.clone() for x in outputs]
+                    similarities = []
+                    outputs = pcb.execute_calibration(inputs, outputs, similarities)
+                    pcb_recorder.process(inputs, outputs, raw_scores, similarities)
+                else:
+                    outputs = pcb.execute_calibration(inputs, outputs)
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
             total_compute_time += time.time() - start_compute_time
-            evaluator.process(inputs, outputs)
+            if isinstance(outputs, DetectionBatch):
+                evaluator.process_detections(inputs, outputs)
+            else:
+                evaluator.process(inputs, outputs)
 
             if (idx + 1) % logging_interval == 0:
                 duration = time.time() - start_time
-                seconds_per_img = duration / (idx + 1 - num_warmup)
-                eta = datetime.timedelta(
-                    seconds=int(seconds_per_img * (total - num_warmup) - duration)
-                )
+                seconds_per_img = duration / timed_images
+                seconds_per_batch = duration / (idx + 1 - num_warmup)
+                eta = datetime.timedelta(seconds=int(seconds_per_batch * (total - idx - 1)))
                 logger.info(
-                    "Inference done {}/{}. {:.4f} s / img. ETA={}".format(
+                    "Inference done {}/{} batches. {:.4f} s / img. ETA={}".format(
                         idx + 1, total, seconds_per_img, str(eta)
                     )
                 )
@@ -129,16 +162,21 @@ def inference_on_dataset(model, data_loader, evaluator, cfg=None):
     # NOTE this format is parsed by grep
     logger.info(
         "Total inference time: {} ({:.6f} s / img per device, on {} devices)".format(
-            total_time_str, total_time / (total - num_warmup), num_devices
+            total_time_str, total_time / max(timed_images, 1), num_devices
         )
     )
     total_compute_time_str = str(datetime.timedelta(seconds=int(total_compute_time)))
     logger.info(
         "Total inference pure compute time: {} ({:.6f} s / img per device, on {} devices)".format(
-            total_compute_time_str, total_compute_time / (total - num_warmup), num_devices
+            total_compute_time_str, total_compute_time / max(timed_images, 1), num_devices
         )
     )
 
+    if pcb_recorder is not None:
+        pcb_recorder.save(
+            os.path.join(cfg.TEST.PCB_DUMP_DIR, "pcb_scores_{}.npz".format(dataset_name or "test"))
+        )
+
     results = evaluator.evaluate()
     # An evaluator may return None when not in main process.
     # Replace it by an empty dict instead to make it easier for downstream code to handle
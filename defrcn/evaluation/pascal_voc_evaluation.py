@@ -2,7 +2,7 @@
 import os
 import torch
 import logging
-import tempfile
+import itertools
 import numpy as np
 from functools import lru_cache
 from xml.etree import ElementTree as ET
@@ -10,6 +10,7 @@ from collections import OrderedDict, defaultdict
 from detectron2.utils import comm
 from detectron2.data import MetadataCatalog
 from detectron2.utils.logger import create_small_table
+from defrcn.structures import DetectionBatch
 from defrcn.evaluation.evaluator import DatasetEvaluator
 
 
@@ -23,12 +24,20 @@ class PascalVOCDetectionEvaluator(DatasetEvaluator):
     the official API.
     """
 
-    def __init__(self, dataset_name):
+    def __init__(self, dataset_name, output_dir=None, dist_eval="gather"):
         """
         Args:
             dataset_name (str): name of the dataset, e.g., "voc_2007_test"
+            output_dir (str): if given, the predictions are also written there as the
+                per-class text files of the VOC devkit. Only in "gather" mode.
+            dist_eval (str): "gather" to match all predictions on the main process, or
+                "reduce" to match those of each rank on the rank and only gather the
+                per-class TP / FP flags and scores.
         """
+        assert dist_eval in ["gather", "reduce"], dist_eval
         self._dataset_name = dataset_name
+        self._output_dir = output_dir
+        self._dist_eval = dist_eval
         meta = MetadataCatalog.get(dataset_name)
         self._anno_file_template = os.path.join(meta.dirname, "Annotations", "{}.xml")
         self._image_set_path = os.path.join(meta.dirname, "ImageSets", "Main", meta.split + ".txt")
@@ -38,41 +47,71 @@ class PascalVOCDetectionEvaluator(DatasetEvaluator):
         self._novel_classes = meta.novel_classes
         assert meta.year in [2007, 2012], meta.year
         self._is_2007 = meta.year == 2007
+        self._gt = None  # (image names, per-class gt arrays), loaded on the first evaluate
         self._cpu_device = torch.device("cpu")
         self._logger = logging.getLogger(__name__)
 
     def reset(self):
-        self._predictions = defaultdict(list)  # class name -> list of prediction strings
+        self._image_ids = []
+        self._detections = []  # DetectionBatch of every processed batch, on cpu
 
     def process(self, inputs, outputs):
-        for input, output in zip(inputs, outputs):
-            image_id = input["image_id"]
-            instances = output["instances"].to(self._cpu_device)
-            boxes = instances.pred_boxes.tensor.numpy()
-            scores = instances.scores.tolist()
-            classes = instances.pred_classes.tolist()
-            for box, score, cls in zip(boxes, scores, classes):
-                xmin, ymin, xmax, ymax = box
-                # The inverse of data loading logic in `datasets/pascal_voc.py`
-                xmin += 1
-                ymin += 1
-                self._predictions[cls].append(
-                    f"{image_id} {score:.3f} {xmin:.1f} {ymin:.1f} {xmax:.1f} {ymax:.1f}"
-                )
+        self.process_detections(inputs, DetectionBatch.from_outputs(outputs))
+
+    def process_detections(self, inputs, detections):
+        self._image_ids.extend(x["image_id"] for x in inputs)
+        self._detections.append(detections.to(self._cpu_device))
 
     def evaluate(self):
         """
         Returns:
             dict: has a key "segm", whose value is a dict of "AP", "AP50", and "AP75".
         """
-        all_predictions = comm.gather(self._predictions, dst=0)
-        if not comm.is_main_process():
-            return
-        predictions = defaultdict(list)
-        for predictions_per_rank in all_predictions:
-            for clsid, lines in predictions_per_rank.items():
-                predictions[clsid].extend(lines)
-        del all_predictions
+        thresholds = list(range(50, 100, 5))
+        # the shards of "reduce" are only ranked like the whole set with a stable sort
+        kind = "mergesort" if self._dist_eval == "reduce" else "quicksort"
+        ovthreshs = [thresh / 100.0 for thresh in thresholds]
+        detections = [DetectionBatch.cat(self._detections)] if self._detections else []
+        if self._dist_eval == "reduce":
+            # every rank matches its own images and only the matches are gathered
+            _, matches = self._match_predictions(
+                self._image_ids, detections, ovthreshs, kind="mergesort"
+            )
+            all_matches = comm.gather(
+                {
+                    cls_id: (confidence, np.packbits(tp, axis=0), np.packbits(fp, axis=0))
+                    for cls_id, (confidence, tp, fp) in matches.items()
+                },
+                dst=0,
+            )
+            if not comm.is_main_process():
+                return
+            matches = {}
+            for cls_id in range(len(self._class_names)):
+                shards = [x[cls_id] for x in all_matches if cls_id in x]
+                if shards:
+                    matches[cls_id] = (
+                        np.concatenate([x[0] for x in shards]),
+                        np.concatenate([
+                            np.unpackbits(x[1], axis=0, count=len(ovthreshs)).astype(bool)
+                            for x in shards], axis=1),
+                        np.concatenate([
+                            np.unpackbits(x[2], axis=0, count=len(ovthreshs)).astype(bool)
+                            for x in shards], axis=1),
+                    )
+            del all_matches
+        else:
+            all_predictions = comm.gather((self._image_ids, detections), dst=0)
+            if not comm.is_main_process():
+                return
+            predictions, matches = self._match_predictions(
+                list(itertools.chain(*[x[0] for x in all_predictions])),
+                list(itertools.chain(*[x[1] for x in all_predictions])),
+                ovthreshs,
+            )
+            del all_predictions
+            if self._output_dir:
+                self._export_predictions(self._load_gt()[0], predictions)
 
         self._logger.info(
             "Evaluating {} using {} metric. "
@@ -81,37 +120,30 @@ class PascalVOCDetectionEvaluator(DatasetEvaluator):
             )
         )
 
-        with tempfile.TemporaryDirectory(prefix="pascal_voc_eval_") as dirname:
-            res_file_template = os.path.join(dirname, "{}.txt")
-
-            aps = defaultdict(list)  # iou -> ap per class
-            aps_base = defaultdict(list)
-            aps_novel = defaultdict(list)
-            exist_base, exist_novel = False, False
-            for cls_id, cls_name in enumerate(self._class_names):
-                lines = predictions.get(cls_id, [""])
-
-                with open(res_file_template.format(cls_name), "w") as f:
-                    f.write("\n".join(lines))
-
-                for thresh in range(50, 100, 5):
-                    rec, prec, ap = voc_eval(
-                        res_file_template,
-                        self._anno_file_template,
-                        self._image_set_path,
-                        cls_name,
-                        ovthresh=thresh / 100.0,
-                        use_07_metric=self._is_2007,
-                    )
-                    aps[thresh].append(ap * 100)
+        _, gt = self._load_gt()
+        aps = defaultdict(list)  # iou -> ap per class
+        aps_base = defaultdict(list)
+        aps_novel = defaultdict(list)
+        exist_base, exist_novel = False, False
+        for cls_id, cls_name in enumerate(self._class_names):
+            confidence, tp, fp = matches.get(
+                cls_id,
+                (np.zeros(0), np.zeros((len(ovthreshs), 0), dtype=bool),
+                 np.zeros((len(ovthreshs), 0), dtype=bool)),
+            )
+            results = voc_ap_from_matches(
+                confidence, tp, fp, gt[cls_name]["npos"], use_07_metric=self._is_2007, kind=kind
+            )
+            for thresh, (rec, prec, ap) in zip(thresholds, results):
+                aps[thresh].append(ap * 100)
 
-                    if self._base_classes is not None and cls_name in self._base_classes:
-                        aps_base[thresh].append(ap * 100)
-                        exist_base = True
+                if self._base_classes is not None and cls_name in self._base_classes:
+                    aps_base[thresh].append(ap * 100)
+                    exist_base = True
 
-                    if self._novel_classes is not None and cls_name in self._novel_classes:
-                        aps_novel[thresh].append(ap * 100)
-                        exist_novel = True
+                if self._novel_classes is not None and cls_name in self._novel_classes:
+                    aps_novel[thresh].append(ap * 100)
+                    exist_novel = True
 
         ret = OrderedDict()
         mAP = {iou: np.mean(x) for iou, x in aps.items()}
@@ -139,6 +171,86 @@ class PascalVOCDetectionEvaluator(DatasetEvaluator):
         self._logger.info("Evaluate overall bbox:\n"+create_small_table(ret["bbox"]))
         return ret
 
+    def _load_gt(self):
+        """
+        Return the image names and per-class ground truth of :func:`load_voc_gt`,
+        loaded on the first call.
+        """
+        if self._gt is None:
+            self._gt = load_voc_gt(
+                self._anno_file_template, self._image_set_path, self._class_names
+            )
+        return self._gt
+
+    def _match_predictions(self, image_ids, detections, ovthreshs, kind="quicksort"):
+        """
+        Args:
+            kind (str): the sorting algorithm of :func:`voc_match`.
+
+        Returns:
+            the per-class arrays of :func:`predictions_to_voc_arrays`, and for each
+            class id the (confidence, tp, fp) of its detections, see :func:`voc_match`.
+        """
+        imagenames, gt = self._load_gt()
+        image_index = {imagename: i for i, imagename in enumerate(imagenames)}
+        predictions = predictions_to_voc_arrays(
+            [image_index[image_id] for image_id in image_ids], detections
+        )
+        matches = {}
+        for cls_id, (image_inds, confidence, BB) in predictions.items():
+            tp, fp = voc_match(
+                image_inds, confidence, BB, gt[self._class_names[cls_id]], ovthreshs, kind
+            )
+            matches[cls_id] = (confidence, tp, fp)
+        return predictions, matches
+
+    def _export_predictions(self, imagenames, predictions):
+        """
+        Write the predictions of each class to `{output_dir}/{dataset}_results/{class}.txt`
+        in the text format of the VOC devkit, for debugging.
+        """
+        dirname = os.path.join(self._output_dir, "{}_results".format(self._dataset_name))
+        os.makedirs(dirname, exist_ok=True)
+        for cls_id, cls_name in enumerate(self._class_names):
+            lines = []
+            if cls_id in predictions:
+                image_inds, scores, boxes = predictions[cls_id]
+                lines = [
+                    f"{imagenames[i]} {score:.3f} {xmin:.1f} {ymin:.1f} {xmax:.1f} {ymax:.1f}"
+                    for i, score, (xmin, ymin, xmax, ymax) in zip(image_inds, scores, boxes)
+                ]
+            with open(os.path.join(dirname, cls_name + ".txt"), "w") as f:
+                f.write("\n".join(lines))
+        self._logger.info("Saved VOC predictions to {}".format(dirname))
+
+
+def predictions_to_voc_arrays(image_inds, detections):
+    """
+    Split detections by class into the arrays that :func:`voc_eval_thresholds` reads.
+
+    Args:
+        image_inds (list[int]): the index in the image set of every image of `detections`.
+        detections (list[DetectionBatch]): detections on cpu.
+
+    Returns:
+        dict[int, tuple]: class id -> (image index (D,), score (D,), box (D x 4)),
+            with float64 scores and boxes in the 1-based VOC pixel coordinates.
+    """
+    predictions = {}
+    if not detections:
+        return predictions
+    detections = DetectionBatch.cat(detections)
+    image_inds = np.repeat(np.asarray(image_inds, dtype=np.int64), detections.num_detections)
+    boxes = detections.boxes.numpy().astype(np.float64)
+    # The inverse of data loading logic in `datasets/pascal_voc.py`
+    boxes[:, :2] += 1
+    scores = detections.scores.numpy().astype(np.float64)
+    classes = detections.classes.numpy()
+    for cls in np.unique(classes):
+        inds = np.nonzero(classes == cls)[0]
+        predictions[int(cls)] = (image_inds[inds], scores[inds], boxes[inds])
+    return predictions
+
 
 ##############################################################################
 #
@@ -208,6 +320,188 @@ def voc_ap(rec, prec, use_07_metric=False):
     return ap
 
 
+def load_voc_gt(annopath, imagesetfile, classnames):
+    """
+    Index the ground truth of an image set once for all classes.
+
+    annopath: annopath.format(imagename) should be the xml annotations file.
+    imagesetfile: Text file containing the list of images, one image per line.
+    classnames: Category names to index.
+
+    Returns the image names of `imagesetfile` and, for each class name, a dict of
+    "bbox" (I x G x 4 float64, zero padded), "difficult" and "valid" (I x G bool) and
+    "npos", the number of non-difficult boxes. I is the number of images and G the
+    largest number of boxes of the class in one image.
+    """
+    # read list of images
+    with open(imagesetfile, "r") as f:
+        lines = f.readlines()
+    imagenames = [x.strip() for x in lines]
+
+    # load annots
+    recs = [parse_rec(annopath.format(imagename)) for imagename in imagenames]
+
+    # extract gt objects of each class
+    gt = {}
+    for classname in classnames:
+        class_objs = [[obj for obj in rec if obj["name"] == classname] for rec in recs]
+        width = max([len(R) for R in class_objs] + [1])
+        bbox = np.zeros((len(imagenames), width, 4))
+        difficult = np.zeros((len(imagenames), width), dtype=bool)
+        valid = np.zeros((len(imagenames), width), dtype=bool)
+        for i, R in enumerate(class_objs):
+            if R:
+                bbox[i, :len(R)] = [x["bbox"] for x in R]
+                difficult[i, :len(R)] = [x["difficult"] for x in R]
+                valid[i, :len(R)] = True
+        gt[classname] = {
+            "bbox": bbox,
+            "difficult": difficult,
+            "valid": valid,
+            "npos": int((valid & ~difficult).sum()),
+        }
+    return imagenames, gt
+
+
+def read_voc_detections(detfile):
+    """
+    Read a detection results file of :func:`voc_eval`.
+
+    Returns the image id (list[str]), confidence (D,) and box (D x 4) of every line.
+    """
+    with open(detfile, "r") as f:
+        lines = f.readlines()
+
+    splitlines = [x.strip().split(" ") for x in lines]
+    image_ids = [x[0] for x in splitlines]
+    confidence = np.array([float(x[1]) for x in splitlines])
+    BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 4)
+    return image_ids, confidence, BB
+
+
+def _max_overlaps(BB, image_inds, class_gt, chunk_size=1 << 22):
+    """
+    Largest overlap of every detection with the ground truth of its image, and the
+    index of that ground truth box (-inf and 0 when the image has none).
+    Detections are processed in chunks of about `chunk_size` (detection, gt) pairs.
+    """
+    nd = len(BB)
+    ovmax = np.full(nd, -np.inf)
+    jmax = np.zeros(nd, dtype=np.int64)
+    step = max(chunk_size // class_gt["bbox"].shape[1], 1)
+    for start in range(0, nd, step):
+        inds = image_inds[start:start + step]
+        bb = BB[start:start + step, None, :]
+        BBGT = class_gt["bbox"][inds]
+
+        # intersection
+        ixmin = np.maximum(BBGT[..., 0], bb[..., 0])
+        iymin = np.maximum(BBGT[..., 1], bb[..., 1])
+        ixmax = np.minimum(BBGT[..., 2], bb[..., 2])
+        iymax = np.minimum(BBGT[..., 3], bb[..., 3])
+        iw = np.maximum(ixmax - ixmin + 1.0, 0.0)
+        ih = np.maximum(iymax - iymin + 1.0, 0.0)
+        inters = iw * ih
+
+        # union
+        uni = (
+            (bb[..., 2] - bb[..., 0] + 1.0) * (bb[..., 3] - bb[..., 1] + 1.0)
+            + (BBGT[..., 2] - BBGT[..., 0] + 1.0) * (BBGT[..., 3] - BBGT[..., 1] + 1.0)
+            - inters
+        )
+
+        overlaps = inters / uni
+        overlaps[~class_gt["valid"][inds]] = -np.inf
+        ovmax[start:start + step] = overlaps.max(axis=1)
+        jmax[start:start + step] = overlaps.argmax(axis=1)
+    return ovmax, jmax
+
+
+def voc_match(image_inds, confidence, BB, class_gt, ovthreshs, kind="quicksort"):
+    """
+    Mark the detections of one class as TP or FP at several overlap thresholds.
+
+    image_inds: Index in the image set of the image of each detection of the class.
+    confidence, BB: Score and box of each detection.
+    class_gt: One class of :func:`load_voc_gt`.
+    ovthreshs: Overlap thresholds.
+    kind: Sorting algorithm of np.argsort. The default ranks tied scores like
+        :func:`voc_eval`. Use "mergesort" when the images are matched in shards, so
+        that each shard ranks its ties like the whole set.
+
+    Returns tp and fp, T x D bool arrays in the order of the input detections. A
+    detection is neither when it matches a difficult ground truth. Detections only
+    compete with those of their own image, so the images can be matched in shards.
+    """
+    # sort by confidence
+    sorted_ind = np.argsort(-confidence, kind=kind)
+    BB = BB[sorted_ind, :]
+    image_inds = np.asarray(image_inds, dtype=np.int64)[sorted_ind]
+
+    # the best gt of a detection does not depend on the threshold, only whether
+    # it is close enough and whether a higher scored detection took it first
+    nd = len(image_inds)
+    ovmax, jmax = _max_overlaps(BB, image_inds, class_gt)
+    gt_ids = image_inds * class_gt["bbox"].shape[1] + jmax
+    difficult = class_gt["difficult"][image_inds, jmax]
+
+    tp = np.zeros((len(ovthreshs), nd), dtype=bool)
+    fp = np.zeros((len(ovthreshs), nd), dtype=bool)
+    for t, ovthresh in enumerate(ovthreshs):
+        above = ovmax > ovthresh
+        matched = np.nonzero(above & ~difficult)[0]
+        # the first detection of each gt is a TP, the following ones are FPs
+        _, first = np.unique(gt_ids[matched], return_index=True)
+        tp_sorted = np.zeros(nd, dtype=bool)
+        tp_sorted[matched[first]] = True
+        fp_sorted = ~above
+        fp_sorted[matched] = ~tp_sorted[matched]
+        tp[t, sorted_ind] = tp_sorted
+        fp[t, sorted_ind] = fp_sorted
+    return tp, fp
+
+
+def voc_ap_from_matches(confidence, tp, fp, npos, use_07_metric=False, kind="quicksort"):
+    """
+    Compute rec, prec and ap of one class at each threshold of :func:`voc_match`.
+
+    confidence: Score of each detection.
+    tp, fp: T x D outputs of :func:`voc_match`, possibly concatenated over shards.
+    npos: Number of non-difficult ground truth boxes of the class.
+    kind: Sorting algorithm, the same as given to :func:`voc_match`.
+
+    Returns a (rec, prec, ap) tuple per threshold.
+    """
+    sorted_ind = np.argsort(-confidence, kind=kind)
+    results = []
+    for tp_t, fp_t in zip(tp, fp):
+        # compute precision recall
+        fp_t = np.cumsum(fp_t[sorted_ind].astype(np.float64))
+        tp_t = np.cumsum(tp_t[sorted_ind].astype(np.float64))
+        rec = tp_t / float(npos)
+        # avoid divide by zero in case the first detection matches a difficult
+        # ground truth
+        prec = tp_t / np.maximum(tp_t + fp_t, np.finfo(np.float64).eps)
+        ap = voc_ap(rec, prec, use_07_metric)
+        results.append((rec, prec, ap))
+    return results
+
+
+def voc_eval_thresholds(image_inds, confidence, BB, class_gt, ovthreshs, use_07_metric=False):
+    """
+    Run :func:`voc_eval` for one class at several overlap thresholds in one pass.
+
+    image_inds: Index in the image set of the image of each detection of the class.
+    confidence, BB: Score and box of each detection.
+    class_gt: One class of :func:`load_voc_gt`.
+    ovthreshs: Overlap thresholds.
+
+    Returns a (rec, prec, ap) tuple per threshold, equal to those of :func:`voc_eval`.
+    """
+    tp, fp = voc_match(image_inds, confidence, BB, class_gt, ovthreshs)
+    return voc_ap_from_matches(confidence, tp, fp, class_gt["npos"], use_07_metric)
+
+
 def voc_eval(detpath, annopath, imagesetfile, classname, ovthresh=0.5, use_07_metric=False):
     """rec, prec, ap = voc_eval(detpath,
                                 annopath,
@@ -231,94 +525,10 @@ def voc_eval(detpath, annopath, imagesetfile, classname, ovthresh=0.5, use_07_me
     # assumes detections are in detpath.format(classname)
     # assumes annotations are in annopath.format(imagename)
     # assumes imagesetfile is a text file with each line an image name
-
-    # first load gt
-    # read list of images
-    with open(imagesetfile, "r") as f:
-        lines = f.readlines()
-    imagenames = [x.strip() for x in lines]
-
-    # load annots
-    recs = {}
-    for imagename in imagenames:
-        recs[imagename] = parse_rec(annopath.format(imagename))
-
-    # extract gt objects for this class
-    class_recs = {}
-    npos = 0
-    for imagename in imagenames:
-        R = [obj for obj in recs[imagename] if obj["name"] == classname]
-        bbox = np.array([x["bbox"] for x in R])
-        difficult = np.array([x["difficult"] for x in R]).astype(np.bool)
-        # difficult = np.array([False for x in R]).astype(np.bool)  # treat all "difficult" as GT
-        det = [False] * len(R)
-        npos = npos + sum(~difficult)
-        class_recs[imagename] = {"bbox": bbox, "difficult": difficult, "det": det}
-
-    # read dets
-    detfile = detpath.format(classname)
-    with open(detfile, "r") as f:
-        lines = f.readlines()
-
-    splitlines = [x.strip().split(" ") for x in lines]
-    image_ids = [x[0] for x in splitlines]
-    confidence = np.array([float(x[1]) for x in splitlines])
-    BB = np.array([[float(z) for z in x[2:]] for x in splitlines]).reshape(-1, 4)
-
-    # sort by confidence
-    sorted_ind = np.argsort(-confidence)
-    BB = BB[sorted_ind, :]
-    image_ids = [image_ids[x] for x in sorted_ind]
-
-    # go down dets and mark TPs and FPs
-    nd = len(image_ids)
-    tp = np.zeros(nd)
-    fp = np.zeros(nd)
-    for d in range(nd):
-        R = class_recs[image_ids[d]]
-        bb = BB[d, :].astype(float)
-        ovmax = -np.inf
-        BBGT = R["bbox"].astype(float)
-
-        if BBGT.size > 0:
-            # compute overlaps
-            # intersection
-            ixmin = np.maximum(BBGT[:, 0], bb[0])
-            iymin = np.maximum(BBGT[:, 1], bb[1])
-            ixmax = np.minimum(BBGT[:, 2], bb[2])
-            iymax = np.minimum(BBGT[:, 3], bb[3])
-            iw = np.maximum(ixmax - ixmin + 1.0, 0.0)
-            ih = np.maximum(iymax - iymin + 1.0, 0.0)
-            inters = iw * ih
-
-            # union
-            uni = (
-                (bb[2] - bb[0] + 1.0) * (bb[3] - bb[1] + 1.0)
-                + (BBGT[:, 2] - BBGT[:, 0] + 1.0) * (BBGT[:, 3] - BBGT[:, 1] + 1.0)
-                - inters
-            )
-
-            overlaps = inters / uni
-            ovmax = np.max(overlaps)
-            jmax = np.argmax(overlaps)
-
-        if ovmax > ovthresh:
-            if not R["difficult"][jmax]:
-                if not R["det"][jmax]:
-                    tp[d] = 1.0
-                    R["det"][jmax] = 1
-                else:
-                    fp[d] = 1.0
-        else:
-            fp[d] = 1.0
-
-    # compute precision recall
-    fp = np.cumsum(fp)
-    tp = np.cumsum(tp)
-    rec = tp / float(npos)
-    # avoid divide by zero in case the first detection matches a difficult
-    # ground truth
-    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-    ap = voc_ap(rec, prec, use_07_metric)
-
-    return rec, prec, ap
+    imagenames, gt = load_voc_gt(annopath, imagesetfile, [classname])
+    image_ids, confidence, BB = read_voc_detections(detpath.format(classname))
+    image_index = {imagename: i for i, imagename in enumerate(imagenames)}
+    image_inds = [image_index[image_id] for image_id in image_ids]
+    return voc_eval_thresholds(
+        image_inds, confidence, BB, gt[classname], [ovthresh], use_07_metric
+    )[0]
@@ -0,0 +1,103 @@
+import os
+import torch
+import numpy as np
+from detectron2.utils import comm
+from defrcn.structures import DetectionBatch
+from .calibration_layer import blend_scores
+
+
+class PCBScoreRecorder:
+    """
+    Collect, for every test image, the detections before PCB calibration together
+    with the prototype similarity of each box, and save them as one columnar .npz
+    file. The file lets :func:`evaluate_calibration` replay the calibration for any
+    alpha/upper/lower without running the detector or the ImageNet model again.
+    """
+
+    def __init__(self, dataset_name):
+        self._dataset_name = dataset_name
+        self._image_ids = []
+        self._image_sizes = []
+        self._num_boxes = []
+        self._boxes = []
+        self._scores = []
+        self._classes = []
+        self._similarities = []
+
+    def process(self, inputs, outputs, scores, similarities):
+        """
+        Args:
+            inputs, outputs: as in :meth:`DatasetEvaluator.process`.
+            scores (list[Tensor]): the detector scores of each image before calibration.
+            similarities (list[Tensor]): the prototype similarity of each box, as
+                recorded by :meth:`PrototypicalCalibrationBlock.execute_calibration`.
+        """
+        for input, output, scores_i, similarities_i in zip(inputs, outputs, scores, similarities):
+            instances = output["instances"]
+            self._image_ids.append(input["image_id"])
+            self._image_sizes.append(instances.image_size)
+            self._num_boxes.append(len(instances))
+            self._boxes.append(instances.pred_boxes.tensor.cpu().numpy())
+            self._scores.append(scores_i.cpu().numpy())
+            self._classes.append(instances.pred_classes.cpu().numpy())
+            self._similarities.append(similarities_i.cpu().numpy())
+
+    def save(self, path):
+        """
+        Gather the records of all ranks and write them to `path` from the main process.
+        """
+        columns = {
+            "image_ids": np.asarray(self._image_ids),
+            "image_sizes": np.asarray(self._image_sizes, dtype=np.int64).reshape(-1, 2),
+            "num_boxes": np.asarray(self._num_boxes, dtype=np.int64),
+            "boxes": np.concatenate([np.zeros((0, 4))] + self._boxes).astype(np.float32),
+            "scores": np.concatenate([np.zeros(0)] + self._scores).astype(np.float32),
+            "classes": np.concatenate([np.zeros(0)] + self._classes).astype(np.int64),
+            "similarities": np.concatenate([np.zeros(0)] + self._similarities).astype(np.float32),
+        }
+        all_columns = comm.gather(columns, dst=0)
+        if not comm.is_main_process():
+            return
+
+        records = {k: np.concatenate([c[k] for c in all_columns]) for k in columns}
+        records["offsets"] = np.concatenate([[0], np.cumsum(records.pop("num_boxes"))])
+        records["dataset_name"] = np.asarray(self._dataset_name)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, **records)
+
+
+def load_pcb_scores(path):
+    """
+    Load a file written by :class:`PCBScoreRecorder` into a dict of arrays.
+    """
+    with np.load(path) as f:
+        return {k: f[k] for k in f.files}
+
+
+def evaluate_calibration(evaluator, records, alpha, upper, lower):
+    """
+    Re-apply PCB calibration with the given settings to recorded detections and
+    evaluate them with `evaluator`.
+
+    The boxes of an image are calibrated when their score is in (lower, upper],
+    which is the slice that :meth:`PrototypicalCalibrationBlock.execute_calibration`
+    selects on the score-sorted detections.
+    """
+    scores = torch.from_numpy(records["scores"])
+    similarities = torch.from_numpy(records["similarities"])
+    selected = (scores > lower) & (scores <= upper)
+    similarities = similarities.masked_fill(~selected, float("nan"))
+    scores = blend_scores(scores, similarities, alpha)
+
+    detections = DetectionBatch(
+        torch.from_numpy(records["boxes"]),
+        scores,
+        torch.from_numpy(records["classes"]),
+        records["offsets"],
+        records["image_sizes"].tolist(),
+    )
+    evaluator.reset()
+    evaluator.process_detections(
+        [{"image_id": image_id.item()} for image_id in records["image_ids"]], detections
+    )
+    return evaluator.evaluate()
@@ -4,11 +4,11 @@ from torch import nn
 from detectron2.structures import ImageList
 from detectron2.utils.logger import log_first_n
 from detectron2.modeling.backbone import build_backbone
-from detectron2.modeling.postprocessing import detector_postprocess
 from detectron2.modeling.proposal_generator import build_proposal_generator
 from .build import META_ARCH_REGISTRY
 from .gdl import decouple_layer, AffineLayer
 from defrcn.modeling.roi_heads import build_roi_heads
+from defrcn.structures import DetectionBatch
 
 __all__ = ["GeneralizedRCNN"]
 
@@ -59,13 +59,13 @@ class GeneralizedRCNN(nn.Module):
     def inference(self, batched_inputs):
         assert not self.training
         _, _, results, image_sizes = self._forward_once_(batched_inputs, None)
-        processed_results = []
-        for r, input, image_size in zip(results, batched_inputs, image_sizes):
-            height = input.get("height", image_size[0])
-            width = input.get("width", image_size[1])
-            r = detector_postprocess(r, height, width)
-            processed_results.append({"instances": r})
-        return processed_results
+        # rescale the detections of all images at once, as `detector_postprocess`
+        output_sizes = [
+            (input.get("height", image_size[0]), input.get("width", image_size[1]))
+            for input, image_size in zip(batched_inputs, image_sizes)
+        ]
+        # also a list of {"instances": Instances}, so that callers can index it as usual
+        return DetectionBatch.from_instances(results).rescale(output_sizes)
 
     def _forward_once_(self, batched_inputs, gt_instances=None):
 
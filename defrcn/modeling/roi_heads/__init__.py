@@ -1,3 +1,4 @@
 from .box_head import ROI_BOX_HEAD_REGISTRY, build_box_head
 from .roi_heads import (
-    ROI_HEADS_REGISTRY, ROIHeads, StandardROIHeads, build_roi_heads, select_foreground_proposals)
+    ROI_HEADS_REGISTRY, ROIHeads, StandardROIHeads, build_roi_heads, select_foreground_proposals,
+    select_proposals_by_objectness)
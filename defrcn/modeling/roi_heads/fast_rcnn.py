@@ -10,6 +10,7 @@ from detectron2.utils.registry import Registry
 from detectron2.layers import batched_nms, cat
 from detectron2.structures import Boxes, Instances
 from detectron2.utils.events import get_event_storage
+from detectron2.utils.logger import log_every_n_seconds
 
 ROI_HEADS_OUTPUT_REGISTRY = Registry("ROI_HEADS_OUTPUT")
 ROI_HEADS_OUTPUT_REGISTRY.__doc__ = """
@@ -17,6 +18,9 @@ Registry for the output layers in ROI heads in a generalized R-CNN model."""
 
 logger = logging.getLogger(__name__)
 
+# images seen / images whose candidates were capped by the pre-NMS top-k
+_PRE_NMS_TOPK_STATS = {"images": 0, "capped": 0}
+
 """
 Shape shorthand in this module:
 
@@ -44,10 +48,21 @@ Naming convention:
 
 
 def fast_rcnn_inference(
-    boxes, scores, image_shapes, score_thresh, nms_thresh, topk_per_image
+    boxes,
+    scores,
+    image_shapes,
+    score_thresh,
+    nms_thresh,
+    topk_per_image,
+    pre_nms_topk_per_image=0,
+    nms_type="greedy",
 ):
     """
-    Call `fast_rcnn_inference_single_image` for all images.
+    Return bounding-box detection results of all images by thresholding on scores
+    and applying non-maximum suppression (NMS). Clipping, thresholding and the
+    pre-NMS top-k run over the whole batch at once, then NMS runs image by image.
+    The detections are the same as calling `fast_rcnn_inference_single_image` for
+    each image.
 
     Args:
         boxes (list[Tensor]): A list of Tensors of predicted class-specific or class-agnostic
@@ -64,6 +79,9 @@ def fast_rcnn_inference(
         nms_thresh (float):  The threshold to use for box non-maximum suppression. Value in [0, 1].
         topk_per_image (int): The number of top scoring detections to return. Set < 0 to return
             all detections.
+        pre_nms_topk_per_image (int): The number of top scoring (box, class) candidates of
+            each image that enter NMS. Set <= 0 to keep all candidates above `score_thresh`.
+        nms_type (str): "greedy", "fast" or "matrix", see :func:`batched_nms_by_type`.
 
     Returns:
         instances: (list[Instances]): A list of N instances, one for each image in the batch,
@@ -71,24 +89,374 @@ def fast_rcnn_inference(
         kept_indices: (list[Tensor]): A list of 1D tensor of length of N, each element indicates
             the corresponding boxes/scores index in [0, Ri) from the input, for image i.
     """
-    result_per_image = [
-        fast_rcnn_inference_single_image(
-            boxes_per_image,
-            scores_per_image,
+    num_preds_per_image = [len(s) for s in scores]
+    image_inds, image_starts = _image_indices(
+        num_preds_per_image, scores[0].device
+    )
+
+    scores = cat(scores, dim=0)[:, :-1]
+    boxes = cat(boxes, dim=0)
+    num_bbox_reg_classes = boxes.shape[1] // 4
+    boxes = _clip_boxes(
+        boxes.view(-1, num_bbox_reg_classes, 4),  # R x C x 4
+        image_shapes,
+        image_inds[:, None],
+    )
+
+    # Filter results based on detection scores
+    filter_mask = scores > score_thresh  # R x K
+    # R' x 2. First column contains indices of the R predictions of all images;
+    # Second column contains indices of classes.
+    filter_inds = filter_mask.nonzero()
+    if num_bbox_reg_classes == 1:
+        boxes = boxes[filter_inds[:, 0], 0]
+    else:
+        boxes = boxes[filter_mask]
+    scores = scores[filter_mask]
+    keep = _pre_nms_topk(
+        scores,
+        image_inds[filter_inds[:, 0]],
+        len(image_shapes),
+        pre_nms_topk_per_image,
+    )
+    if keep is not None:
+        boxes, scores, filter_inds = boxes[keep], scores[keep], filter_inds[keep]
+
+    return _batched_nms_per_image(
+        boxes,
+        scores,
+        filter_inds,
+        image_inds,
+        image_starts,
+        image_shapes,
+        nms_thresh,
+        topk_per_image,
+        nms_type,
+        score_thresh,
+    )
+
+
+def batched_nms_by_type(boxes, scores, idxs, iou_threshold, nms_type="greedy", score_thresh=0.0):
+    """
+    Per-group NMS, where boxes of different `idxs` never suppress each other.
+
+    Args:
+        boxes, scores, idxs, iou_threshold: same as `batched_nms`.
+        nms_type (str): "greedy" for the sequential `batched_nms`; "fast" for
+            :func:`batched_fast_nms`; "matrix" for :func:`batched_matrix_nms`,
+            which decays scores instead of using `iou_threshold`.
+        score_thresh (float): Matrix-NMS only, boxes whose decayed score is not
+            above it are removed.
+
+    Returns:
+        Tensor: indices of the kept boxes, sorted by decreasing (updated) score.
+        Tensor: the scores of all boxes after suppression. Only Matrix-NMS
+            changes them.
+    """
+    if nms_type == "greedy":
+        return batched_nms(boxes, scores, idxs, iou_threshold), scores
+    if nms_type == "fast":
+        return batched_fast_nms(boxes, scores, idxs, iou_threshold), scores
+    if nms_type == "matrix":
+        return batched_matrix_nms(boxes, scores, idxs, score_thresh=score_thresh)
+    raise ValueError("Unknown NMS type: {}".format(nms_type))
+
+
+def _box_iou_blocks(boxes):
+    """
+    IoU of every pair of boxes within each block of a (G, n, 4) tensor, computed as
+    `detectron2.structures.pairwise_iou`. Zero-size padding boxes have no overlap with any box.
+    """
+    area = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+    width_height = torch.min(boxes[:, :, None, 2:], boxes[:, None, :, 2:]) - torch.max(
+        boxes[:, :, None, :2], boxes[:, None, :, :2]
+    )  # G x n x n x 2
+    inter = width_height.clamp(min=0).prod(dim=3)
+    return torch.where(
+        inter > 0,
+        inter / (area[:, :, None] + area[:, None, :] - inter),
+        torch.zeros(1, dtype=inter.dtype, device=inter.device),
+    )
+
+
+def _same_group_overlaps(boxes, scores, idxs, sigma=None, max_elements=1 << 24):
+    """
+    Compare every box only with the higher scoring boxes of its own group.
+
+    The boxes are sorted by group, then by decreasing score, into a padded (G, n, 4)
+    tensor, where n is the size of the largest group. The IoU of all groups is one
+    (G, n, n) tensor op, so the cost grows with the size of the groups, not with the
+    total number of boxes. Above `max_elements` IoU entries it runs over fixed-size
+    slices of groups; the only host sync is for the padded shape.
+
+    Args:
+        sigma (float or None): if given, also compute the Gaussian Matrix-NMS decay.
+
+    Returns:
+        Tensor: (R,) indices of the boxes sorted by decreasing score.
+        Tensor: (R,) in that order, the largest IoU of each box with a higher scoring
+            box of its group (0 for the first box of a group).
+        Tensor or None: (R,) in that order, the Matrix-NMS decay of each box.
+    """
+    num_boxes = len(scores)
+    order = scores.argsort(descending=True)
+    max_iou = scores.new_zeros(num_boxes)
+    decay = scores.new_ones(num_boxes) if sigma is not None else None
+    if num_boxes == 0:
+        return order, max_iou, decay
+
+    # positions in `order`, grouped by idxs and in score order within a group
+    by_group = torch.argsort(
+        idxs[order] * num_boxes + torch.arange(num_boxes, device=scores.device)
+    )
+    counts = torch.unique_consecutive(idxs[order][by_group], return_counts=True)[1]
+    group = torch.repeat_interleave(
+        torch.arange(len(counts), device=scores.device), counts
+    )
+    pos = torch.arange(num_boxes, device=scores.device) - (
+        torch.cumsum(counts, dim=0) - counts
+    )[group]
+    n = int(counts.max())
+    padded = boxes.new_zeros(len(counts), n, 4)
+    padded[group, pos] = boxes[order[by_group]]
+
+    groups_per_slice = max(1, max_elements // (n * n))
+    slice_max, slice_decay = [], []
+    for first in range(0, len(counts), groups_per_slice):
+        # entry (g, i, j): overlap of box j with the higher scoring box i of group g
+        iou = _box_iou_blocks(padded[first:first + groups_per_slice]).triu_(diagonal=1)
+        iou_max = iou.max(dim=1)[0]  # G x n
+        slice_max.append(iou_max)
+        if sigma is not None:
+            # each decay is compensated by how much the suppressing box i is overlapped
+            slice_decay.append(
+                torch.exp(-sigma * (iou ** 2 - iou_max[:, :, None] ** 2)).min(dim=1)[0]
+            )
+    max_iou[by_group] = torch.cat(slice_max)[group, pos]
+    if sigma is not None:
+        decay[by_group] = torch.cat(slice_decay)[group, pos]
+    return order, max_iou, decay
+
+
+def batched_fast_nms(boxes, scores, idxs, iou_threshold):
+    """
+    Fast NMS from YOLACT: a box is removed if it overlaps any higher scoring box of
+    its group by more than `iou_threshold`, whether or not that box was itself
+    removed. This is one matrix op per group instead of a sequential loop, and
+    suppresses slightly more than greedy NMS.
+
+    Returns:
+        Tensor: indices of the kept boxes, sorted by decreasing score.
+    """
+    order, max_iou, _ = _same_group_overlaps(boxes, scores, idxs)
+    return order[max_iou <= iou_threshold]
+
+
+def batched_matrix_nms(boxes, scores, idxs, sigma=2.0, score_thresh=0.0):
+    """
+    Matrix NMS from SOLOv2 with a Gaussian kernel. Every score is decayed by its
+    overlap with higher scoring boxes of its group, with each decay compensated by
+    how much the suppressing box is itself overlapped. As the update threshold of
+    SOLOv2, the boxes whose decayed score is not above `score_thresh` are removed.
+
+    Returns:
+        Tensor: indices of the kept boxes, sorted by decreasing decayed score.
+        Tensor: the decayed scores of all boxes.
+    """
+    order, _, decay = _same_group_overlaps(boxes, scores, idxs, sigma=sigma)
+    if len(order) == 0:
+        return order, scores
+    decayed = scores.clone()
+    decayed[order] = scores[order] * decay
+    keep = decayed.argsort(descending=True)
+    return keep[decayed[keep] > score_thresh], decayed
+
+
+def _pre_nms_topk(scores, image_inds, num_images, topk):
+    """
+    Select the `topk` highest scoring candidates of every image, so that the cost
+    of NMS does not grow with the number of candidates above the score threshold.
+
+    Args:
+        scores (Tensor): (R',) scores of the candidates of all images.
+        image_inds (Tensor): (R',) image index of every candidate.
+        num_images (int): number of images in the batch.
+        topk (int): number of candidates kept per image; <= 0 keeps all.
+
+    Returns:
+        Tensor or None: indices of the kept candidates in their original order,
+            or None if no image has more than `topk` candidates.
+    """
+    if topk <= 0:
+        return None
+    num_candidates = torch.bincount(image_inds, minlength=num_images)
+    num_capped = int((num_candidates > topk).sum())
+    _PRE_NMS_TOPK_STATS["images"] += num_images
+    _PRE_NMS_TOPK_STATS["capped"] += num_capped
+    log_every_n_seconds(
+        logging.INFO,
+        "Pre-NMS top-{} hit on {}/{} images so far.".format(
+            topk, _PRE_NMS_TOPK_STATS["capped"], _PRE_NMS_TOPK_STATS["images"]
+        ),
+        n=60,
+    )
+    if num_capped == 0:
+        return None
+
+    # sort by score, then group by image keeping the score order
+    order = torch.argsort(scores, descending=True)
+    order = order[
+        torch.argsort(
+            image_inds[order] * len(order)
+            + torch.arange(len(order), device=order.device)
+        )
+    ]
+    first = torch.cumsum(num_candidates, dim=0) - num_candidates
+    rank = torch.arange(len(order), device=order.device) - first[image_inds[order]]
+    return order[rank < topk].sort()[0]
+
+
+def _image_indices(num_preds_per_image, device):
+    """
+    Returns the image index of every prediction of a batch and the offset of the
+    first prediction of every image, for predictions concatenated over images.
+    """
+    image_inds = torch.repeat_interleave(
+        torch.arange(len(num_preds_per_image), device=device),
+        torch.as_tensor(num_preds_per_image, device=device),
+    )
+    image_starts = torch.as_tensor(
+        np.cumsum([0] + num_preds_per_image[:-1]), device=device
+    )
+    return image_inds, image_starts
+
+
+def _clip_boxes(boxes, image_shapes, image_inds):
+    """
+    Clip boxes of shape (..., 4) to the size of their own image, as `Boxes.clip`
+    does. `image_inds` holds the image index of every box and broadcasts against
+    `boxes.shape[:-1]`.
+    """
+    sizes = torch.as_tensor(image_shapes, dtype=boxes.dtype, device=boxes.device)
+    h, w = sizes[image_inds, 0], sizes[image_inds, 1]
+    return torch.stack(
+        (
+            torch.min(boxes[..., 0].clamp(min=0), w),
+            torch.min(boxes[..., 1].clamp(min=0), h),
+            torch.min(boxes[..., 2].clamp(min=0), w),
+            torch.min(boxes[..., 3].clamp(min=0), h),
+        ),
+        dim=-1,
+    )
+
+
+def _batched_nms_per_image(
+    boxes,
+    scores,
+    filter_inds,
+    image_inds,
+    image_starts,
+    image_shapes,
+    nms_thresh,
+    topk_per_image,
+    nms_type="greedy",
+    score_thresh=0.0,
+):
+    """
+    Per-class NMS over the score-filtered candidates of a whole batch, image by image.
+
+    The candidates of each image go through :func:`_nms_single_image` on their own,
+    as in `fast_rcnn_inference_single_image`. A single call over all images would need
+    image offsets on the group ids, and `batched_nms` turns those into coordinate
+    offsets large enough for float32 to round the IoUs and change the kept boxes.
+
+    Args:
+        boxes (Tensor): (R', 4) clipped boxes of the candidates.
+        scores (Tensor): (R',) scores of the candidates.
+        filter_inds (Tensor): (R', 2) prediction index, over all images, and class
+            index of every candidate, sorted by prediction index.
+        image_inds (Tensor): (R,) image index of every prediction.
+        image_starts (Tensor): (N,) index of the first prediction of every image.
+        image_shapes, nms_thresh, topk_per_image, nms_type, score_thresh: same
+            as fast_rcnn_inference.
+
+    Returns:
+        same as fast_rcnn_inference.
+    """
+    num_candidates = torch.bincount(
+        image_inds[filter_inds[:, 0]], minlength=len(image_shapes)
+    ).tolist()
+    results, kept_indices = [], []
+    for image_shape, image_start, boxes_i, scores_i, filter_inds_i in zip(
+        image_shapes,
+        image_starts,
+        boxes.split(num_candidates),
+        scores.split(num_candidates),
+        filter_inds.split(num_candidates),
+    ):
+        result, inds = _nms_single_image(
+            boxes_i,
+            scores_i,
+            filter_inds_i,
             image_shape,
-            score_thresh,
             nms_thresh,
             topk_per_image,
+            nms_type,
+            score_thresh,
         )
-        for scores_per_image, boxes_per_image, image_shape in zip(
-            scores, boxes, image_shapes
-        )
-    ]
-    return tuple(list(x) for x in zip(*result_per_image))
+        results.append(result)
+        # indices of the predictions within their own image
+        kept_indices.append(inds - image_start)
+    return results, kept_indices
+
+
+def _nms_single_image(
+    boxes,
+    scores,
+    filter_inds,
+    image_shape,
+    nms_thresh,
+    topk_per_image,
+    nms_type="greedy",
+    score_thresh=0.0,
+):
+    """
+    Per-class NMS and top-k over the score-filtered candidates of one image.
+
+    Args:
+        boxes (Tensor): (R', 4) clipped boxes of the candidates.
+        scores (Tensor): (R',) scores of the candidates.
+        filter_inds (Tensor): (R', 2) prediction and class index of every candidate.
+        image_shape, nms_thresh, topk_per_image, nms_type, score_thresh: same
+            as fast_rcnn_inference.
+
+    Returns:
+        same as fast_rcnn_inference_single_image.
+    """
+    # Apply per-class NMS
+    keep, scores = batched_nms_by_type(
+        boxes, scores, filter_inds[:, 1], nms_thresh, nms_type, score_thresh
+    )
+    if topk_per_image >= 0:
+        keep = keep[:topk_per_image]
+    boxes, scores, filter_inds = boxes[keep], scores[keep], filter_inds[keep]
+
+    result = Instances(image_shape)
+    result.pred_boxes = Boxes(boxes)
+    result.scores = scores
+    result.pred_classes = filter_inds[:, 1]
+    return result, filter_inds[:, 0]
 
 
 def fast_rcnn_inference_single_image(
-    boxes, scores, image_shape, score_thresh, nms_thresh, topk_per_image
+    boxes,
+    scores,
+    image_shape,
+    score_thresh,
+    nms_thresh,
+    topk_per_image,
+    pre_nms_topk_per_image=0,
+    nms_type="greedy",
 ):
     """
     Single-image inference. Return bounding-box detection results by thresholding
@@ -118,18 +486,22 @@ def fast_rcnn_inference_single_image(
     else:
         boxes = boxes[filter_mask]
     scores = scores[filter_mask]
-
-    # Apply per-class NMS
-    keep = batched_nms(boxes, scores, filter_inds[:, 1], nms_thresh)
-    if topk_per_image >= 0:
-        keep = keep[:topk_per_image]
-    boxes, scores, filter_inds = boxes[keep], scores[keep], filter_inds[keep]
-
-    result = Instances(image_shape)
-    result.pred_boxes = Boxes(boxes)
-    result.scores = scores
-    result.pred_classes = filter_inds[:, 1]
-    return result, filter_inds[:, 0]
+    keep = _pre_nms_topk(
+        scores, filter_inds.new_zeros(len(scores)), 1, pre_nms_topk_per_image
+    )
+    if keep is not None:
+        boxes, scores, filter_inds = boxes[keep], scores[keep], filter_inds[keep]
+
+    return _nms_single_image(
+        boxes,
+        scores,
+        filter_inds,
+        image_shape,
+        nms_thresh,
+        topk_per_image,
+        nms_type,
+        score_thresh,
+    )
 
 
 class FastRCNNOutputs(object):
@@ -330,27 +702,71 @@ class FastRCNNOutputs(object):
         probs = F.softmax(self.pred_class_logits, dim=-1)
         return probs.split(self.num_preds_per_image, dim=0)
 
-    def inference(self, score_thresh, nms_thresh, topk_per_image):
+    def inference(
+        self,
+        score_thresh,
+        nms_thresh,
+        topk_per_image,
+        pre_nms_topk_per_image=0,
+        nms_type="greedy",
+    ):
         """
+        Same as running fast_rcnn_inference on `predict_boxes()` and `predict_probs()`,
+        but only the deltas of the (proposal, class) pairs scoring above `score_thresh`
+        are decoded and clipped, instead of R x K boxes.
+
         Args:
             score_thresh (float): same as fast_rcnn_inference.
             nms_thresh (float): same as fast_rcnn_inference.
             topk_per_image (int): same as fast_rcnn_inference.
+            pre_nms_topk_per_image (int): same as fast_rcnn_inference.
+            nms_type (str): same as fast_rcnn_inference.
         Returns:
             list[Instances]: same as fast_rcnn_inference.
             list[Tensor]: same as fast_rcnn_inference.
         """
-        boxes = self.predict_boxes()
-        scores = self.predict_probs()
-        image_shapes = self.image_shapes
+        scores = F.softmax(self.pred_class_logits, dim=-1)[:, :-1]
+        num_pred = scores.shape[0]
+        B = self.proposals.tensor.shape[1]
+        K = self.pred_proposal_deltas.shape[1] // B
+        deltas = self.pred_proposal_deltas.view(num_pred, K, B)
 
-        return fast_rcnn_inference(
+        filter_mask = scores > score_thresh  # R x K
+        filter_inds = filter_mask.nonzero()
+        if K == 1:
+            deltas = deltas[filter_inds[:, 0], 0]
+        else:
+            deltas = deltas[filter_mask]
+        scores = scores[filter_mask]
+
+        image_inds, image_starts = _image_indices(
+            self.num_preds_per_image, scores.device
+        )
+        keep = _pre_nms_topk(
+            scores,
+            image_inds[filter_inds[:, 0]],
+            len(self.image_shapes),
+            pre_nms_topk_per_image,
+        )
+        if keep is not None:
+            deltas, scores, filter_inds = deltas[keep], scores[keep], filter_inds[keep]
+        boxes = self.box2box_transform.apply_deltas(
+            deltas, self.proposals.tensor[filter_inds[:, 0]]
+        )
+        boxes = _clip_boxes(
+            boxes, self.image_shapes, image_inds[filter_inds[:, 0]]
+        )
+        return _batched_nms_per_image(
             boxes,
             scores,
-            image_shapes,
-            score_thresh,
+            filter_inds,
+            image_inds,
+            image_starts,
+            self.image_shapes,
             nms_thresh,
             topk_per_image,
+            nms_type,
+            score_thresh,
         )
 
 
@@ -393,15 +809,68 @@ class FastRCNNOutputLayers(nn.Module):
 
         self._do_cls_dropout = cfg.MODEL.ROI_HEADS.CLS_DROPOUT
         self._dropout_ratio = cfg.MODEL.ROI_HEADS.DROPOUT_RATIO
+        self._box_dim = box_dim
+        self._class_subset = None
+
+    def set_class_subset(self, class_ids=None):
+        """
+        At inference, only predict the foreground classes `class_ids`, in increasing
+        order, followed by the background. None restores all classes.
+
+        The box regression rows of the kept classes are selected once here and
+        gathered from the live weights at every forward. The classification still
+        scores all classes, and the logits of the other classes are folded into the
+        background logit (logsumexp). As a result, the softmax score of every kept
+        class is the same as with all classes.
+
+        Args:
+            class_ids (list[int] or None): contiguous ids in [0, num_classes).
+        """
+        if class_ids is None:
+            self._class_subset = None
+            return
+        num_classes = self.cls_score.out_features - 1
+        class_ids = torch.as_tensor(sorted(set(class_ids)), dtype=torch.long)
+        assert len(class_ids) and 0 <= class_ids[0] and class_ids[-1] < num_classes, \
+            "Class subset must be a non-empty list of ids in [0, {})".format(num_classes)
+        # the background and all classes outside of the subset
+        other_ids = torch.ones(num_classes + 1, dtype=torch.bool)
+        other_ids[class_ids] = False
+        other_ids = other_ids.nonzero().squeeze(1)
+
+        rows = None
+        if self.bbox_pred.out_features > self._box_dim:  # class-specific
+            rows = (
+                self._box_dim * class_ids[:, None] + torch.arange(self._box_dim)
+            ).flatten()
+        self._class_subset = (class_ids, other_ids, rows)
 
     def forward(self, x):
         if x.dim() > 2:
             x = torch.flatten(x, start_dim=1)
-        proposal_deltas = self.bbox_pred(x)
+        class_subset = None if self.training else self._class_subset
+        if class_subset is not None:
+            class_ids, other_ids, rows = [
+                None if t is None else t.to(x.device) for t in class_subset
+            ]
+        if class_subset is None or rows is None:
+            proposal_deltas = self.bbox_pred(x)
+        else:
+            proposal_deltas = F.linear(
+                x, self.bbox_pred.weight[rows], self.bbox_pred.bias[rows]
+            )
 
         if self._do_cls_dropout:
             x = F.dropout(x, self._dropout_ratio, training=self.training)
         scores = self.cls_score(x)
+        if class_subset is not None:
+            scores = torch.cat(
+                [
+                    scores[:, class_ids],
+                    torch.logsumexp(scores[:, other_ids], dim=1, keepdim=True),
+                ],
+                dim=1,
+            )
 
         return scores, proposal_deltas
 
@@ -8,6 +8,7 @@ from detectron2.utils.registry import Registry
 from detectron2.modeling.matcher import Matcher
 from detectron2.modeling.poolers import ROIPooler
 from detectron2.utils.events import get_event_storage
+from detectron2.utils.logger import log_every_n_seconds
 from detectron2.modeling.sampling import subsample_labels
 from detectron2.modeling.box_regression import Box2BoxTransform
 from detectron2.structures import Boxes, Instances, pairwise_iou
@@ -37,6 +38,51 @@ def build_roi_heads(cfg, input_shape):
     return ROI_HEADS_REGISTRY.get(name)(cfg, input_shape)
 
 
+def select_proposals_by_objectness(
+    proposals, min_score=0.0, mass=1.0, min_keep=0, max_keep=-1
+):
+    """
+    Test-time gate on the RPN objectness of the proposals of every image, so that
+    hopeless proposals never reach the ROI head. The limits apply in this order:
+    `min_score` and `mass` cut the image's proposals, ranked by objectness, the
+    stricter of the two wins; `min_keep` then restores the top proposals up to a
+    floor, and `max_keep` finally caps the count.
+
+    Args:
+        proposals (list[Instances]): per-image proposals with "objectness_logits".
+        min_score (float): drop proposals whose sigmoid objectness is below this.
+        mass (float): adaptive per-image budget: keep the fewest top proposals whose
+            sigmoid objectness sums to this fraction of the image's total. 1.0 keeps all.
+        min_keep (int): the top `min_keep` proposals of an image are always kept.
+        max_keep (int): at most the top `max_keep` proposals of an image are kept;
+            < 0 for no limit. Takes precedence over `min_keep`.
+
+    Returns:
+        list[Instances]: the kept proposals of every image, in their original order.
+    """
+    kept_proposals = []
+    for proposals_per_image in proposals:
+        num_proposals = len(proposals_per_image)
+        scores, order = proposals_per_image.objectness_logits.sigmoid().sort(
+            descending=True
+        )
+        num_keep = num_proposals
+        if min_score > 0:
+            num_keep = int((scores >= min_score).sum())
+        if mass < 1.0 and num_proposals > 0:
+            cum_scores = scores.cumsum(dim=0)
+            num_keep = min(
+                num_keep, int((cum_scores < mass * cum_scores[-1]).sum()) + 1
+            )
+        num_keep = min(max(num_keep, min_keep), num_proposals)
+        if max_keep >= 0:
+            num_keep = min(num_keep, max_keep)
+        if num_keep < num_proposals:
+            proposals_per_image = proposals_per_image[order[:num_keep].sort()[0]]
+        kept_proposals.append(proposals_per_image)
+    return kept_proposals
+
+
 def select_foreground_proposals(proposals, bg_label):
     """
     Given a list of N Instances (for N images), each containing a `gt_classes` field,
@@ -86,6 +132,12 @@ class ROIHeads(torch.nn.Module):
         self.test_score_thresh        = cfg.MODEL.ROI_HEADS.SCORE_THRESH_TEST
         self.test_nms_thresh          = cfg.MODEL.ROI_HEADS.NMS_THRESH_TEST
         self.test_detections_per_img  = cfg.TEST.DETECTIONS_PER_IMAGE
+        self.test_pre_nms_topk        = cfg.TEST.PRE_NMS_TOPK_PER_IMAGE
+        self.test_nms_type            = cfg.TEST.NMS_TYPE
+        self.test_min_objectness      = cfg.TEST.PROPOSAL_MIN_OBJECTNESS
+        self.test_objectness_mass     = cfg.TEST.PROPOSAL_OBJECTNESS_MASS
+        self.test_gate_min_keep       = cfg.TEST.PROPOSAL_GATE_MIN_KEEP
+        self.test_gate_max_keep       = cfg.TEST.PROPOSAL_GATE_MAX_KEEP
         self.in_features              = cfg.MODEL.ROI_HEADS.IN_FEATURES
         self.num_classes              = cfg.MODEL.ROI_HEADS.NUM_CLASSES
         self.proposal_append_gt       = cfg.MODEL.ROI_HEADS.PROPOSAL_APPEND_GT
@@ -106,6 +158,73 @@ class ROIHeads(torch.nn.Module):
         self.box2box_transform = Box2BoxTransform(
             weights=cfg.MODEL.ROI_BOX_HEAD.BBOX_REG_WEIGHTS
         )
+        # foreground classes predicted at inference, None for all
+        self.test_class_ids = None
+        # images seen / proposals received / proposals kept by the objectness gate
+        self.proposal_gate_stats = {"images": 0, "proposals": 0, "kept": 0}
+
+    def _gate_proposals(self, proposals):
+        """
+        Apply :func:`select_proposals_by_objectness` at inference with the
+        TEST.PROPOSAL_* settings, and keep count of the proposals it saves.
+        It runs on the RPN's output, after the RPN's own POST_NMS_TOPK_TEST cut,
+        and is the only test-time budget on the proposals of an image.
+        """
+        if (
+            self.test_min_objectness <= 0
+            and self.test_objectness_mass >= 1.0
+            and self.test_gate_max_keep < 0
+        ):
+            return proposals
+        kept_proposals = select_proposals_by_objectness(
+            proposals,
+            self.test_min_objectness,
+            self.test_objectness_mass,
+            self.test_gate_min_keep,
+            self.test_gate_max_keep,
+        )
+        stats = self.proposal_gate_stats
+        stats["images"] += len(proposals)
+        stats["proposals"] += sum(len(p) for p in proposals)
+        stats["kept"] += sum(len(p) for p in kept_proposals)
+        log_every_n_seconds(
+            logging.INFO,
+            "Objectness gate kept {:.1f} of {:.1f} proposals per image so far.".format(
+                stats["kept"] / stats["images"], stats["proposals"] / stats["images"]
+            ),
+            n=60,
+        )
+        return kept_proposals
+
+    def set_class_subset(self, class_ids=None):
+        """
+        Only score and postprocess the foreground classes `class_ids` at inference,
+        e.g. the novel classes when testing on a novel-only split. None restores
+        all classes. See :meth:`FastRCNNOutputLayers.set_class_subset`.
+
+        Args:
+            class_ids (list[int] or None): contiguous ids in [0, num_classes).
+                The `pred_classes` of the predictions keep these ids.
+        """
+        for module in self.children():
+            if isinstance(module, FastRCNNOutputLayers):
+                module.set_class_subset(class_ids)
+        self.test_class_ids = (
+            None if class_ids is None
+            else torch.as_tensor(sorted(set(class_ids)), dtype=torch.long)
+        )
+
+    def _map_class_subset(self, pred_instances):
+        """
+        Map `pred_classes` predicted over the active class subset back to the
+        contiguous ids of all classes.
+        """
+        if self.test_class_ids is None:
+            return pred_instances
+        for instances in pred_instances:
+            class_ids = self.test_class_ids.to(instances.pred_classes.device)
+            instances.pred_classes = class_ids[instances.pred_classes]
+        return pred_instances
 
     def _sample_proposals(self, matched_idxs, matched_labels, gt_classes):
         """
@@ -297,6 +416,7 @@ class Res5ROIHeads(ROIHeads):
         )
 
         self.res5, out_channels = self._build_res5_block(cfg)
+        self.test_res5_chunk_size = cfg.TEST.RES5_CHUNK_SIZE
         output_layer = cfg.MODEL.ROI_HEADS.OUTPUT_LAYER
         self.box_predictor = ROI_HEADS_OUTPUT_REGISTRY.get(output_layer)(
             cfg, out_channels, self.num_classes, self.cls_agnostic_bbox_reg
@@ -335,6 +455,28 @@ class Res5ROIHeads(ROIHeads):
         # print('res5:', x.size())
         return x
 
+    def _chunked_roi_transform(self, features, boxes, chunk_size):
+        """
+        Same as `_shared_roi_transform` followed by the mean pooling, but over
+        micro-batches of at most `chunk_size` proposals taken across all images.
+        The peak memory of the res5 head is then bounded by the chunk size rather
+        than by the number of proposals.
+        """
+        num_boxes = [len(b) for b in boxes]
+        starts = np.cumsum([0] + num_boxes[:-1])
+        total = sum(num_boxes)
+        feature_pooled = []
+        for start in range(0, total, chunk_size):
+            end = min(start + chunk_size, total)
+            chunk_boxes = [
+                b[int(np.clip(start - s, 0, n)):int(np.clip(end - s, 0, n))]
+                for b, s, n in zip(boxes, starts, num_boxes)
+            ]
+            x = self._shared_roi_transform(features, chunk_boxes)
+            feature_pooled.append(x.mean(dim=[2, 3]))
+            del x
+        return torch.cat(feature_pooled, dim=0)
+
     def forward(self, images, features, proposals, targets=None):
         """
         See :class:`ROIHeads.forward`.
@@ -343,13 +485,25 @@ class Res5ROIHeads(ROIHeads):
 
         if self.training:
             proposals = self.label_and_sample_proposals(proposals, targets)
+        else:
+            proposals = self._gate_proposals(proposals)
         del targets
 
         proposal_boxes = [x.proposal_boxes for x in proposals]
-        box_features = self._shared_roi_transform(
-            [features[f] for f in self.in_features], proposal_boxes
-        )
-        feature_pooled = box_features.mean(dim=[2, 3])  # pooled to 1x1
+        chunk_size = self.test_res5_chunk_size
+        if (
+            not self.training
+            and 0 < chunk_size < sum(len(b) for b in proposal_boxes)
+        ):
+            feature_pooled = self._chunked_roi_transform(
+                [features[f] for f in self.in_features], proposal_boxes, chunk_size
+            )
+        else:
+            box_features = self._shared_roi_transform(
+                [features[f] for f in self.in_features], proposal_boxes
+            )
+            feature_pooled = box_features.mean(dim=[2, 3])  # pooled to 1x1
+            del box_features
         pred_class_logits, pred_proposal_deltas = self.box_predictor(
             feature_pooled
         )
@@ -372,8 +526,10 @@ class Res5ROIHeads(ROIHeads):
                 self.test_score_thresh,
                 self.test_nms_thresh,
                 self.test_detections_per_img,
+                self.test_pre_nms_topk,
+                self.test_nms_type,
             )
-            return pred_instances, {}
+            return self._map_class_subset(pred_instances), {}
 
 
 @ROI_HEADS_REGISTRY.register()
@@ -457,6 +613,8 @@ class StandardROIHeads(ROIHeads):
         del images
         if self.training:
             proposals = self.label_and_sample_proposals(proposals, targets)
+        else:
+            proposals = self._gate_proposals(proposals)
         del targets
 
         features_list = [features[f] for f in self.in_features]
@@ -512,5 +670,7 @@ class StandardROIHeads(ROIHeads):
                 self.test_score_thresh,
                 self.test_nms_thresh,
                 self.test_detections_per_img,
+                self.test_pre_nms_topk,
+                self.test_nms_type,
             )
-            return pred_instances
+            return self._map_class_subset(pred_instances)
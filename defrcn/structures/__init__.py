@@ -0,0 +1,3 @@
+from .detection_batch import DetectionBatch
+
+__all__ = ["DetectionBatch"]
@@ -0,0 +1,162 @@
+import torch
+import numpy as np
+from detectron2.structures import Boxes, Instances
+
+
+class DetectionBatch:
+    """
+    The detections of a batch of images as contiguous columns. The detections of
+    image i are the rows `offsets[i]:offsets[i + 1]` of `boxes`, `scores` and
+    `classes`, so a whole batch moves between devices and ranks as a few tensors
+    instead of one object per image or per box.
+
+    A batch is also a sequence of model outputs, one `{"instances": Instances}` per
+    image, so a model can return it in place of the usual list of outputs. The fields
+    of these Instances are views of the columns, so that in-place updates of their
+    scores (e.g. by PCB) are seen by the batch.
+
+    Attributes:
+        boxes (Tensor): (D, 4) boxes in XYXY_ABS format.
+        scores (Tensor): (D,) detection scores.
+        classes (Tensor): (D,) contiguous class ids.
+        offsets (ndarray): (N + 1,) int64 row offsets of every image.
+        image_sizes (list[tuple]): (height, width) of every image.
+    """
+
+    def __init__(self, boxes, scores, classes, offsets, image_sizes):
+        self.boxes = boxes
+        self.scores = scores
+        self.classes = classes
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.image_sizes = [tuple(s) for s in image_sizes]
+        assert len(self.offsets) == len(self.image_sizes) + 1
+        self._instances = None
+
+    @classmethod
+    def from_instances(cls, instances):
+        """
+        Args:
+            instances (list[Instances]): per-image detections with fields
+                "pred_boxes", "scores" and "pred_classes".
+        """
+        assert len(instances) > 0
+        return cls(
+            torch.cat([x.pred_boxes.tensor for x in instances]),
+            torch.cat([x.scores for x in instances]),
+            torch.cat([x.pred_classes for x in instances]),
+            np.cumsum([0] + [len(x) for x in instances]),
+            [x.image_size for x in instances],
+        )
+
+    @classmethod
+    def from_outputs(cls, outputs):
+        """
+        Build a batch from model outputs, a list of dicts with key "instances".
+        """
+        return cls.from_instances([x["instances"] for x in outputs])
+
+    @classmethod
+    def cat(cls, batches):
+        """
+        Concatenate the images of several batches, e.g. gathered from all ranks.
+        """
+        assert len(batches) > 0
+        counts = np.concatenate([np.diff(b.offsets) for b in batches])
+        return cls(
+            torch.cat([b.boxes for b in batches]),
+            torch.cat([b.scores for b in batches]),
+            torch.cat([b.classes for b in batches]),
+            np.cumsum(np.concatenate([[0], counts])),
+            [s for b in batches for s in b.image_sizes],
+        )
+
+    def __len__(self):
+        return len(self.image_sizes)
+
+    def __getitem__(self, i):
+        if self._instances is None:
+            self._instances = self.to_instances()
+        return {"instances": self._instances[i]}
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    @property
+    def num_detections(self):
+        """
+        ndarray: (N,) number of detections of every image.
+        """
+        return np.diff(self.offsets)
+
+    def image_inds(self):
+        """
+        Tensor: (D,) the image index of every detection.
+        """
+        return torch.repeat_interleave(
+            torch.arange(len(self), device=self.scores.device),
+            torch.as_tensor(self.num_detections, device=self.scores.device),
+        )
+
+    def to(self, device):
+        return DetectionBatch(
+            self.boxes.to(device),
+            self.scores.to(device),
+            self.classes.to(device),
+            self.offsets,
+            self.image_sizes,
+        )
+
+    def rescale(self, output_sizes):
+        """
+        Same as `detector_postprocess` on every image, in a few tensor ops: scale the
+        boxes from the network input size to `output_sizes`, clip them and drop the
+        empty ones.
+
+        Args:
+            output_sizes (list[tuple]): (height, width) of every original image.
+
+        Returns:
+            DetectionBatch: with `image_sizes` set to `output_sizes`.
+        """
+        device = self.boxes.device
+        image_sizes = np.asarray(self.image_sizes, dtype=np.float64).reshape(-1, 2)
+        output = np.asarray(output_sizes, dtype=np.float64).reshape(-1, 2)
+        image_inds = self.image_inds()
+        # (scale_x, scale_y) as the python floats `detector_postprocess` uses
+        scales = torch.as_tensor(
+            (output / image_sizes)[:, ::-1].copy(), dtype=self.boxes.dtype, device=device
+        )[image_inds]
+        sizes = torch.as_tensor(output, dtype=self.boxes.dtype, device=device)[image_inds]
+
+        boxes = self.boxes.view(-1, 2, 2) * scales[:, None, :]
+        boxes = torch.min(boxes.clamp(min=0), sizes.flip(1)[:, None, :]).view(-1, 4)
+        keep = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+
+        counts = torch.bincount(image_inds[keep], minlength=len(self)).cpu().numpy()
+        return DetectionBatch(
+            boxes[keep],
+            self.scores[keep],
+            self.classes[keep],
+            np.cumsum(np.concatenate([[0], counts])),
+            [tuple(int(x) for x in s) for s in output_sizes],
+        )
+
+    def to_instances(self):
+        """
+        Returns:
+            list[Instances]: one per image, whose fields are views of the columns.
+        """
+        counts = self.num_detections.tolist()
+        instances = []
+        for image_size, boxes, scores, classes in zip(
+            self.image_sizes,
+            self.boxes.split(counts),
+            self.scores.split(counts),
+            self.classes.split(counts),
+        ):
+            result = Instances(image_size)
+            result.pred_boxes = Boxes(boxes)
+            result.scores = scores
+            result.pred_classes = classes
+            instances.append(result)
+        return instances
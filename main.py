@@ -19,10 +19,16 @@ class Trainer(DefaultTrainer):
         evaluator_type = MetadataCatalog.get(dataset_name).evaluator_type
         if evaluator_type == "coco":
             from defrcn.evaluation import COCOEvaluator
-            evaluator_list.append(COCOEvaluator(dataset_name, True, output_folder))
+            evaluator_list.append(COCOEvaluator(
+                dataset_name, True, output_folder, cfg.TEST.COCO_EVAL_WORKERS, cfg.TEST.DIST_EVAL
+            ))
         if evaluator_type == "pascal_voc":
             from defrcn.evaluation import PascalVOCDetectionEvaluator
-            return PascalVOCDetectionEvaluator(dataset_name)
+            return PascalVOCDetectionEvaluator(
+                dataset_name,
+                output_folder if cfg.TEST.VOC_EXPORT_PREDICTIONS else None,
+                cfg.TEST.DIST_EVAL,
+            )
         if len(evaluator_list) == 0:
             raise NotImplementedError(
                 "no Evaluator for the dataset {} with the type {}".format(
@@ -0,0 +1,433 @@
+import copy
+import os
+import tempfile
+import threading
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import torch
+import torch.nn.functional as F
+from fvcore.common.config import CfgNode
+from detectron2.structures import Boxes, Instances
+
+from defrcn.evaluation import calibration_layer
+from defrcn.evaluation.archs.resnet import resnet18
+from defrcn.evaluation.calibration_layer import (
+    FeatureMapStore,
+    PrototypicalCalibrationBlock,
+    get_calibration_block,
+    kmeans,
+)
+from defrcn.evaluation.evaluator import DatasetEvaluator
+from defrcn.evaluation.pcb_sweep import PCBScoreRecorder, evaluate_calibration, load_pcb_scores
+
+
+def make_block(prototypes_dict, num_classes, exclude_cls=(), topk=1):
+    """A calibration block around a given prototype bank, without any model."""
+    pcb = PrototypicalCalibrationBlock.__new__(PrototypicalCalibrationBlock)
+    pcb.cfg = SimpleNamespace(
+        MODEL=SimpleNamespace(ROI_HEADS=SimpleNamespace(NUM_CLASSES=num_classes)),
+        DATASETS=SimpleNamespace(TRAIN=["support"]),
+        TEST=SimpleNamespace(PCB_TOPK=topk, PCB_UPPER=1.0, PCB_LOWER=0.05),
+    )
+    pcb.device = torch.device("cpu")
+    pcb.alpha = 0.5
+    pcb.exclude_cls = list(exclude_cls)
+    pcb.prototypes, pcb.prototype_index = pcb.build_prototype_matrix(prototypes_dict)
+    return pcb
+
+
+def random_detections(num_images, num_classes, max_detections=40):
+    dts = []
+    for _ in range(num_images):
+        n = int(torch.randint(0, max_detections, ()))
+        xy = torch.rand(n, 2) * 500
+        instances = Instances((800, 800))
+        instances.pred_boxes = Boxes(torch.cat([xy, xy + torch.rand(n, 2) * 200 + 1], dim=1))
+        instances.scores = torch.rand(n).sort(descending=True)[0]
+        instances.pred_classes = torch.randint(0, num_classes, (n,))
+        dts.append({"instances": instances})
+    return dts
+
+
+def stub_features(pcb, dim):
+    """Replace the feature extractor by a fixed function of each box."""
+    projection = torch.randn(4, dim)
+    pcb.test_conv_features = lambda inputs: [None] * len(inputs)
+    pcb.extract_roi_features = lambda conv_features, boxes: torch.tanh(
+        torch.cat([b.tensor for b in boxes]) / 100 @ projection
+    )
+    return projection
+
+
+class TestKMeans(unittest.TestCase):
+    def test_clusters_by_direction(self):
+        torch.manual_seed(0)
+        directions = F.normalize(torch.randn(2, 16), dim=1)
+        # direction 0 at norms 1 and 100, direction 1 at norm 1: by euclidean distance,
+        # the split would follow the norm instead of the direction
+        features = torch.cat([
+            directions[0] + torch.randn(10, 16) * 0.01,
+            (directions[0] + torch.randn(10, 16) * 0.01) * 100,
+            directions[1] + torch.randn(10, 16) * 0.01,
+        ])
+        centroids = kmeans(features, 2)
+        self.assertTrue(torch.allclose(centroids.norm(dim=1), torch.ones(2), atol=1e-5))
+        cos = torch.mm(centroids, directions.t())
+        self.assertGreater(float(cos.max(dim=1)[0].min()), 0.999)
+        self.assertEqual(sorted(cos.argmax(dim=1).tolist()), [0, 1])
+
+    def test_scale_invariant(self):
+        torch.manual_seed(1)
+        features = torch.randn(50, 8)
+        scaled = features * torch.rand(50, 1) * 10
+        self.assertTrue(torch.allclose(kmeans(features, 4), kmeans(scaled, 4), atol=1e-5))
+
+
+class TestClassSimilarity(unittest.TestCase):
+    def test_topk_matches_loop(self):
+        torch.manual_seed(2)
+        prototypes = {0: torch.randn(5, 8), 1: torch.randn(2, 8), 3: torch.randn(4, 8)}
+        pcb = make_block(prototypes, 5, exclude_cls=[3], topk=3)
+        classes = torch.randint(0, 5, (40,))
+        features = torch.randn(40, 8)
+        cos = pcb.class_similarity(classes, features)
+        for c, feature, result in zip(classes.tolist(), features, cos):
+            if c not in prototypes or c == 3:
+                self.assertTrue(torch.isnan(result))
+                continue
+            expected = F.cosine_similarity(feature[None], prototypes[c]).topk(min(3, len(prototypes[c])))[0]
+            self.assertAlmostEqual(float(result), float(expected.mean()), places=5)
+
+
+class TestExecuteCalibration(unittest.TestCase):
+    def test_matches_per_box_loop(self):
+        torch.manual_seed(3)
+        prototypes = {c: torch.randn(1, 16) for c in (0, 1, 2, 4)}
+        pcb = make_block(prototypes, 6, exclude_cls=[1])
+        projection = stub_features(pcb, 16)
+        dts = random_detections(5, 6)
+        expected = [dt["instances"].scores.clone() for dt in dts]
+        # the calibration of the baseline, one box at a time
+        for dt, scores in zip(dts, expected):
+            instances = dt["instances"]
+            for i in range(len(instances)):
+                c = int(instances.pred_classes[i])
+                if not 0.05 < scores[i] <= 1.0 or c == 1 or c not in prototypes:
+                    continue
+                feature = torch.tanh(instances.pred_boxes.tensor[i:i + 1] / 100 @ projection)
+                cos = F.cosine_similarity(feature, prototypes[c])[0]
+                scores[i] = scores[i] * 0.5 + cos * 0.5
+
+        similarities = []
+        pcb.execute_calibration([{}] * len(dts), dts, similarities)
+        for dt, scores, cos in zip(dts, expected, similarities):
+            self.assertTrue(torch.allclose(dt["instances"].scores, scores, atol=1e-6))
+            self.assertEqual(len(cos), len(scores))
+
+    def test_empty_bank_keeps_scores(self):
+        torch.manual_seed(4)
+        pcb = make_block({}, 6)
+        self.assertIsNone(pcb.prototypes)
+        dts = random_detections(3, 6)
+        expected = [dt["instances"].scores.clone() for dt in dts]
+        similarities = []
+        self.assertIs(pcb.execute_calibration([{}] * 3, dts, similarities), dts)
+        for dt, scores, cos in zip(dts, expected, similarities):
+            self.assertTrue(torch.equal(dt["instances"].scores, scores))
+            self.assertTrue(torch.isnan(cos).all())
+            self.assertEqual(len(cos), len(scores))
+
+
+class TestGetCalibrationBlock(unittest.TestCase):
+    def make_cfg(self, **pcb):
+        cfg = CfgNode({
+            "MODEL": {"DEVICE": "cpu", "ROI_HEADS": {"NUM_CLASSES": 20}},
+            "DATASETS": {"TRAIN": ["support"], "TEST": ["test"]},
+            "TEST": {"PCB_ALPHA": 0.5, "PCB_MODELTYPE": "resnet"},
+        })
+        cfg.TEST.update(pcb)
+        return cfg
+
+    def test_reused_across_evaluations(self):
+        with mock.patch.object(calibration_layer, "PrototypicalCalibrationBlock", side_effect=lambda cfg: object()), \
+                mock.patch.dict(calibration_layer._PCB_BLOCKS, clear=True):
+            block = get_calibration_block(self.make_cfg())
+            self.assertIs(get_calibration_block(self.make_cfg()), block)
+            # a change of any PCB setting builds another block
+            other = get_calibration_block(self.make_cfg(PCB_ALPHA=0.3))
+            self.assertIsNot(other, block)
+            self.assertIs(get_calibration_block(self.make_cfg()), block)
+            self.assertEqual(calibration_layer.PrototypicalCalibrationBlock.call_count, 2)
+
+
+class TestFeatureExtractor(unittest.TestCase):
+    def test_trunk_matches_resnet(self):
+        torch.manual_seed(8)
+        pcb = PrototypicalCalibrationBlock.__new__(PrototypicalCalibrationBlock)
+        pcb.device = torch.device("cpu")
+        pcb.imagenet_model = resnet18().eval()
+        # non-trivial batch norm statistics, for the conv/bn fusion of the trunk
+        for m in pcb.imagenet_model.modules():
+            if isinstance(m, torch.nn.BatchNorm2d):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 2.0)
+                m.weight.data.uniform_(0.5, 1.5)
+        images = torch.randn(2, 3, 160, 224)
+        with torch.no_grad():
+            expected = pcb.imagenet_model(images)[1]
+            for modeltype in ("resnet", "resnet_trunk"):
+                pcb.cfg = SimpleNamespace(TEST=SimpleNamespace(PCB_MODELTYPE=modeltype))
+                features = pcb.build_feature_extractor()(
+                    images.contiguous(memory_format=torch.channels_last)
+                )
+                self.assertEqual(features.shape, expected.shape)
+                self.assertTrue(torch.allclose(features, expected, rtol=1e-3, atol=1e-3))
+
+
+class TestPrototypeCache(unittest.TestCase):
+    def make_cached_block(self, cache_dir, prototypes_per_class=1):
+        pcb = PrototypicalCalibrationBlock.__new__(PrototypicalCalibrationBlock)
+        pcb.cfg = SimpleNamespace(
+            DATASETS=SimpleNamespace(TRAIN=["support"]),
+            TEST=SimpleNamespace(
+                PCB_CACHE_DIR=cache_dir, PCB_MODELTYPE="resnet", PCB_SUPPORT_MIN_SIZE=0,
+                PCB_SUPPORT_MAX_SIZE=1333, PCB_PROTOTYPES_PER_CLASS=prototypes_per_class,
+                PCB_BATCH_SIZE=8, PCB_QUANT_CALIB_BATCHES=4,
+            ),
+        )
+        pcb.model_hash = "0" * 40
+        pcb.built = 0
+
+        def build_prototypes():
+            pcb.built += 1
+            return {0: torch.randn(prototypes_per_class, 8), 3: torch.randn(prototypes_per_class, 8)}
+
+        pcb.build_prototypes = build_prototypes
+        return pcb
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            first = self.make_cached_block(cache_dir)
+            built = first.load_or_build_prototypes()
+            second = self.make_cached_block(cache_dir)
+            loaded = second.load_or_build_prototypes()
+            self.assertEqual((first.built, second.built), (1, 0))
+            self.assertEqual(sorted(loaded), sorted(built))
+            for label in built:
+                self.assertTrue(torch.equal(loaded[label], built[label]))
+
+            # other settings of the feature extractor miss the cache
+            other = self.make_cached_block(cache_dir, prototypes_per_class=2)
+            other.load_or_build_prototypes()
+            self.assertEqual(other.built, 1)
+
+    def test_disabled_without_cache_dir(self):
+        for _ in range(2):
+            pcb = self.make_cached_block("")
+            pcb.load_or_build_prototypes()
+            self.assertEqual(pcb.built, 1)
+
+
+class ThreadedRanks:
+    """
+    Stand-in for detectron2.utils.comm and the torch.distributed collectives that runs
+    one rank per thread of this process.
+    """
+
+    def __init__(self, world_size):
+        self.world_size = world_size
+        self.local = threading.local()
+        self.barrier = threading.Barrier(world_size, timeout=60)
+        self.slots = [None] * world_size
+
+    def get_world_size(self):
+        return self.world_size
+
+    def is_main_process(self):
+        return self.local.rank == 0
+
+    def all_gather(self, data, group=None):
+        self.slots[self.local.rank] = data
+        self.barrier.wait()
+        gathered = list(self.slots)
+        self.barrier.wait()
+        return gathered
+
+    def all_reduce(self, tensor):
+        tensor.copy_(sum(self.all_gather(tensor.clone())))
+
+    def run(self, fn):
+        """Return the results of `fn(rank)` on every rank."""
+        results, errors = [None] * self.world_size, []
+
+        def target(rank):
+            self.local.rank = rank
+            try:
+                results[rank] = fn(rank)
+            except Exception as e:
+                errors.append(e)
+                self.barrier.abort()
+
+        threads = [threading.Thread(target=target, args=(r,)) for r in range(self.world_size)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+        return results
+
+
+class TestShardedPrototypes(unittest.TestCase):
+    def make_support_block(self, features, labels, prototypes_per_class, rank=0, world_size=1):
+        """A block whose support loader yields the boxes of this rank's shard, as InferenceSampler splits them."""
+        pcb = PrototypicalCalibrationBlock.__new__(PrototypicalCalibrationBlock)
+        pcb.cfg = SimpleNamespace(
+            MODEL=SimpleNamespace(ROI_HEADS=SimpleNamespace(NUM_CLASSES=6)),
+            TEST=SimpleNamespace(PCB_PROTOTYPES_PER_CLASS=prototypes_per_class),
+        )
+        pcb.device = torch.device("cpu")
+        pcb.imagenet_model = SimpleNamespace(fc=SimpleNamespace(out_features=features.shape[1]))
+        shard_size = (len(features) - 1) // world_size + 1
+        begin = min(shard_size * rank, len(features))
+        shard = range(begin, min(begin + shard_size, len(features)))
+
+        def support_roi_features():
+            for start in range(shard.start, shard.stop, 3):
+                batch = slice(start, min(start + 3, shard.stop))
+                yield features[batch], labels[batch]
+
+        pcb.support_roi_features = support_roi_features
+        return pcb
+
+    def check_ranks_match_single_process(self, prototypes_per_class, world_size):
+        features = torch.randn(20, 8)
+        labels = torch.tensor([0, 2, 2, 5, 0, 2, 5, 5, 0, 2, 2, 0, 5, 2, 2, 0, 2, 5, 2, 2])
+        expected = self.make_support_block(features, labels, prototypes_per_class).build_prototypes()
+        ranks = ThreadedRanks(world_size)
+        with mock.patch.object(calibration_layer, "comm", ranks), \
+                mock.patch.object(torch.distributed, "all_reduce", ranks.all_reduce), \
+                mock.patch.object(torch.distributed, "get_backend", lambda: "gloo"):
+            results = ranks.run(lambda rank: self.make_support_block(
+                features, labels, prototypes_per_class, rank, world_size
+            ).build_prototypes())
+        for prototypes in results:
+            self.assertEqual(sorted(prototypes), sorted(expected))
+            for label in expected:
+                # identical on every rank, and equal to one process up to the order of the sums
+                self.assertTrue(torch.equal(prototypes[label], results[0][label]))
+                self.assertTrue(torch.allclose(prototypes[label], expected[label], atol=1e-6))
+
+    def test_mean_prototypes(self):
+        torch.manual_seed(5)
+        # uneven shards, and more ranks than boxes of some class
+        for world_size in (2, 3, 8):
+            self.check_ranks_match_single_process(1, world_size)
+
+    def test_prototype_bank(self):
+        torch.manual_seed(6)
+        # a rank without support boxes when there are more ranks than boxes
+        for world_size in (2, 3, 24):
+            self.check_ranks_match_single_process(3, world_size)
+
+
+class TestLoadImage(unittest.TestCase):
+    def test_original_image_in_bgr(self):
+        pcb = PrototypicalCalibrationBlock.__new__(PrototypicalCalibrationBlock)
+        pcb.device = torch.device("cpu")
+        bgr = torch.randint(0, 256, (3, 40, 60), dtype=torch.uint8)
+        for image_format, image in (("BGR", bgr), ("RGB", bgr[[2, 1, 0]])):
+            pcb.cfg = SimpleNamespace(INPUT=SimpleNamespace(FORMAT=image_format))
+            self.assertTrue(torch.equal(pcb.load_image({"original_image": image}), bgr))
+
+
+class TestFeatureMapStore(unittest.TestCase):
+    def make_block(self, store):
+        pcb = PrototypicalCalibrationBlock.__new__(PrototypicalCalibrationBlock)
+        pcb.device = torch.device("cpu")
+        pcb.feature_store = store
+        pcb.load_image = lambda input: input["image"]
+
+        def extract_conv_features(images):
+            # a stride-32 map of the padded batch where every cell only depends on its own pixel
+            h, w = max(x.shape[1] for x in images), max(x.shape[2] for x in images)
+            batch = torch.stack([F.pad(x, (0, w - x.shape[2], 0, h - x.shape[1])) for x in images])
+            return batch[:, :, ::32, ::32]
+
+        pcb.extract_conv_features = extract_conv_features
+        return pcb
+
+    def test_cached_maps_match_computed(self):
+        torch.manual_seed(7)
+        sizes = [(300, 500), (480, 260), (33, 64), (300, 500)]
+        inputs = [
+            {"image_id": i, "file_name": "{}.jpg".format(i), "image": torch.randn(3, h, w)}
+            for i, (h, w) in enumerate(sizes)
+        ]
+        # each image alone, without a store
+        expected = [self.make_block(None).test_conv_features([x])[0] for x in inputs]
+        with tempfile.TemporaryDirectory() as root:
+            store = FeatureMapStore(root)
+            pcb = self.make_block(store)
+            computed = pcb.test_conv_features(inputs[:3])
+            pcb.extract_conv_features = None
+            # cached maps, read back into batches of other images and sizes
+            cached = pcb.test_conv_features(inputs[2::-1])[::-1]
+            pcb.feature_store = FeatureMapStore(root)
+            self.assertIsNone(pcb.feature_store.get(inputs[3]))
+        for i in range(3):
+            self.assertEqual(computed[i].shape, expected[i].shape)
+            self.assertTrue(torch.equal(computed[i], expected[i]))
+            self.assertTrue(torch.equal(cached[i], expected[i].half().float()))
+
+
+class RecordingEvaluator(DatasetEvaluator):
+    def reset(self):
+        self.detections = None
+
+    def process_detections(self, inputs, detections):
+        self.image_ids = [x["image_id"] for x in inputs]
+        self.detections = detections
+
+    def evaluate(self):
+        return {}
+
+
+class TestCalibrationReplay(unittest.TestCase):
+    def test_replay_matches_calibration(self):
+        torch.manual_seed(0)
+        pcb = make_block({c: torch.randn(2, 16) for c in (0, 1, 2, 4)}, 6, exclude_cls=[1], topk=2)
+        stub_features(pcb, 16)
+        dts = random_detections(6, 6)
+        inputs = [{"image_id": 10 + i} for i in range(len(dts))]
+
+        # record once, with the settings of the test run
+        recorded = copy.deepcopy(dts)
+        scores = [dt["instances"].scores.clone() for dt in recorded]
+        similarities = []
+        pcb.execute_calibration(inputs, recorded, similarities)
+        recorder = PCBScoreRecorder("test")
+        recorder.process(inputs, dts, scores, similarities)
+
+        with tempfile.TemporaryDirectory() as root:
+            path = os.path.join(root, "pcb_scores_test.npz")
+            recorder.save(path)
+            records = load_pcb_scores(path)
+
+        evaluator = RecordingEvaluator()
+        for alpha, upper, lower in [(0.5, 1.0, 0.05), (0.2, 0.8, 0.3), (0.9, 1.0, 0.0)]:
+            pcb.alpha = alpha
+            pcb.cfg.TEST.PCB_UPPER, pcb.cfg.TEST.PCB_LOWER = upper, lower
+            expected = pcb.execute_calibration(inputs, copy.deepcopy(dts))
+            evaluate_calibration(evaluator, records, alpha, upper, lower)
+            self.assertEqual(evaluator.image_ids, [x["image_id"] for x in inputs])
+            for dt, output in zip(expected, evaluator.detections.to_instances()):
+                self.assertTrue(torch.allclose(output.scores, dt["instances"].scores, atol=1e-6))
+                self.assertTrue(torch.equal(output.pred_classes, dt["instances"].pred_classes))
+                self.assertTrue(torch.equal(output.pred_boxes.tensor, dt["instances"].pred_boxes.tensor))
+
+
+if __name__ == "__main__":
+    unittest.main()
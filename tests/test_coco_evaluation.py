@@ -0,0 +1,195 @@
+import contextlib
+import io
+import unittest
+
+import numpy as np
+import torch
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+from detectron2.structures import Boxes, Instances
+
+from defrcn.evaluation.coco_evaluation import (
+    _accumulate_coco_shards,
+    _evaluate_coco_shard,
+    _evaluate_predictions_on_coco,
+    _evaluate_splits_on_coco,
+    coco_array_to_json,
+    instances_to_coco_json,
+    results_to_coco_array,
+)
+from defrcn.structures import DetectionBatch
+
+CATEGORIES = [1, 3, 5, 8]
+
+
+def make_coco(rng, num_images, tie_decimals=None):
+    """
+    A random COCO ground truth with crowd boxes, and detections around it in the
+    (D, 7) array format of `COCO.loadRes`. With `tie_decimals`, scores are rounded
+    so that many of them are tied.
+    """
+    images = [{"id": i + 1, "width": 640, "height": 480} for i in range(num_images)]
+    annotations, detections = [], []
+    for image in images:
+        for _ in range(rng.randint(0, 6)):
+            x, y = rng.rand(2) * [500, 380]
+            w, h = rng.rand(2) * [140, 100] + 4
+            category = int(rng.choice(CATEGORIES))
+            annotations.append({
+                "id": len(annotations) + 1, "image_id": image["id"], "category_id": category,
+                "bbox": [x, y, w, h], "area": w * h, "iscrowd": int(rng.rand() < 0.05),
+            })
+            for _ in range(rng.randint(0, 3)):
+                jitter = rng.randn(4) * 6
+                detections.append([
+                    image["id"], x + jitter[0], y + jitter[1], max(w + jitter[2], 1),
+                    max(h + jitter[3], 1), rng.rand(),
+                    category if rng.rand() < 0.85 else int(rng.choice(CATEGORIES)),
+                ])
+        for _ in range(rng.randint(0, 4)):
+            x, y = rng.rand(2) * [500, 380]
+            detections.append([image["id"], x, y, 40, 30, rng.rand() * 0.5, int(rng.choice(CATEGORIES))])
+    detections = np.asarray(detections, dtype=np.float64).reshape(-1, 7)
+    if tie_decimals is not None:
+        detections[:, 5] = detections[:, 5].round(tie_decimals)
+
+    coco_gt = COCO()
+    coco_gt.dataset = {
+        "images": images,
+        "annotations": annotations,
+        "categories": [{"id": c, "name": str(c)} for c in CATEGORIES],
+    }
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_gt.createIndex()
+    return coco_gt, detections
+
+
+def reference_coco_eval(coco_gt, coco_results, catIds=None):
+    """A plain COCOeval run, restricted to `catIds`."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_eval = COCOeval(coco_gt, coco_gt.loadRes(coco_results), "bbox")
+        if catIds is not None:
+            coco_eval.params.catIds = catIds
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    return coco_eval
+
+
+class COCOTestCase(unittest.TestCase):
+    def assertEvalEqual(self, coco_eval, expected):
+        np.testing.assert_array_equal(coco_eval.stats, expected.stats)
+        for k in ("precision", "recall", "scores"):
+            np.testing.assert_array_equal(coco_eval.eval[k], expected.eval[k])
+
+
+class TestCOCOArray(COCOTestCase):
+    def test_matches_instances_to_coco_json(self):
+        coco_gt, coco_results = make_coco(np.random.RandomState(8), 40)
+        # the same detections, as the per image Instances of a model
+        outputs = []
+        for image_id in coco_gt.getImgIds():
+            rows = coco_results[coco_results[:, 0] == image_id]
+            instances = Instances((480, 640))
+            xyxy = np.concatenate([rows[:, 1:3], rows[:, 1:3] + rows[:, 3:5]], axis=1)
+            instances.pred_boxes = Boxes(torch.tensor(xyxy, dtype=torch.float32))
+            instances.scores = torch.tensor(rows[:, 5], dtype=torch.float32)
+            instances.pred_classes = torch.tensor(rows[:, 6], dtype=torch.int64)
+            outputs.append((image_id, instances))
+
+        detections = DetectionBatch.from_instances([x for _, x in outputs])
+        array = results_to_coco_array(
+            np.repeat([i for i, _ in outputs], detections.num_detections),
+            detections.boxes.numpy(),
+            detections.scores.numpy(),
+            detections.classes.numpy(),
+        )
+        dicts = [r for image_id, x in outputs for r in instances_to_coco_json(x, image_id)]
+        self.assertEqual(coco_array_to_json(array), dicts)
+        self.assertEvalEqual(
+            reference_coco_eval(coco_gt, array), reference_coco_eval(coco_gt, dicts)
+        )
+
+
+class TestSplitsOnCOCO(COCOTestCase):
+    def test_matches_separate_evaluations(self):
+        for seed in range(3):
+            coco_gt, coco_results = make_coco(np.random.RandomState(seed), 100)
+            # all categories, a subset in any order, and one with an unknown id
+            split_catIds = [None, [8, 3], [1, 5, 99]]
+            with contextlib.redirect_stdout(io.StringIO()):
+                coco_evals = _evaluate_splits_on_coco(coco_gt, coco_results, "bbox", split_catIds)
+            for catIds, coco_eval in zip(split_catIds, coco_evals):
+                self.assertEvalEqual(coco_eval, reference_coco_eval(coco_gt, coco_results, catIds))
+
+
+class TestParallelCOCOEval(COCOTestCase):
+    def test_matches_serial(self):
+        coco_gt, coco_results = make_coco(np.random.RandomState(3), 100, tie_decimals=2)
+        expected = reference_coco_eval(coco_gt, coco_results)
+        # more workers than categories, and a worker with several categories
+        for num_workers in (2, 3, 8):
+            with contextlib.redirect_stdout(io.StringIO()):
+                coco_eval = _evaluate_predictions_on_coco(
+                    coco_gt, coco_results, "bbox", num_workers=num_workers
+                )
+            self.assertEvalEqual(coco_eval, expected)
+
+    def test_splits_match_serial(self):
+        coco_gt, coco_results = make_coco(np.random.RandomState(4), 80)
+        split_catIds = [None, [3, 8], [1, 5]]
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = _evaluate_splits_on_coco(coco_gt, coco_results, "bbox", split_catIds)
+            coco_evals = _evaluate_splits_on_coco(
+                coco_gt, coco_results, "bbox", split_catIds, num_workers=3
+            )
+        for coco_eval, expected_eval in zip(coco_evals, expected):
+            self.assertEvalEqual(coco_eval, expected_eval)
+
+
+class TestCOCOShards(COCOTestCase):
+    def check_shards_match_single_process(self, coco_gt, coco_results, rank_imgIds):
+        split_catIds = [[1, 3, 5, 8], [3, 8], [1, 5]]
+        with contextlib.redirect_stdout(io.StringIO()):
+            expected = _evaluate_splits_on_coco(coco_gt, coco_results, "bbox", split_catIds)
+            shards = [
+                _evaluate_coco_shard(
+                    coco_gt, coco_results[np.isin(coco_results[:, 0], imgIds)], "bbox",
+                    imgIds, [1, 3, 5, 8],
+                )
+                for imgIds in rank_imgIds
+            ]
+            coco_evals = _accumulate_coco_shards(coco_gt, shards, "bbox", split_catIds)
+        for coco_eval, expected_eval in zip(coco_evals, expected):
+            self.assertEvalEqual(coco_eval, expected_eval)
+
+    def test_matches_single_process(self):
+        coco_gt, coco_results = make_coco(np.random.RandomState(5), 90)
+        imgIds = sorted(coco_gt.getImgIds())
+        # uneven ranks, with an empty one
+        self.check_shards_match_single_process(
+            coco_gt, coco_results, [imgIds[:30], [], imgIds[30:75], imgIds[75:]]
+        )
+        # one rank
+        self.check_shards_match_single_process(coco_gt, coco_results, [imgIds])
+
+    def test_tied_scores(self):
+        coco_gt, coco_results = make_coco(np.random.RandomState(6), 90, tie_decimals=1)
+        imgIds = sorted(coco_gt.getImgIds())
+        # interleaved ranks, so that the tied detections of a category span several ranks
+        self.check_shards_match_single_process(
+            coco_gt, coco_results, [imgIds[r::3] for r in range(3)]
+        )
+
+    def test_images_evaluated_by_no_rank(self):
+        coco_gt, coco_results = make_coco(np.random.RandomState(7), 60)
+        imgIds = sorted(coco_gt.getImgIds())
+        # ground truth images without detections that no rank received
+        coco_results = coco_results[np.isin(coco_results[:, 0], imgIds[:50])]
+        self.check_shards_match_single_process(
+            coco_gt, coco_results, [imgIds[:20], imgIds[20:50]]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
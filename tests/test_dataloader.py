@@ -0,0 +1,39 @@
+import unittest
+
+import numpy as np
+
+from defrcn.dataloader.build import InferenceGroupedBatchSampler
+
+
+class TestInferenceGroupedBatchSampler(unittest.TestCase):
+    def test_batches_by_group(self):
+        rng = np.random.RandomState(0)
+        group_ids = rng.randint(2, size=100).tolist()
+        # the shard of one rank, as InferenceSampler gives it
+        sampler = list(range(13, 61))
+        for batch_size in (1, 2, 4, 7, 100):
+            batch_sampler = InferenceGroupedBatchSampler(sampler, group_ids, batch_size)
+            batches = list(batch_sampler)
+            self.assertEqual(len(batches), len(batch_sampler))
+            # nothing is dropped or repeated
+            self.assertEqual(sorted(i for b in batches for i in b), sampler)
+            for batch in batches:
+                self.assertLessEqual(len(batch), batch_size)
+                self.assertEqual(len({group_ids[i] for i in batch}), 1)
+            # the sampler order is kept within each group
+            for group in (0, 1):
+                order = [i for b in batches for i in b if group_ids[i] == group]
+                self.assertEqual(order, [i for i in sampler if group_ids[i] == group])
+            # only the last batch of each group can be partial
+            partial = [b for b in batches if len(b) < batch_size]
+            self.assertLessEqual(len(partial), 2)
+            self.assertEqual(batches[len(batches) - len(partial):], partial)
+
+    def test_batch_size_one_keeps_sampler_order(self):
+        group_ids = [0, 1, 1, 0, 1, 0, 0]
+        batches = list(InferenceGroupedBatchSampler(range(7), group_ids, 1))
+        self.assertEqual(batches, [[i] for i in range(7)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import unittest
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+from detectron2.modeling.postprocessing import detector_postprocess
+from detectron2.structures import Boxes, Instances
+
+from defrcn.evaluation.evaluator import DatasetEvaluator, inference_on_dataset
+from defrcn.structures import DetectionBatch
+
+
+def random_instances(num_images, max_detections=30):
+    instances = []
+    for _ in range(num_images):
+        h, w = torch.randint(300, 900, (2,)).tolist()
+        n = int(torch.randint(0, max_detections, ()))
+        xy = torch.rand(n, 2) * torch.tensor([w, h]) * 1.1 - 20
+        result = Instances((h, w))
+        # some boxes are degenerate and are dropped once clipped
+        result.pred_boxes = Boxes(torch.cat([xy, xy + torch.rand(n, 2) * 200], dim=1))
+        result.scores = torch.rand(n)
+        result.pred_classes = torch.randint(0, 20, (n,))
+        instances.append(result)
+    return instances
+
+
+class TestDetectionBatch(unittest.TestCase):
+    def test_rescale_matches_detector_postprocess(self):
+        torch.manual_seed(0)
+        instances = random_instances(6)
+        output_sizes = [(int(torch.randint(200, 1500, ())), int(torch.randint(200, 1500, ())))
+                        for _ in instances]
+        batch = DetectionBatch.from_instances(instances).rescale(output_sizes)
+        for result, output_size, expected in zip(batch.to_instances(), output_sizes, instances):
+            expected = detector_postprocess(expected, *output_size)
+            self.assertEqual(result.image_size, output_size)
+            self.assertTrue(torch.equal(result.pred_boxes.tensor, expected.pred_boxes.tensor))
+            self.assertTrue(torch.equal(result.scores, expected.scores))
+            self.assertTrue(torch.equal(result.pred_classes, expected.pred_classes))
+
+    def test_sequence_of_outputs(self):
+        torch.manual_seed(1)
+        instances = random_instances(3)
+        batch = DetectionBatch.from_instances(instances)
+        self.assertEqual(len(list(batch)), 3)
+        for output, expected in zip(batch, instances):
+            self.assertTrue(torch.equal(output["instances"].scores, expected.scores))
+        # in-place updates of the per-image scores are seen by the columns
+        batch[1]["instances"].scores[:] = -1
+        self.assertTrue((batch.scores[batch.offsets[1]:batch.offsets[2]] == -1).all())
+        self.assertTrue(torch.equal(DetectionBatch.from_outputs(batch).scores, batch.scores))
+
+
+class RecordingEvaluator(DatasetEvaluator):
+    def reset(self):
+        self.calls = []
+
+    def process(self, inputs, outputs):
+        self.calls.append("process")
+
+    def process_detections(self, inputs, detections):
+        self.calls.append("process_detections")
+
+    def evaluate(self):
+        return {}
+
+
+class BatchModel(nn.Module):
+    def __init__(self, return_batch):
+        super().__init__()
+        self.return_batch = return_batch
+
+    def forward(self, inputs):
+        batch = DetectionBatch.from_instances(random_instances(len(inputs)))
+        return batch if self.return_batch else list(batch)
+
+
+class TestInferenceOnDataset(unittest.TestCase):
+    def test_detection_batches_go_to_process_detections(self):
+        cfg = SimpleNamespace(TEST=SimpleNamespace(PCB_ENABLE=False))
+        data_loader = [[{"image_id": 0}, {"image_id": 1}], [{"image_id": 2}]]
+        for return_batch, expected in [(True, "process_detections"), (False, "process")]:
+            evaluator = RecordingEvaluator()
+            inference_on_dataset(BatchModel(return_batch), data_loader, evaluator, cfg)
+            self.assertEqual(evaluator.calls, [expected] * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
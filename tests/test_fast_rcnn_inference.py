@@ -0,0 +1,207 @@
+import unittest
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+from detectron2.modeling.box_regression import Box2BoxTransform
+from detectron2.structures import Boxes, Instances
+
+from defrcn.modeling.roi_heads import ROIHeads
+from defrcn.modeling.roi_heads.fast_rcnn import (
+    FastRCNNOutputLayers,
+    FastRCNNOutputs,
+    fast_rcnn_inference,
+    fast_rcnn_inference_single_image,
+)
+
+
+def random_proposals(num_images, num_boxes):
+    proposals = []
+    for _ in range(num_images):
+        h, w = torch.randint(400, 1333, (2,)).tolist()
+        xy = torch.rand(num_boxes, 2) * torch.tensor([w, h])
+        wh = torch.rand(num_boxes, 2) * torch.tensor([w, h]) / 3 + 1
+        instances = Instances((h, w))
+        instances.proposal_boxes = Boxes(torch.cat([xy, xy + wh], dim=1))
+        proposals.append(instances)
+    return proposals
+
+
+def random_predictions(num_images, num_boxes, num_classes, max_size, agnostic=False):
+    boxes, scores, image_shapes = [], [], []
+    for _ in range(num_images):
+        h, w = torch.randint(max_size // 2, max_size, (2,)).tolist()
+        xy = torch.rand(num_boxes, 1, 2) * torch.tensor([w, h])
+        wh = torch.rand(num_boxes, 1, 2) * torch.tensor([w, h]) / 4 + 1
+        jitter = torch.randn(num_boxes, 1 if agnostic else num_classes, 4) * 3
+        boxes.append((torch.cat([xy, xy + wh], dim=2) + jitter).flatten(1))
+        # unique scores, so that the result does not depend on how ties are broken
+        probs = torch.randperm(num_boxes * (num_classes + 1)).float() + 1
+        probs = probs.view(num_boxes, num_classes + 1)
+        scores.append(probs / probs.sum(dim=1, keepdim=True))
+        image_shapes.append((h, w))
+    return boxes, scores, image_shapes
+
+
+class TestBatchedFastRCNNInference(unittest.TestCase):
+    def check_equal_to_single_image(self, *args, nms_type="greedy", pre_nms_topk=0, **kwargs):
+        boxes, scores, image_shapes = random_predictions(*args, **kwargs)
+        for topk in (-1, 50):
+            results, kept_indices = fast_rcnn_inference(
+                boxes, scores, image_shapes, 0.005, 0.5, topk, pre_nms_topk, nms_type=nms_type
+            )
+            for i, image_shape in enumerate(image_shapes):
+                expected, expected_inds = fast_rcnn_inference_single_image(
+                    boxes[i], scores[i], image_shape, 0.005, 0.5, topk, pre_nms_topk, nms_type=nms_type
+                )
+                self.assertTrue(torch.equal(results[i].pred_boxes.tensor, expected.pred_boxes.tensor))
+                self.assertTrue(torch.equal(results[i].scores, expected.scores))
+                self.assertTrue(torch.equal(results[i].pred_classes, expected.pred_classes))
+                self.assertTrue(torch.equal(kept_indices[i], expected_inds))
+
+    def test_multi_image_batches(self):
+        torch.manual_seed(0)
+        for _ in range(30):
+            self.check_equal_to_single_image(4, 240, 3, 1333)
+
+    def test_many_classes(self):
+        torch.manual_seed(1)
+        for _ in range(5):
+            self.check_equal_to_single_image(8, 100, 20, 1333)
+
+    def test_class_agnostic(self):
+        torch.manual_seed(2)
+        for _ in range(5):
+            self.check_equal_to_single_image(4, 240, 3, 1333, agnostic=True)
+
+    def test_nms_types(self):
+        torch.manual_seed(3)
+        for nms_type in ("fast", "matrix"):
+            self.check_equal_to_single_image(4, 120, 3, 800, nms_type=nms_type)
+
+    def test_pre_nms_topk(self):
+        torch.manual_seed(4)
+        for pre_nms_topk in (1, 100, 10000):
+            self.check_equal_to_single_image(4, 240, 3, 1333, pre_nms_topk=pre_nms_topk)
+        self.check_equal_to_single_image(4, 240, 3, 1333, agnostic=True, pre_nms_topk=100)
+
+    def test_pre_nms_topk_drops_lower_candidates(self):
+        torch.manual_seed(5)
+        boxes, scores, image_shapes = random_predictions(1, 240, 3, 1333)
+        boxes, scores = boxes[0], scores[0]
+        # the cap is the same as the score threshold of the 100th best candidate
+        fg_scores = scores[:, :-1]
+        cutoff = fg_scores[fg_scores > 0.005].sort(descending=True)[0][99]
+        masked = scores.clone()
+        masked[:, :-1] = fg_scores.masked_fill(fg_scores < cutoff, 0)
+        result, kept = fast_rcnn_inference_single_image(
+            boxes, scores, image_shapes[0], 0.005, 0.5, -1, 100
+        )
+        expected, expected_kept = fast_rcnn_inference_single_image(
+            boxes, masked, image_shapes[0], 0.005, 0.5, -1
+        )
+        self.assertTrue(torch.equal(result.pred_boxes.tensor, expected.pred_boxes.tensor))
+        self.assertTrue(torch.equal(result.scores, expected.scores))
+        self.assertTrue(torch.equal(result.pred_classes, expected.pred_classes))
+        self.assertTrue(torch.equal(kept, expected_kept))
+
+    def test_empty_image(self):
+        boxes, scores, image_shapes = random_predictions(3, 20, 3, 800)
+        scores[1] = torch.zeros_like(scores[1])
+        results, kept_indices = fast_rcnn_inference(boxes, scores, image_shapes, 0.005, 0.5, -1)
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(results[1]), 0)
+        self.assertEqual(len(kept_indices[1]), 0)
+
+
+class TestFastRCNNOutputsInference(unittest.TestCase):
+    def check_equal_to_single_image(self, num_images, num_boxes, num_classes, agnostic=False, pre_nms_topk=0):
+        proposals = random_proposals(num_images, num_boxes)
+        num_rois = num_images * num_boxes
+        # unique logits, so that the result does not depend on how ties are broken
+        logits = torch.randperm(num_rois * (num_classes + 1)).float() / num_rois
+        deltas = torch.randn(num_rois, 4 if agnostic else 4 * num_classes) * 0.5
+        outputs = FastRCNNOutputs(
+            Box2BoxTransform((10.0, 10.0, 5.0, 5.0)),
+            logits.view(num_rois, num_classes + 1),
+            deltas,
+            proposals,
+            0.0,
+        )
+
+        results, kept_indices = outputs.inference(0.05, 0.5, 100, pre_nms_topk)
+        for i, (boxes, scores) in enumerate(zip(outputs.predict_boxes(), outputs.predict_probs())):
+            expected, expected_inds = fast_rcnn_inference_single_image(
+                boxes, scores, proposals[i].image_size, 0.05, 0.5, 100, pre_nms_topk
+            )
+            self.assertTrue(torch.equal(results[i].pred_boxes.tensor, expected.pred_boxes.tensor))
+            self.assertTrue(torch.equal(results[i].scores, expected.scores))
+            self.assertTrue(torch.equal(results[i].pred_classes, expected.pred_classes))
+            self.assertTrue(torch.equal(kept_indices[i], expected_inds))
+
+    def test_class_specific(self):
+        torch.manual_seed(0)
+        for _ in range(10):
+            self.check_equal_to_single_image(4, 300, 5)
+
+    def test_class_agnostic(self):
+        torch.manual_seed(1)
+        for _ in range(10):
+            self.check_equal_to_single_image(4, 300, 5, agnostic=True)
+
+    def test_pre_nms_topk(self):
+        torch.manual_seed(2)
+        for _ in range(5):
+            self.check_equal_to_single_image(4, 300, 5, pre_nms_topk=50)
+            self.check_equal_to_single_image(4, 300, 5, agnostic=True, pre_nms_topk=50)
+
+
+class TestClassSubset(unittest.TestCase):
+    def check_subset_matches_filtered(self, class_ids, agnostic):
+        num_classes = 6
+        cfg = SimpleNamespace(MODEL=SimpleNamespace(
+            ROI_HEADS=SimpleNamespace(CLS_DROPOUT=False, DROPOUT_RATIO=0.0)
+        ))
+        heads = ROIHeads.__new__(ROIHeads)
+        nn.Module.__init__(heads)
+        heads.box_predictor = FastRCNNOutputLayers(cfg, 32, num_classes, agnostic).eval()
+        nn.init.normal_(heads.box_predictor.cls_score.weight, std=1.0)
+        nn.init.normal_(heads.box_predictor.bbox_pred.weight, std=0.1)
+        proposals = random_proposals(3, 200)
+        features = torch.randn(600, 32)
+
+        def run():
+            outputs = FastRCNNOutputs(
+                Box2BoxTransform((10.0, 10.0, 5.0, 5.0)),
+                *heads.box_predictor(features),
+                proposals,
+                0.0,
+            )
+            results, _ = outputs.inference(0.05, 0.5, 1000)
+            return heads._map_class_subset(results)
+
+        heads.set_class_subset(None)
+        full = run()
+        heads.set_class_subset(class_ids)
+        subset = run()
+        for result, expected in zip(subset, full):
+            keep = (expected.pred_classes[:, None] == torch.tensor(class_ids)).any(dim=1)
+            self.assertTrue(torch.equal(result.pred_classes, expected.pred_classes[keep]))
+            self.assertTrue(torch.allclose(result.scores, expected.scores[keep], atol=1e-6))
+            self.assertTrue(torch.allclose(
+                result.pred_boxes.tensor, expected.pred_boxes.tensor[keep], atol=1e-3
+            ))
+        self.assertGreater(sum(len(r) for r in subset), 0)
+
+    def test_class_specific(self):
+        torch.manual_seed(0)
+        self.check_subset_matches_filtered([1, 4], agnostic=False)
+        self.check_subset_matches_filtered([5], agnostic=False)
+
+    def test_class_agnostic(self):
+        torch.manual_seed(1)
+        self.check_subset_matches_filtered([0, 2, 3], agnostic=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import unittest
+
+import torch
+from detectron2.structures import Boxes, pairwise_iou
+
+from defrcn.modeling.roi_heads.fast_rcnn import (
+    _same_group_overlaps,
+    batched_fast_nms,
+    batched_matrix_nms,
+    batched_nms_by_type,
+)
+
+
+def random_boxes(num_boxes, num_groups):
+    xy = torch.rand(num_boxes, 2) * 200
+    boxes = torch.cat([xy, xy + torch.rand(num_boxes, 2) * 80 + 1], dim=1)
+    return boxes, torch.rand(num_boxes), torch.randint(0, num_groups, (num_boxes,)) * 7
+
+
+class TestMatrixNMS(unittest.TestCase):
+    def setUp(self):
+        # two heavily overlapping low-scoring boxes and a distant one, all of class 0
+        self.boxes = torch.tensor(
+            [[0, 0, 10, 10], [0, 0, 10, 11], [50, 50, 60, 60]], dtype=torch.float32
+        )
+        self.scores = torch.tensor([0.06, 0.055, 0.06])
+        self.idxs = torch.zeros(3, dtype=torch.int64)
+
+    def test_decayed_below_threshold_removed(self):
+        keep, decayed = batched_matrix_nms(
+            self.boxes, self.scores, self.idxs, score_thresh=0.05
+        )
+        self.assertLess(decayed[1].item(), 0.05)
+        self.assertEqual(sorted(keep.tolist()), [0, 2])
+        self.assertTrue((decayed[keep] > 0.05).all())
+
+    def test_no_threshold_keeps_all(self):
+        keep, decayed = batched_matrix_nms(self.boxes, self.scores, self.idxs)
+        self.assertEqual(sorted(keep.tolist()), [0, 1, 2])
+        self.assertTrue(torch.equal(decayed[keep], decayed[keep].sort(descending=True)[0]))
+
+    def test_other_groups_untouched(self):
+        idxs = torch.tensor([0, 1, 0])
+        keep, decayed = batched_nms_by_type(
+            self.boxes, self.scores, idxs, 0.5, "matrix", score_thresh=0.05
+        )
+        self.assertEqual(sorted(keep.tolist()), [0, 1, 2])
+        self.assertTrue(torch.allclose(decayed, self.scores))
+
+
+class TestSameGroupOverlaps(unittest.TestCase):
+    def test_matches_dense_reference(self):
+        torch.manual_seed(0)
+        for num_boxes in (0, 1, 50, 400):
+            boxes, scores, idxs = random_boxes(num_boxes, 10)
+            order, max_iou, decay = _same_group_overlaps(boxes, scores, idxs, sigma=2.0)
+            self.assertTrue(torch.equal(order, scores.argsort(descending=True)))
+            if num_boxes == 0:
+                continue
+            # IoU with every higher scoring box of the same group, over the whole set
+            b, g = boxes[order], idxs[order]
+            iou = pairwise_iou(Boxes(b), Boxes(b)).triu(diagonal=1)
+            iou = iou * (g[:, None] == g[None, :])
+            expected_max = iou.max(dim=0)[0]
+            expected_decay = torch.exp(-2.0 * (iou ** 2 - expected_max[:, None] ** 2)).min(dim=0)[0]
+            self.assertTrue(torch.allclose(max_iou, expected_max, atol=1e-6))
+            self.assertTrue(torch.allclose(decay, expected_decay, atol=1e-6))
+            self.assertTrue(torch.equal(
+                batched_fast_nms(boxes, scores, idxs, 0.5), order[expected_max <= 0.5]
+            ))
+
+    def test_slices_match_single_op(self):
+        torch.manual_seed(1)
+        boxes, scores, idxs = random_boxes(500, 30)
+        expected = _same_group_overlaps(boxes, scores, idxs, sigma=2.0)
+        for max_elements in (1, 1000):
+            result = _same_group_overlaps(boxes, scores, idxs, sigma=2.0, max_elements=max_elements)
+            for x, y in zip(result, expected):
+                self.assertTrue(torch.equal(x, y))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,331 @@
+import os
+import tempfile
+import unittest
+from collections import defaultdict
+from unittest import mock
+
+import numpy as np
+import torch
+from detectron2.data import MetadataCatalog
+from detectron2.structures import Boxes, Instances
+
+from defrcn.evaluation import pascal_voc_evaluation
+from defrcn.evaluation.pascal_voc_evaluation import (
+    PascalVOCDetectionEvaluator,
+    load_voc_gt,
+    parse_rec,
+    voc_ap,
+    voc_eval,
+    voc_eval_thresholds,
+)
+from defrcn.structures import DetectionBatch
+
+CLASSES = ["aeroplane", "bicycle", "bird", "boat"]
+THRESHOLDS = [t / 100.0 for t in range(50, 100, 5)]
+
+
+def write_voc_dataset(root, rng, num_images, tie_decimals=None):
+    """
+    Write a random VOC-style image set under `root` and random detections for it.
+    The last class has no ground truth. With `tie_decimals`, scores are rounded so
+    that many of them are tied.
+
+    Returns the image names and the detections of every image, in detectron2's
+    0-based coordinates.
+    """
+    os.makedirs(os.path.join(root, "Annotations"))
+    os.makedirs(os.path.join(root, "ImageSets", "Main"))
+    names = ["{:06d}".format(i) for i in range(num_images)]
+    detections = []
+    for name in names:
+        objects, boxes, scores, classes = [], [], [], []
+        for _ in range(rng.randint(0, 6)):
+            c = rng.randint(len(CLASSES) - 1)
+            x, y = rng.randint(1, 400, size=2)
+            w, h = rng.randint(10, 200, size=2)
+            objects.append((c, x, y, x + w, y + h, int(rng.rand() < 0.2)))
+            for _ in range(rng.randint(0, 4)):
+                jitter = rng.randn(4) * rng.choice([1, 5, 20])
+                boxes.append(np.array([x - 1, y - 1, x + w, y + h]) + jitter)
+                classes.append(c if rng.rand() < 0.8 else rng.randint(len(CLASSES)))
+        scores = rng.rand(len(boxes))
+        if tie_decimals is not None:
+            scores = scores.round(tie_decimals)
+        with open(os.path.join(root, "Annotations", name + ".xml"), "w") as f:
+            f.write("<annotation>" + "".join(
+                "<object><name>{}</name><pose>Unspecified</pose><truncated>0</truncated>"
+                "<difficult>{}</difficult><bndbox><xmin>{}</xmin><ymin>{}</ymin>"
+                "<xmax>{}</xmax><ymax>{}</ymax></bndbox></object>".format(
+                    CLASSES[c], difficult, x1, y1, x2, y2
+                )
+                for c, x1, y1, x2, y2, difficult in objects
+            ) + "</annotation>")
+        instances = Instances((600, 600))
+        instances.pred_boxes = Boxes(torch.tensor(np.array(boxes).reshape(-1, 4), dtype=torch.float32))
+        instances.scores = torch.tensor(scores, dtype=torch.float32)
+        instances.pred_classes = torch.tensor(classes, dtype=torch.int64)
+        detections.append(instances)
+    with open(os.path.join(root, "ImageSets", "Main", "test.txt"), "w") as f:
+        f.write("\n".join(names))
+    return names, detections
+
+
+def class_detections(names, detections, cls_id):
+    """The image names, float64 scores and 1-based VOC boxes of one class."""
+    image_ids, confidence, BB = [], [], []
+    for name, instances in zip(names, detections):
+        keep = instances.pred_classes == cls_id
+        boxes = instances.pred_boxes.tensor[keep].numpy().astype(np.float64)
+        boxes[:, :2] += 1
+        image_ids += [name] * len(boxes)
+        confidence.append(instances.scores[keep].numpy().astype(np.float64))
+        BB.append(boxes)
+    return image_ids, np.concatenate(confidence), np.concatenate(BB).reshape(-1, 4)
+
+
+def reference_voc_eval(annopath, imagenames, classname, image_ids, confidence, BB, ovthresh,
+                       use_07_metric):
+    """The per-detection loop of the original voc_eval, on in-memory detections."""
+    class_recs = {}
+    npos = 0
+    for imagename in imagenames:
+        R = [obj for obj in parse_rec(annopath.format(imagename)) if obj["name"] == classname]
+        bbox = np.array([x["bbox"] for x in R])
+        difficult = np.array([x["difficult"] for x in R]).astype(bool)
+        npos = npos + sum(~difficult)
+        class_recs[imagename] = {"bbox": bbox, "difficult": difficult, "det": [False] * len(R)}
+
+    sorted_ind = np.argsort(-confidence)
+    BB = BB[sorted_ind, :]
+    image_ids = [image_ids[x] for x in sorted_ind]
+
+    nd = len(image_ids)
+    tp = np.zeros(nd)
+    fp = np.zeros(nd)
+    for d in range(nd):
+        R = class_recs[image_ids[d]]
+        bb = BB[d, :].astype(float)
+        ovmax = -np.inf
+        BBGT = R["bbox"].astype(float)
+        if BBGT.size > 0:
+            ixmin = np.maximum(BBGT[:, 0], bb[0])
+            iymin = np.maximum(BBGT[:, 1], bb[1])
+            ixmax = np.minimum(BBGT[:, 2], bb[2])
+            iymax = np.minimum(BBGT[:, 3], bb[3])
+            iw = np.maximum(ixmax - ixmin + 1.0, 0.0)
+            ih = np.maximum(iymax - iymin + 1.0, 0.0)
+            inters = iw * ih
+            uni = (
+                (bb[2] - bb[0] + 1.0) * (bb[3] - bb[1] + 1.0)
+                + (BBGT[:, 2] - BBGT[:, 0] + 1.0) * (BBGT[:, 3] - BBGT[:, 1] + 1.0)
+                - inters
+            )
+            overlaps = inters / uni
+            ovmax = np.max(overlaps)
+            jmax = np.argmax(overlaps)
+        if ovmax > ovthresh:
+            if not R["difficult"][jmax]:
+                if not R["det"][jmax]:
+                    tp[d] = 1.0
+                    R["det"][jmax] = 1
+                else:
+                    fp[d] = 1.0
+        else:
+            fp[d] = 1.0
+
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    return rec, prec, voc_ap(rec, prec, use_07_metric)
+
+
+class SimulatedRanks:
+    """
+    Stand-in for detectron2.utils.comm that runs the ranks one after another in this
+    process. Rank 0 must evaluate last: its gather returns the payloads of all ranks.
+    """
+
+    def __init__(self):
+        self.rank = 0
+        self.payloads = {}
+
+    def gather(self, data, dst=0):
+        self.payloads[self.rank] = data
+        return [self.payloads[r] for r in sorted(self.payloads)] if self.rank == 0 else []
+
+    def is_main_process(self):
+        return self.rank == 0
+
+
+class VOCTestCase(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self.root = self._tmpdir.name
+        self.annopath = os.path.join(self.root, "Annotations", "{}.xml")
+        self.imagesetfile = os.path.join(self.root, "ImageSets", "Main", "test.txt")
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def make_evaluator(self, dist_eval="gather", output_dir=None):
+        """An evaluator of the image set in `root`, over the classes with ground truth."""
+        dataset_name = "voc_2007_test_{}".format(os.path.basename(self.root))
+        MetadataCatalog.get(dataset_name).set(
+            dirname=self.root, split="test", year=2007, thing_classes=CLASSES[:-1],
+            base_classes=CLASSES[:2], novel_classes=CLASSES[2:-1],
+        )
+        return PascalVOCDetectionEvaluator(dataset_name, output_dir, dist_eval)
+
+    def assertResultsEqual(self, result, expected):
+        for x, y in zip(result, expected):
+            np.testing.assert_array_equal(x, y)
+
+
+class TestVOCEvalThresholds(VOCTestCase):
+    def check_matches_reference(self, tie_decimals):
+        names, detections = write_voc_dataset(
+            self.root, np.random.RandomState(0), 150, tie_decimals
+        )
+        imagenames, gt = load_voc_gt(self.annopath, self.imagesetfile, CLASSES)
+        image_index = {name: i for i, name in enumerate(imagenames)}
+        for cls_id, classname in enumerate(CLASSES):
+            image_ids, confidence, BB = class_detections(names, detections, cls_id)
+            for use_07_metric in (True, False):
+                results = voc_eval_thresholds(
+                    [image_index[x] for x in image_ids], confidence, BB, gt[classname],
+                    THRESHOLDS, use_07_metric,
+                )
+                for ovthresh, result in zip(THRESHOLDS, results):
+                    self.assertResultsEqual(result, reference_voc_eval(
+                        self.annopath, imagenames, classname, image_ids, confidence, BB,
+                        ovthresh, use_07_metric,
+                    ))
+
+    def test_matches_reference(self):
+        self.check_matches_reference(None)
+
+    def test_tied_scores(self):
+        self.check_matches_reference(1)
+
+    def test_voc_eval_file(self):
+        names, detections = write_voc_dataset(self.root, np.random.RandomState(1), 50)
+        imagenames = load_voc_gt(self.annopath, self.imagesetfile, [])[0]
+        detpath = os.path.join(self.root, "{}.txt")
+        for cls_id, classname in enumerate(CLASSES):
+            image_ids, confidence, BB = class_detections(names, detections, cls_id)
+            with open(detpath.format(classname), "w") as f:
+                f.write("\n".join(
+                    " ".join([image_id, repr(float(score))] + [repr(float(x)) for x in box])
+                    for image_id, score, box in zip(image_ids, confidence, BB)
+                ))
+            self.assertResultsEqual(
+                voc_eval(detpath, self.annopath, self.imagesetfile, classname, 0.7, True),
+                reference_voc_eval(self.annopath, imagenames, classname, image_ids,
+                                   confidence, BB, 0.7, True),
+            )
+
+
+class TestPascalVOCDetectionEvaluator(VOCTestCase):
+    def test_matches_voc_eval(self):
+        names, detections = write_voc_dataset(self.root, np.random.RandomState(2), 120)
+        detections = [x[x.pred_classes < len(CLASSES) - 1] for x in detections]
+        evaluator = self.make_evaluator()
+        evaluator.reset()
+        # a mix of output dicts and detection batches, as models return either
+        for start in range(0, len(names), 8):
+            inputs = [{"image_id": name} for name in names[start:start + 8]]
+            batch = detections[start:start + 8]
+            if start % 16:
+                evaluator.process(inputs, [{"instances": x} for x in batch])
+            else:
+                evaluator.process_detections(inputs, DetectionBatch.from_instances(batch))
+        result = evaluator.evaluate()["bbox"]
+
+        # voc_eval at each threshold, on detection files written at full precision
+        imagenames = load_voc_gt(self.annopath, self.imagesetfile, [])[0]
+        aps = defaultdict(list)
+        for cls_id, classname in enumerate(CLASSES[:-1]):
+            image_ids, confidence, BB = class_detections(names, detections, cls_id)
+            for thresh in range(50, 100, 5):
+                ap = reference_voc_eval(self.annopath, imagenames, classname, image_ids,
+                                        confidence, BB, thresh / 100.0, True)[2]
+                aps[thresh].append(ap * 100)
+        for prefix, classes in [("", slice(None)), ("b", slice(0, 2)), ("n", slice(2, None))]:
+            mAP = {iou: np.mean(x[classes]) for iou, x in aps.items()}
+            self.assertEqual(result[prefix + "AP"], np.mean(list(mAP.values())))
+            self.assertEqual(result[prefix + "AP50"], mAP[50])
+            self.assertEqual(result[prefix + "AP75"], mAP[75])
+
+
+    def test_export_matches_devkit_lines(self):
+        names, detections = write_voc_dataset(self.root, np.random.RandomState(4), 40)
+        detections = [x[x.pred_classes < len(CLASSES) - 1] for x in detections]
+        output_dir = os.path.join(self.root, "output")
+        evaluator = self.make_evaluator(output_dir=output_dir)
+        evaluator.reset()
+        evaluator.process(
+            [{"image_id": name} for name in names], [{"instances": x} for x in detections]
+        )
+        evaluator.evaluate()
+
+        # the lines that the evaluator used to write for voc_eval, image by image
+        expected = defaultdict(list)
+        for name, instances in zip(names, detections):
+            boxes = instances.pred_boxes.tensor.numpy()
+            for box, score, cls in zip(boxes, instances.scores.tolist(), instances.pred_classes.tolist()):
+                xmin, ymin, xmax, ymax = box
+                xmin += 1
+                ymin += 1
+                expected[cls].append(f"{name} {score:.3f} {xmin:.1f} {ymin:.1f} {xmax:.1f} {ymax:.1f}")
+        dirname = os.path.join(output_dir, "{}_results".format(evaluator._dataset_name))
+        for cls_id, classname in enumerate(CLASSES[:-1]):
+            with open(os.path.join(dirname, classname + ".txt")) as f:
+                self.assertEqual(f.read(), "\n".join(expected[cls_id]))
+
+
+class TestReduceMode(VOCTestCase):
+    def evaluate(self, names, detections, shard_sizes, dist_eval):
+        """Evaluate on one simulated rank per shard, and return the results of rank 0."""
+        ranks = SimulatedRanks()
+        evaluators = []
+        start = 0
+        for size in shard_sizes:
+            evaluator = self.make_evaluator(dist_eval)
+            evaluator.reset()
+            if size:
+                evaluator.process(
+                    [{"image_id": name} for name in names[start:start + size]],
+                    [{"instances": x} for x in detections[start:start + size]],
+                )
+            evaluators.append(evaluator)
+            start += size
+        self.assertEqual(start, len(names))
+        with mock.patch.object(pascal_voc_evaluation, "comm", ranks):
+            for rank in reversed(range(len(evaluators))):
+                ranks.rank = rank
+                results = evaluators[rank].evaluate()
+                if rank:
+                    self.assertIsNone(results)
+        return results
+
+    def check_reduce_matches(self, tie_decimals, baseline_mode):
+        names, detections = write_voc_dataset(
+            self.root, np.random.RandomState(3), 100, tie_decimals
+        )
+        detections = [x[x.pred_classes < len(CLASSES) - 1] for x in detections]
+        expected = self.evaluate(names, detections, [100], baseline_mode)
+        # shards of different sizes, with an empty rank
+        for shard_sizes in ([100], [30, 0, 45, 25], [1, 99]):
+            self.assertEqual(self.evaluate(names, detections, shard_sizes, "reduce"), expected)
+
+    def test_matches_gather(self):
+        self.check_reduce_matches(None, "gather")
+
+    def test_tied_scores_match_single_process(self):
+        # with ties, only the stable sort of "reduce" ranks every shard like the whole set
+        self.check_reduce_matches(1, "reduce")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import unittest
+
+import torch
+from detectron2.structures import Boxes, Instances
+
+from defrcn.modeling.roi_heads import ROIHeads, select_proposals_by_objectness
+
+
+def random_proposals(num_images, max_proposals):
+    proposals = []
+    for _ in range(num_images):
+        n = int(torch.randint(0, max_proposals, ()))
+        instances = Instances((800, 800))
+        instances.proposal_boxes = Boxes(torch.rand(n, 4) * 400)
+        # unique logits, so that the ranking is well defined
+        instances.objectness_logits = torch.randperm(n).float() / n * 8 - 4
+        proposals.append(instances)
+    return proposals
+
+
+def reference_num_keep(logits, min_score, mass, min_keep, max_keep):
+    """The gate of one image, one limit at a time in the documented order."""
+    scores = sorted(logits.sigmoid().tolist(), reverse=True)
+    num_keep = len(scores)
+    if min_score > 0:
+        num_keep = sum(s >= min_score for s in scores)
+    if mass < 1.0 and scores:
+        total, num_mass = sum(scores), 0
+        while sum(scores[:num_mass]) < mass * total:
+            num_mass += 1
+        num_keep = min(num_keep, max(num_mass, 1))
+    num_keep = min(max(num_keep, min_keep), len(scores))
+    if max_keep >= 0:
+        num_keep = min(num_keep, max_keep)
+    return num_keep
+
+
+class TestSelectProposalsByObjectness(unittest.TestCase):
+    def test_matches_reference(self):
+        torch.manual_seed(0)
+        proposals = random_proposals(20, 300)
+        for min_score, mass, min_keep, max_keep in [
+            (0.0, 1.0, 0, -1), (0.3, 1.0, 0, -1), (0.0, 0.8, 0, -1), (0.5, 0.6, 16, -1),
+            (0.9, 1.0, 64, 32), (0.2, 0.9, 8, 100),
+        ]:
+            kept = select_proposals_by_objectness(proposals, min_score, mass, min_keep, max_keep)
+            for p, k in zip(proposals, kept):
+                num_keep = reference_num_keep(p.objectness_logits, min_score, mass, min_keep, max_keep)
+                self.assertEqual(len(k), num_keep)
+                # the top proposals, in their original order
+                top = p.objectness_logits.sort(descending=True)[1][:num_keep].sort()[0]
+                self.assertTrue(torch.equal(k.objectness_logits, p.objectness_logits[top]))
+                self.assertTrue(torch.equal(k.proposal_boxes.tensor, p.proposal_boxes.tensor[top]))
+
+    def test_min_keep_and_max_keep(self):
+        proposals = [Instances((800, 800))]
+        proposals[0].objectness_logits = torch.full((50,), -10.0)
+        # min_keep restores proposals dropped by the threshold, max_keep wins over it
+        self.assertEqual(len(select_proposals_by_objectness(proposals, 0.5, 1.0, 16)[0]), 16)
+        self.assertEqual(len(select_proposals_by_objectness(proposals, 0.5, 1.0, 16, 8)[0]), 8)
+        self.assertEqual(len(select_proposals_by_objectness(proposals, 0.0, 1.0, 0, 20)[0]), 20)
+
+
+class TestROIHeadsGate(unittest.TestCase):
+    def make_heads(self, min_objectness, mass, min_keep, max_keep):
+        heads = ROIHeads.__new__(ROIHeads)
+        heads.test_min_objectness = min_objectness
+        heads.test_objectness_mass = mass
+        heads.test_gate_min_keep = min_keep
+        heads.test_gate_max_keep = max_keep
+        heads.proposal_gate_stats = {"images": 0, "proposals": 0, "kept": 0}
+        return heads
+
+    def test_disabled_by_default(self):
+        proposals = random_proposals(3, 100)
+        heads = self.make_heads(0.0, 1.0, 16, -1)
+        self.assertIs(heads._gate_proposals(proposals), proposals)
+        self.assertEqual(heads.proposal_gate_stats["images"], 0)
+
+    def test_settings_and_stats(self):
+        torch.manual_seed(1)
+        proposals = random_proposals(4, 200)
+        heads = self.make_heads(0.3, 0.9, 4, 50)
+        kept = heads._gate_proposals(proposals)
+        expected = select_proposals_by_objectness(proposals, 0.3, 0.9, 4, 50)
+        self.assertEqual([len(k) for k in kept], [len(e) for e in expected])
+        self.assertTrue(all(len(k) <= 50 for k in kept))
+        stats = heads.proposal_gate_stats
+        self.assertEqual(stats["images"], 4)
+        self.assertEqual(stats["proposals"], sum(len(p) for p in proposals))
+        self.assertEqual(stats["kept"], sum(len(k) for k in kept))
+
+
+if __name__ == "__main__":
+    unittest.main()
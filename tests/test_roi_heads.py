@@ -0,0 +1,46 @@
+import unittest
+
+import torch
+from torch import nn
+from torchvision.ops import roi_align
+from detectron2.structures import Boxes
+
+from defrcn.modeling.roi_heads.roi_heads import Res5ROIHeads
+
+
+class ROIAlignPooler(nn.Module):
+    """A single-level ROIPooler."""
+
+    def forward(self, features, boxes):
+        return roi_align(features[0], [b.tensor for b in boxes], 7, 1 / 16, 0, aligned=True)
+
+
+def make_res5_heads():
+    heads = Res5ROIHeads.__new__(Res5ROIHeads)
+    nn.Module.__init__(heads)
+    heads.pooler = ROIAlignPooler()
+    heads.res5 = nn.Sequential(nn.Conv2d(8, 16, 3, stride=2, padding=1), nn.ReLU()).eval()
+    return heads
+
+
+class TestChunkedRes5(unittest.TestCase):
+    def test_matches_single_pass(self):
+        torch.manual_seed(0)
+        heads = make_res5_heads()
+        features = [torch.randn(3, 8, 40, 50)]
+        for num_boxes in ([5, 0, 7], [300, 1000, 17], [0, 0, 3]):
+            boxes = []
+            for n in num_boxes:
+                xy = torch.rand(n, 2) * 600
+                boxes.append(Boxes(torch.cat([xy, xy + torch.rand(n, 2) * 200 + 1], dim=1)))
+            with torch.no_grad():
+                expected = heads._shared_roi_transform(features, boxes).mean(dim=[2, 3])
+                # chunks that split images, chunks of one box and a single chunk
+                for chunk_size in (1, 4, 64, 999, 5000):
+                    result = heads._chunked_roi_transform(features, boxes, chunk_size)
+                    self.assertEqual(result.shape, expected.shape)
+                    self.assertTrue(torch.allclose(result, expected, atol=1e-6))
+
+
+if __name__ == "__main__":
+    unittest.main()
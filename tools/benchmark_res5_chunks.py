@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import resource
+import multiprocessing
+import torch
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.structures import Boxes, Instances  # noqa: E402
+from main import Trainer, setup  # noqa: E402
+from defrcn.engine import default_argument_parser  # noqa: E402
+
+
+def random_proposals(num_images, num_proposals, image_size, device):
+    h, w = image_size
+    proposals = []
+    for _ in range(num_images):
+        xy = torch.rand(num_proposals, 2, device=device) * torch.tensor([w, h], device=device)
+        wh = torch.rand(num_proposals, 2, device=device) * torch.tensor([w, h], device=device) / 2
+        instances = Instances(image_size)
+        instances.proposal_boxes = Boxes(torch.cat([xy, xy + wh], dim=1))
+        instances.objectness_logits = torch.zeros(num_proposals, device=device)
+        proposals.append(instances)
+    return proposals
+
+
+def run_setting(args, chunk_size):
+    """
+    Time `roi_heads` on random features and proposals with TEST.RES5_CHUNK_SIZE set
+    to `chunk_size`. Runs in its own process so that the peak RSS is its own.
+    """
+    torch.set_num_threads(args.num_threads)
+    cfg = setup(args)
+    model = Trainer.build_model(cfg).eval()
+    roi_heads = model.roi_heads
+    roi_heads.test_res5_chunk_size = chunk_size
+    device = torch.device(cfg.MODEL.DEVICE)
+
+    h, w = args.image_size
+    stride = roi_heads.feature_strides[roi_heads.in_features[0]]
+    channels = roi_heads.feature_channels[roi_heads.in_features[0]]
+    features = {
+        roi_heads.in_features[0]: torch.randn(
+            args.num_images, channels, h // stride, w // stride, device=device
+        )
+    }
+    proposals = random_proposals(
+        args.num_images, cfg.MODEL.RPN.POST_NMS_TOPK_TEST, (h, w), device
+    )
+
+    with torch.no_grad():
+        roi_heads(None, features, proposals)  # warmup
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            base_memory = torch.cuda.memory_allocated()
+        start = time.perf_counter()
+        for _ in range(args.iters):
+            roi_heads(None, features, proposals)
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        elapsed = time.perf_counter() - start
+
+    if device.type == "cuda":
+        peak_memory = torch.cuda.max_memory_allocated() - base_memory
+    else:
+        # fresh process: the peak RSS is the model, the inputs and this setting
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        "chunk_size": chunk_size,
+        "images/s": args.iters * args.num_images / elapsed,
+        "peak memory (MB)": peak_memory / 1024 ** 2,
+    }
+
+
+def main():
+    """
+    Benchmark the memory / throughput tradeoff of TEST.RES5_CHUNK_SIZE for the
+    Res5ROIHeads of a config, on random features and MODEL.RPN.POST_NMS_TOPK_TEST
+    random proposals per image. Peak memory is the CUDA allocator peak above the
+    model and inputs, or the process peak RSS on CPU.
+    """
+    parser = default_argument_parser()
+    parser.add_argument('--chunk-sizes', type=int, nargs='+', default=[0, 512, 256, 128, 64],
+                        help='TEST.RES5_CHUNK_SIZE values, 0 runs all proposals at once')
+    parser.add_argument('--num-images', type=int, default=1, help='images per forward')
+    parser.add_argument('--image-size', type=int, nargs=2, default=[800, 1216], help='h w')
+    parser.add_argument('--iters', type=int, default=5, help='timed forwards per setting')
+    parser.add_argument('--num-threads', type=int, default=torch.get_num_threads(), help='cpu threads')
+    args = parser.parse_args()
+
+    rows = []
+    ctx = multiprocessing.get_context("spawn")
+    for chunk_size in args.chunk_sizes:
+        with ctx.Pool(1) as pool:
+            rows.append(pool.apply(run_setting, (args, chunk_size)))
+    print(tabulate([list(r.values()) for r in rows], headers=list(rows[0].keys()),
+                   floatfmt=".1f", tablefmt="pipe"))
+
+
+if __name__ == '__main__':
+    main()
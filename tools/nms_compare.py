@@ -0,0 +1,196 @@
+import os
+import sys
+import json
+import time
+import torch
+import numpy as np
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.utils import comm  # noqa: E402
+from detectron2.engine import launch  # noqa: E402
+from detectron2.checkpoint import DetectionCheckpointer  # noqa: E402
+from main import Trainer, setup  # noqa: E402 registers all datasets
+from defrcn.engine import default_argument_parser  # noqa: E402
+from defrcn.modeling.roi_heads.fast_rcnn import fast_rcnn_inference_single_image  # noqa: E402
+from defrcn.evaluation.pascal_voc_evaluation import voc_match, voc_ap_from_matches  # noqa: E402
+
+NMS_TYPES = ["greedy", "fast", "matrix"]
+
+
+def synthetic_image(rng, num_objects, num_classes, num_background, image_size=(800, 1216)):
+    """
+    A random scene and the output of a detector-like head for it: every object gets a
+    cluster of proposals, jittered around it, that score higher the closer they are,
+    with a fraction of the mass on a wrong class, plus low scoring background proposals.
+
+    Returns the (R, K * 4) boxes and (R, K + 1) scores of fast_rcnn_inference, and the
+    (G, 4) boxes and (G,) classes of the ground truth.
+    """
+    h, w = image_size
+    xy = rng.rand(num_objects, 2) * [w * 0.8, h * 0.8]
+    wh = rng.rand(num_objects, 2) * [w * 0.3, h * 0.3] + 16
+    gt_boxes = np.concatenate([xy, xy + wh], axis=1)
+    gt_classes = rng.randint(num_classes, size=num_objects)
+
+    per_object = 40
+    jitter = rng.rand(num_objects, per_object, 1) * 0.4
+    noise = rng.randn(num_objects, per_object, 4) * jitter * np.tile(wh, 2)[:, None]
+    boxes = (gt_boxes[:, None] + noise).reshape(-1, 4)
+    fg = np.clip(0.95 - 2 * jitter.reshape(-1) + rng.randn(len(boxes)) * 0.1, 0.01, 0.99)
+    classes = np.repeat(gt_classes, per_object)
+    wrong = (classes + rng.randint(1, num_classes, size=len(classes))) % num_classes
+
+    xy = rng.rand(num_background, 2) * [w, h]
+    background = np.concatenate([xy, xy + rng.rand(num_background, 2) * [w / 4, h / 4]], axis=1)
+    boxes = np.concatenate([boxes, background])
+    fg = np.concatenate([fg, rng.rand(num_background) * 0.3])
+    classes = np.concatenate([classes, rng.randint(num_classes, size=num_background)])
+    wrong = np.concatenate([wrong, rng.randint(num_classes, size=num_background)])
+
+    scores = np.zeros((len(boxes), num_classes + 1))
+    rows = np.arange(len(boxes))
+    scores[rows, classes] = fg * 0.8
+    scores[rows, wrong] += fg * 0.2
+    scores[:, -1] = 1 - fg
+    boxes = np.tile(boxes, (1, num_classes))
+    return (
+        torch.tensor(boxes, dtype=torch.float32),
+        torch.tensor(scores, dtype=torch.float32),
+        gt_boxes,
+        gt_classes,
+    )
+
+
+def synthetic_benchmark(args):
+    """
+    Compare the NMS types without a model, on synthetic detector outputs: the VOC AP of
+    the detections against the synthetic ground truth, and the median wall time of the
+    postprocessing of one image (thresholding, NMS and top-k).
+    """
+    torch.set_num_threads(args.num_threads)
+    num_classes, image_size = 20, (800, 1216)
+    ovthreshs = [t / 100.0 for t in range(50, 100, 5)]
+    rows = []
+    for num_objects, num_background in [(3, 300), (15, 1000), (50, 2000)]:
+        rng = np.random.RandomState(0)
+        images = [
+            synthetic_image(rng, num_objects, num_classes, num_background, image_size)
+            for _ in range(args.num_images)
+        ]
+        for nms_type in args.nms_types:
+            times, dets = [], []
+            for i, (boxes, scores, _, _) in enumerate(images):
+                start = time.perf_counter()
+                result, _ = fast_rcnn_inference_single_image(
+                    boxes, scores, image_size, 0.05, 0.5, 100, nms_type=nms_type
+                )
+                times.append(time.perf_counter() - start)
+                dets.append((i, result))
+
+            aps = []
+            for c in range(num_classes):
+                gt = [g[2][g[3] == c] for g in images]
+                width = max([len(x) for x in gt] + [1])
+                class_gt = {
+                    "bbox": np.zeros((len(images), width, 4)),
+                    "difficult": np.zeros((len(images), width), dtype=bool),
+                    "valid": np.zeros((len(images), width), dtype=bool),
+                }
+                for i, x in enumerate(gt):
+                    class_gt["bbox"][i, :len(x)] = x
+                    class_gt["valid"][i, :len(x)] = True
+                npos = int(class_gt["valid"].sum())
+                if npos == 0:
+                    continue
+                image_inds = np.concatenate([
+                    np.full(int((r.pred_classes == c).sum()), i) for i, r in dets
+                ]).astype(np.int64)
+                confidence = np.concatenate([r.scores[r.pred_classes == c].numpy() for _, r in dets])
+                BB = np.concatenate([
+                    r.pred_boxes.tensor[r.pred_classes == c].numpy() for _, r in dets
+                ]).astype(np.float64).reshape(-1, 4)
+                tp, fp = voc_match(image_inds, confidence, BB, class_gt, ovthreshs)
+                aps.append([ap for _, _, ap in voc_ap_from_matches(confidence, tp, fp, npos)])
+            aps = np.array(aps) * 100
+            rows.append([
+                num_objects,
+                int(np.mean([(s[:, :-1] > 0.05).sum().item() for _, s, _, _ in images])),
+                nms_type,
+                aps.mean(),
+                aps[:, 0].mean(),
+                aps[:, 5].mean(),
+                np.median(times) * 1000,
+            ])
+    print(tabulate(
+        rows,
+        headers=["objects", "candidates", "nms", "AP", "AP50", "AP75", "ms / image"],
+        floatfmt=".2f",
+        tablefmt="pipe",
+    ))
+    return rows
+
+
+def main(args):
+    """
+    Evaluate one model with every TEST.NMS_TYPE and report the AP of each next to
+    the greedy NMS baseline, plus the wall time of each evaluation.
+    """
+    cfg = setup(args)
+    model = Trainer.build_model(cfg)
+    DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
+        cfg.MODEL.WEIGHTS, resume=False
+    )
+
+    results = {}
+    for nms_type in args.nms_types:
+        model.roi_heads.test_nms_type = nms_type
+        start = time.perf_counter()
+        res = Trainer.test(cfg, model)
+        if len(cfg.DATASETS.TEST) == 1:
+            res = {cfg.DATASETS.TEST[0]: res}
+        results[nms_type] = {"time": time.perf_counter() - start, "results": res}
+
+    if not comm.is_main_process():
+        return results
+
+    rows = []
+    for dataset_name in cfg.DATASETS.TEST:
+        base = results[args.nms_types[0]]["results"][dataset_name]["bbox"]
+        metrics = [k for k in base if "-" not in k]  # skip per-category entries
+        for nms_type in args.nms_types:
+            bbox = results[nms_type]["results"][dataset_name]["bbox"]
+            rows.append(
+                [dataset_name, nms_type, results[nms_type]["time"]]
+                + ["{:.2f} ({:+.2f})".format(bbox[k], bbox[k] - base[k]) for k in metrics]
+            )
+    print(tabulate(rows, headers=["dataset", "nms", "time (s)"] + metrics, floatfmt=".1f", tablefmt="pipe"))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
+    return results
+
+
+if __name__ == "__main__":
+    parser = default_argument_parser()
+    parser.add_argument('--nms-types', type=str, nargs='+', default=NMS_TYPES, choices=NMS_TYPES,
+                        help='NMS types to evaluate, deltas are against the first one')
+    parser.add_argument('--output', type=str, default='', help='optional json file for all results')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='compare on synthetic detector outputs, without a model or dataset')
+    parser.add_argument('--num-images', type=int, default=50, help='synthetic images per setting')
+    parser.add_argument('--num-threads', type=int, default=1, help='cpu threads of the synthetic run')
+    args = parser.parse_args()
+    if args.synthetic:
+        synthetic_benchmark(args)
+        sys.exit(0)
+    launch(
+        main,
+        args.num_gpus,
+        num_machines=args.num_machines,
+        machine_rank=args.machine_rank,
+        dist_url=args.dist_url,
+        args=(args,),
+    )
@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import argparse
+import itertools
+import multiprocessing
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import Trainer  # noqa: E402 registers all datasets
+from defrcn.config import get_cfg  # noqa: E402
+from defrcn.evaluation.pcb_sweep import evaluate_calibration, load_pcb_scores  # noqa: E402
+
+_records, _evaluator = None, None
+
+
+def init_worker(scores_file):
+    global _records, _evaluator
+    _records = load_pcb_scores(scores_file)
+    dataset_name = str(_records["dataset_name"])
+    # no output folder, so that parallel workers never write the same files
+    _evaluator = Trainer.build_evaluator(get_cfg(), dataset_name, output_folder="")
+
+
+def evaluate_setting(setting):
+    alpha, upper, lower = setting
+    results = evaluate_calibration(_evaluator, _records, alpha, upper, lower)
+    return {"alpha": alpha, "upper": upper, "lower": lower, "bbox": results.get("bbox", {})}
+
+
+def main():
+    """
+    Re-run PCB calibration and evaluation for a grid of TEST.PCB_ALPHA / PCB_UPPER /
+    PCB_LOWER values from the raw scores dumped with TEST.PCB_DUMP_DIR, without
+    running any model.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scores', type=str, required=True, help='pcb_scores_*.npz dumped by inference')
+    parser.add_argument('--alpha', type=float, nargs='+', default=[0.5], help='PCB_ALPHA values')
+    parser.add_argument('--upper', type=float, nargs='+', default=[1.0], help='PCB_UPPER values')
+    parser.add_argument('--lower', type=float, nargs='+', default=[0.05], help='PCB_LOWER values')
+    parser.add_argument('--num-workers', type=int, default=4, help='parallel evaluation processes')
+    parser.add_argument('--output', type=str, default='', help='optional json file for all results')
+    args = parser.parse_args()
+
+    settings = list(itertools.product(args.alpha, args.upper, args.lower))
+    with multiprocessing.Pool(args.num_workers, initializer=init_worker, initargs=(args.scores,)) as pool:
+        results = pool.map(evaluate_setting, settings)
+
+    metrics = [k for k in results[0]["bbox"] if "-" not in k]  # skip per-category entries
+    rows = [[r["alpha"], r["upper"], r["lower"]] + [r["bbox"][k] for k in metrics] for r in results]
+    print(tabulate(rows, headers=["alpha", "upper", "lower"] + metrics, floatfmt=".2f", tablefmt="pipe"))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
+
+
+if __name__ == '__main__':
+    main()
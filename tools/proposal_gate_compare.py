@@ -0,0 +1,191 @@
+import os
+import sys
+import json
+import time
+import itertools
+import torch
+import numpy as np
+from tabulate import tabulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from detectron2.utils import comm  # noqa: E402
+from detectron2.engine import launch  # noqa: E402
+from detectron2.checkpoint import DetectionCheckpointer  # noqa: E402
+from main import Trainer, setup  # noqa: E402 registers all datasets
+from defrcn.engine import default_argument_parser  # noqa: E402
+from detectron2.structures import Boxes, Instances, pairwise_iou  # noqa: E402
+from defrcn.modeling.roi_heads import select_proposals_by_objectness  # noqa: E402
+
+
+def synthetic_proposals(rng, num_objects, num_proposals=1000, image_size=(800, 1216)):
+    """
+    A random scene and RPN-like proposals for it: every object gets a cluster of
+    proposals jittered around it, whose objectness is higher the closer they are,
+    and the rest are low-objectness background, as after POST_NMS_TOPK_TEST.
+
+    Returns the proposals as Instances and the (G, 4) ground truth boxes.
+    """
+    h, w = image_size
+    xy = rng.rand(num_objects, 2) * [w * 0.8, h * 0.8]
+    wh = rng.rand(num_objects, 2) * [w * 0.3, h * 0.3] + 16
+    gt_boxes = np.concatenate([xy, xy + wh], axis=1)
+
+    per_object = 30
+    jitter = rng.rand(num_objects, per_object, 1) * 0.6
+    noise = rng.randn(num_objects, per_object, 4) * jitter * np.tile(wh, 2)[:, None]
+    boxes = (gt_boxes[:, None] + noise).reshape(-1, 4)
+    # some objects are hard for the RPN: all of their proposals score low
+    hardness = np.repeat(rng.rand(num_objects) * 0.6, per_object)
+    objectness = 0.95 - jitter.reshape(-1) - hardness + rng.randn(len(boxes)) * 0.15
+    objectness = np.clip(objectness, 0.01, 0.99)
+
+    num_background = max(num_proposals - len(boxes), 0)
+    xy = rng.rand(num_background, 2) * [w, h]
+    background = np.concatenate([xy, xy + rng.rand(num_background, 2) * [w / 4, h / 4]], axis=1)
+    boxes = np.concatenate([boxes, background])
+    objectness = np.concatenate([objectness, rng.beta(1, 6, size=num_background)])
+    top = np.argsort(-objectness)[:num_proposals]
+    boxes, objectness = boxes[top], objectness[top]
+
+    proposals = Instances(image_size)
+    proposals.proposal_boxes = Boxes(torch.tensor(boxes, dtype=torch.float32))
+    proposals.objectness_logits = torch.tensor(np.log(objectness / (1 - objectness)), dtype=torch.float32)
+    return proposals, gt_boxes
+
+
+def synthetic_benchmark(args):
+    """
+    Compare the gate settings without a model, on synthetic RPN outputs: the
+    proposals per image that reach the ROI head, which the ROI head's cost scales
+    with, and the recall of the ground truth by the kept proposals, which bounds
+    the AP the detector can reach.
+    """
+    torch.set_num_threads(args.num_threads)
+    settings = [(0.0, 1.0)] + [
+        s for s in itertools.product(args.min_objectness, args.mass) if s != (0.0, 1.0)
+    ]
+    rows = []
+    for num_objects in [3, 15, 50]:
+        rng = np.random.RandomState(0)
+        images = [synthetic_proposals(rng, num_objects) for _ in range(args.num_images)]
+        for min_objectness, mass in settings:
+            baseline = (min_objectness, mass) == (0.0, 1.0)
+            max_keep = -1 if baseline else args.max_keep
+            start = time.perf_counter()
+            kept = select_proposals_by_objectness(
+                [p for p, _ in images], min_objectness, mass, args.min_keep, max_keep
+            )
+            elapsed = time.perf_counter() - start
+            recalls = []
+            for k, (_, gt_boxes) in zip(kept, images):
+                iou = pairwise_iou(Boxes(torch.tensor(gt_boxes, dtype=torch.float32)), k.proposal_boxes)
+                best = iou.max(dim=1)[0] if len(k) else torch.zeros(len(gt_boxes))
+                recalls.append([(best >= t).float().mean().item() for t in (0.5, 0.7)])
+            recalls = np.array(recalls) * 100
+            rows.append([
+                num_objects,
+                min_objectness,
+                mass,
+                np.mean([len(k) for k in kept]),
+                recalls[:, 0].mean(),
+                recalls[:, 1].mean(),
+                elapsed / len(images) * 1000,
+            ])
+    print(tabulate(
+        rows,
+        headers=["objects", "min objectness", "mass", "proposals / image", "recall@0.5",
+                 "recall@0.7", "gate ms / image"],
+        floatfmt=".2f",
+        tablefmt="pipe",
+    ))
+    return rows
+
+
+def main(args):
+    """
+    Evaluate one model with a grid of TEST.PROPOSAL_MIN_OBJECTNESS /
+    PROPOSAL_OBJECTNESS_MASS gates and report, for each, the proposals that reach
+    the ROI head per image and the AP delta against the ungated baseline.
+    """
+    cfg = setup(args)
+    model = Trainer.build_model(cfg)
+    DetectionCheckpointer(model, save_dir=cfg.OUTPUT_DIR).resume_or_load(
+        cfg.MODEL.WEIGHTS, resume=False
+    )
+    roi_heads = model.roi_heads
+    roi_heads.test_gate_min_keep = args.min_keep
+
+    settings = [(0.0, 1.0)] + [
+        s for s in itertools.product(args.min_objectness, args.mass) if s != (0.0, 1.0)
+    ]
+    results = []
+    for min_objectness, mass in settings:
+        roi_heads.test_min_objectness = min_objectness
+        roi_heads.test_objectness_mass = mass
+        baseline = (min_objectness, mass) == (0.0, 1.0)
+        roi_heads.test_gate_max_keep = -1 if baseline else args.max_keep
+        roi_heads.proposal_gate_stats = {"images": 0, "proposals": 0, "kept": 0}
+        start = time.perf_counter()
+        res = Trainer.test(cfg, model)
+        if len(cfg.DATASETS.TEST) == 1:
+            res = {cfg.DATASETS.TEST[0]: res}
+        stats = roi_heads.proposal_gate_stats
+        results.append({
+            "min_objectness": min_objectness,
+            "mass": mass,
+            "kept_per_image": stats["kept"] / max(stats["images"], 1),
+            "proposals_per_image": stats["proposals"] / max(stats["images"], 1),
+            "time": time.perf_counter() - start,
+            "results": res,
+        })
+
+    if not comm.is_main_process():
+        return results
+
+    rows = []
+    for dataset_name in cfg.DATASETS.TEST:
+        base = results[0]["results"][dataset_name]["bbox"]
+        metrics = [k for k in base if "-" not in k]  # skip per-category entries
+        for r in results:
+            bbox = r["results"][dataset_name]["bbox"]
+            # the stats of the ungated baseline are not collected
+            kept = r["kept_per_image"] if r["proposals_per_image"] else "all"
+            rows.append(
+                [dataset_name, r["min_objectness"], r["mass"], kept, r["time"]]
+                + ["{:.2f} ({:+.2f})".format(bbox[k], bbox[k] - base[k]) for k in metrics]
+            )
+    headers = ["dataset", "min objectness", "mass", "proposals / image", "time (s)"] + metrics
+    print(tabulate(rows, headers=headers, floatfmt=".1f", tablefmt="pipe"))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f)
+    return results
+
+
+if __name__ == "__main__":
+    parser = default_argument_parser()
+    parser.add_argument('--min-objectness', type=float, nargs='+', default=[0.0, 0.05, 0.1, 0.2],
+                        help='TEST.PROPOSAL_MIN_OBJECTNESS values')
+    parser.add_argument('--mass', type=float, nargs='+', default=[1.0, 0.9, 0.8],
+                        help='TEST.PROPOSAL_OBJECTNESS_MASS values')
+    parser.add_argument('--min-keep', type=int, default=16, help='TEST.PROPOSAL_GATE_MIN_KEEP')
+    parser.add_argument('--max-keep', type=int, default=-1, help='TEST.PROPOSAL_GATE_MAX_KEEP')
+    parser.add_argument('--output', type=str, default='', help='optional json file for all results')
+    parser.add_argument('--synthetic', action='store_true',
+                        help='compare on synthetic RPN outputs, without a model or dataset')
+    parser.add_argument('--num-images', type=int, default=50, help='synthetic images per setting')
+    parser.add_argument('--num-threads', type=int, default=1, help='cpu threads of the synthetic run')
+    args = parser.parse_args()
+    if args.synthetic:
+        synthetic_benchmark(args)
+        sys.exit(0)
+    launch(
+        main,
+        args.num_gpus,
+        num_machines=args.num_machines,
+        machine_rank=args.machine_rank,
+        dist_url=args.dist_url,
+        args=(args,),
+    )